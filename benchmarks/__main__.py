@@ -0,0 +1,210 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+
+Run the benchmark suite and store the results under benchmarks/results/<version>.json:
+
+    python -m benchmarks [--quick] [--scale N] [--filter NAME] [--compare RESULTS_FILE]
+"""
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+import mechanical_markdown
+
+from benchmarks import generators
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+BENCHMARKS = {}
+
+
+def benchmark(name, measure='time'):
+    """Register a benchmark. The decorated function takes a scale factor and returns the callable to time.
+
+    Benchmarks measuring 'memory' instead return a callable whose return value is kept alive while the memory
+    allocated by it is measured.
+    """
+    def register(func):
+        func.measure = measure
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+@benchmark('parse_many_steps')
+def parse_many_steps(scale):
+    markdown = generators.markdown_with_steps(2000 * scale)
+    return lambda: mechanical_markdown.MechanicalMarkdown(markdown)
+
+
+@benchmark('validate_large_output')
+def validate_large_output(scale):
+    line_count = 100000 * scale
+    expected = "\n".join(f"  - {line}" for line in generators.output_lines(line_count).split("\n")[::line_count // 20])
+    step = mechanical_markdown.MechanicalMarkdown(f"""
+<!-- STEP
+name: large output
+output_match_mode: substring
+expected_stdout_lines:
+{expected}
+-->
+
+```bash
+generate_lots_of_output
+```
+
+<!-- END_STEP -->
+""").all_steps[0]
+    generators.fake_run(step.commands[0], generators.output_lines(line_count))
+    return step.validate_and_report
+
+
+@benchmark('spawn_background_commands')
+def spawn_background_commands(scale):
+    markdown = generators.markdown_with_background_steps(25 * scale)
+    return lambda: mechanical_markdown.MechanicalMarkdown(markdown, shell='sh -c').execute_steps(False)
+
+
+@benchmark('validate_many_links')
+def validate_many_links(scale):
+    from tests.fake_http_server import FakeHttpServer
+
+    server = FakeHttpServer()
+    server.start()
+    host = f'localhost:{server.get_port()}'
+    server.set_response_codes(itertools.repeat(200))
+    markdown = generators.markdown_with_links(f'http://{host}/page/{i}' for i in range(200 * scale))
+
+    def run():
+        mechanical_markdown.MechanicalMarkdown(markdown).execute_steps(False, validate_links=True)
+    run.cleanup = server.shutdown_server
+    return run
+
+
+@benchmark('memory_large_corpus', measure='memory')
+def memory_large_corpus(scale):
+    corpus = [generators.markdown_with_steps(50, env_vars=3) for _ in range(40 * scale)]
+    output = generators.output_lines(200)
+
+    def run():
+        recipes = [mechanical_markdown.MechanicalMarkdown(markdown) for markdown in corpus]
+        # Keep the results too, like a parallel run buffering the results of every recipe
+        results = []
+        for recipe in recipes:
+            for step in recipe.all_steps:
+                for command in step.commands:
+                    generators.fake_run(command, output)
+                results.append(step.validate())
+        return recipes, results
+    return run
+
+
+def memory_benchmark(func, rounds):
+    retained = []
+    peaks = []
+    for _ in range(rounds):
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            tracemalloc.start()
+            try:
+                kept = func()
+                current, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            del kept
+        retained.append(current / (1024 * 1024))
+        peaks.append(peak / (1024 * 1024))
+    # Like timings, the smallest measurement is the least disturbed one
+    return {
+        'rounds': rounds,
+        'min': min(retained),
+        'retained_mb': min(retained),
+        'peak_mb': min(peaks),
+    }
+
+
+def time_benchmark(func, rounds):
+    timings = []
+    for _ in range(rounds):
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+    return {
+        'rounds': rounds,
+        'min': min(timings),
+        'mean': statistics.mean(timings),
+        'stdev': statistics.stdev(timings) if rounds > 1 else 0.0,
+    }
+
+
+def compare(results, baseline_file):
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    print(f"\nComparison against {baseline['version']} ({baseline_file}):")
+    for name, result in results['benchmarks'].items():
+        if name not in baseline['benchmarks']:
+            continue
+        ratio = result['min'] / baseline['benchmarks'][name]['min']
+        print(f"\t{name}: {ratio:.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run mechanical-markdown benchmarks')
+    parser.add_argument('--quick', action='store_true', help='Run a single round of every benchmark')
+    parser.add_argument('--scale', type=int, default=1, help='Multiply the size of every synthetic input [Default: 1]')
+    parser.add_argument('--rounds', type=int, default=5, help='Number of timed rounds per benchmark [Default: 5]')
+    parser.add_argument('--filter', '-k', dest='name_filter', default='', help='Only run benchmarks containing NAME')
+    parser.add_argument('--output', '-o', default=None,
+                        help='Where to store results [Default: benchmarks/results/<version>.json]')
+    parser.add_argument('--compare', '-c', metavar='RESULTS_FILE', default=None,
+                        help='Print the ratio of this run against a previously stored result')
+    args = parser.parse_args()
+
+    rounds = 1 if args.quick else args.rounds
+
+    results = {
+        'version': mechanical_markdown.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'benchmarks': {},
+    }
+    for name, setup in BENCHMARKS.items():
+        if args.name_filter not in name:
+            continue
+        func = setup(args.scale)
+        try:
+            if setup.measure == 'memory':
+                result = memory_benchmark(func, rounds)
+            else:
+                result = time_benchmark(func, rounds)
+        finally:
+            if hasattr(func, 'cleanup'):
+                func.cleanup()
+        results['benchmarks'][name] = result
+        if setup.measure == 'memory':
+            print(f"{name}: retained {result['retained_mb']:.1f}MB peak {result['peak_mb']:.1f}MB")
+        else:
+            print(f"{name}: min {result['min']:.4f}s mean {result['mean']:.4f}s stdev {result['stdev']:.4f}s")
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{mechanical_markdown.__version__}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,66 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+
+Synthetic inputs for the benchmark suite.
+"""
+
+
+def markdown_with_steps(step_count, commands_per_step=2, expected_lines=3, prose_lines=5, env_vars=0):
+    """Build an annotated markdown document with step_count STEP blocks, each setting env_vars variables."""
+    chunks = ["# Synthetic tutorial\n"]
+    for i in range(step_count):
+        expected = "".join(f"  - line {j} of step {i}\n" for j in range(expected_lines))
+        env = "env:\n" + "".join(f"  VAR_{j}: value {j} of step {i}\n" for j in range(env_vars)) if env_vars else ""
+        prose = "".join(f"Some prose describing step {i}, line {j}. See [docs](https://example.com/{i}/{j}).\n"
+                        for j in range(prose_lines))
+        commands = "".join(f"```bash\necho 'line {j} of step {i}'\n```\n\n" for j in range(commands_per_step))
+        chunks.append(f"""
+## Step {i}
+
+<!-- STEP
+name: step {i}
+{env}tags:
+  - tag{i % 10}
+expected_stdout_lines:
+{expected}-->
+
+{prose}
+{commands}
+<!-- END_STEP -->
+""")
+    return "".join(chunks)
+
+
+def markdown_with_background_steps(step_count, command='true'):
+    """Build a document where every step runs a single background command."""
+    return "".join(f"""
+<!-- STEP
+name: background {i}
+background: true
+-->
+
+```bash
+{command}
+```
+
+<!-- END_STEP -->
+""" for i in range(step_count))
+
+
+def markdown_with_links(urls):
+    """Build a document with one link per url."""
+    return "".join(f"Link number {i}: [link]({url})\n\n" for i, url in enumerate(urls))
+
+
+def output_lines(line_count, width=60):
+    """Return line_count lines of synthetic command output joined with newlines."""
+    filler = "x" * width
+    return "\n".join(f"{i:08d} {filler}" for i in range(line_count))
+
+
+def fake_run(command, stdout, stderr="", return_code=0):
+    """Make a Command look like it ran and produced the given output, without spawning anything."""
+    command.process = object()
+    command.output = {'stdout': stdout, 'stderr': stderr}
+    command.return_code = return_code
@@ -1,12 +1,20 @@
-
 """
 Copyright (c) Microsoft Corporation.
 Licensed under the MIT License.
 """
 
-from mechanical_markdown.recipe import Recipe as MechanicalMarkdown
-from mechanical_markdown.parsers import MarkdownAnnotationError
-
 __version__ = '0.7.0'
 
-__all__ = [MechanicalMarkdown, MarkdownAnnotationError]
+__all__ = ['MechanicalMarkdown', 'MarkdownAnnotationError']
+
+
+def __getattr__(name):
+    # Resolve the public API lazily so that `mm.py --version` and other light entry points
+    # don't pay for importing mistune, yaml, requests and friends.
+    if name == 'MechanicalMarkdown':
+        from mechanical_markdown.recipe import Recipe
+        return Recipe
+    if name == 'MarkdownAnnotationError':
+        from mechanical_markdown.parsers import MarkdownAnnotationError
+        return MarkdownAnnotationError
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -7,7 +7,7 @@ Licensed under the MIT License.
 import mechanical_markdown
 
 import argparse
-import colorama
+import os
 import platform
 import sys
 
@@ -15,11 +15,11 @@ import sys
 def main():
     parse_args = argparse.ArgumentParser(description='Auto validate markdown documentation')
     group = parse_args.add_argument_group()
-    group.add_argument('markdown_file',
+    group.add_argument('markdown_files',
                        metavar='MARKDOWN_FILE',
-                       nargs='?',
+                       nargs='*',
                        type=argparse.FileType('r'),
-                       help="The annotated markdown file to run/execute")
+                       help="The annotated markdown file(s) to run/execute")
     group.add_argument('--dry-run', '-d',
                        dest='dry_run',
                        action='store_true',
@@ -41,6 +41,11 @@ def main():
                             default=False,
                             action='store_true',
                             help='Check for broken links to external URLs')
+    parse_args.add_argument('--validate-local-links', '-L',
+                            dest='validate_local_links',
+                            default=False,
+                            action='store_true',
+                            help='Check that relative links point to existing files and headings')
     parse_args.add_argument('--link-retries', '-r',
                             dest='link_retries',
                             default=3,
@@ -53,38 +58,351 @@ def main():
                             action="append",
                             type=str,
                             help='Tags used to filter steps')
+    parse_args.add_argument('--strict-tags',
+                            dest='strict_tags',
+                            default=False,
+                            action='store_true',
+                            help='With --tags, only run the steps matching them, not the steps without tags')
+    parse_args.add_argument('--step',
+                            dest='steps',
+                            default=[],
+                            action='append',
+                            metavar='NAME',
+                            help='Only run the step called NAME, and the steps it depends on')
+    parse_args.add_argument('--from',
+                            dest='from_step',
+                            metavar='NAME',
+                            help='Only run the steps from the one called NAME, and the steps they depend on')
+    parse_args.add_argument('--until',
+                            dest='until_step',
+                            metavar='NAME',
+                            help='Only run the steps up to the one called NAME, and the steps they depend on')
+    parse_args.add_argument('--trace',
+                            dest='trace_file',
+                            default=None,
+                            metavar='FILE',
+                            help='Write a Chrome trace/Perfetto compatible timeline of the run to FILE')
+    parse_args.add_argument('--live',
+                            dest='live',
+                            default=False,
+                            action='store_true',
+                            help='Print the output of commands as it arrives, prefixed with a timestamp and step name')
+    parse_args.add_argument('--report-json',
+                            dest='json_report',
+                            default=None,
+                            metavar='FILE',
+                            type=argparse.FileType('w'),
+                            help='Write the results as JSON Lines to FILE while the steps run')
+    parse_args.add_argument('--junit-xml',
+                            dest='junit_report',
+                            default=None,
+                            metavar='FILE',
+                            type=argparse.FileType('w'),
+                            help='Write the results as JUnit XML to FILE while the steps run')
+    parse_args.add_argument('--record',
+                            dest='record_dir',
+                            default=None,
+                            metavar='DIR',
+                            help='Save the output, return code and timing of every command to a cassette in DIR')
+    parse_args.add_argument('--replay',
+                            dest='replay_dir',
+                            default=None,
+                            metavar='DIR',
+                            help='Validate the steps against the cassettes recorded in DIR instead of running them')
+    parse_args.add_argument('--update-golden',
+                            dest='update_golden',
+                            default=False,
+                            action='store_true',
+                            help='Overwrite the expected_stdout_file/expected_stderr_file of steps with their actual '
+                                 'output')
+    parse_args.add_argument('--fixtures',
+                            dest='fixture_files',
+                            default=[],
+                            action='append',
+                            metavar='FILE',
+                            type=argparse.FileType('r'),
+                            help='A markdown file declaring fixtures shared by the markdown files being run')
+    parse_args.add_argument('--lint',
+                            dest='lint_paths',
+                            default=None,
+                            nargs='+',
+                            metavar='PATH',
+                            help='Check the annotations of markdown files, or directories of them, without running '
+                                 'anything')
+    parse_args.add_argument('--lint-format',
+                            dest='lint_format',
+                            default='text',
+                            choices=('text', 'json'),
+                            help='Print lint diagnostics as FILE:LINE: SEVERITY: MESSAGE text or as JSON Lines '
+                                 '[Default: text]')
+    parse_args.add_argument('--jobs', '-j',
+                            dest='jobs',
+                            default=None,
+                            type=int,
+                            help='Number of markdown files to run, or lint, in parallel [Default: 1 when running, '
+                                 'number of CPUs when linting]')
+    parse_args.add_argument('--isolate',
+                            dest='isolate',
+                            default=False,
+                            action='store_true',
+                            help='Run the steps of every markdown file in a private copy of the working directory')
+    parse_args.add_argument('--capacity',
+                            dest='capacities',
+                            default=[],
+                            action='append',
+                            metavar='NAME=AMOUNT',
+                            help='How much of a resource the steps of files run in parallel may use together, '
+                                 'e.g. cpus=4 or docker=2 [Default: the number of CPUs and megabytes of memory for '
+                                 'cpus and memory_mb, 1 for anything else]')
+    parse_args.add_argument('--deadline',
+                            dest='deadline',
+                            default=None,
+                            type=float,
+                            metavar='SECONDS',
+                            help='Wall-clock budget for the whole run. Commands are stopped when it runs out, '
+                                 'and steps that have not started are reported as skipped')
+    parse_args.add_argument('--plugin',
+                            dest='plugins',
+                            default=[],
+                            action='append',
+                            metavar='MODULE:CLASS',
+                            help='Load a plugin observing the run, in addition to those registered by installed '
+                                 'packages')
+    parse_args.add_argument('--metrics-file',
+                            dest='metrics_file',
+                            default=None,
+                            metavar='PATH',
+                            help='Write metrics about the run to PATH in the Prometheus text format, e.g. for a '
+                                 'node_exporter textfile collector')
+    parse_args.add_argument('--metrics-interval',
+                            dest='metrics_interval',
+                            default=None,
+                            metavar='SECONDS',
+                            type=float,
+                            help='Also update the --metrics-file every SECONDS while the steps run')
+    parse_args.add_argument('--serve',
+                            dest='serve_socket',
+                            default=None,
+                            metavar='SOCKET',
+                            help='Stay resident and run, lint and check the links of markdown files for clients '
+                                 'connecting to the Unix socket SOCKET')
+    parse_args.add_argument('--daemon',
+                            dest='daemon_socket',
+                            default=None,
+                            metavar='SOCKET',
+                            help='Have the daemon listening on SOCKET, started with --serve, do the work')
     args = parse_args.parse_args()
 
+    deadline = None
+    if args.deadline is not None:
+        if args.manual:
+            parse_args.error('--deadline can not be used with --manual, pauses wait for as long as it takes')
+        # Counted from here, parsing the markdown is part of the run
+        from mechanical_markdown.deadline import Deadline
+        deadline = Deadline(args.deadline)
+
     if args.print_version:
         parse_args.exit(status=0, message='{} version:\nv{}'.format(parse_args.prog, mechanical_markdown.__version__))
 
-    if args.markdown_file is None:
-        parse_args.error('You must provide exactly one markdown file to operate on.\n\
-                         Try "{} -h" for more info'.format(parse_args.prog))
+    capacities = {}
+    if len(args.capacities):
+        from mechanical_markdown.capacity import parse_capacity
+        try:
+            capacities = dict(parse_capacity(text) for text in args.capacities)
+        except ValueError as e:
+            parse_args.error(str(e))
+
+    if args.serve_socket is not None:
+        from mechanical_markdown.daemon import Daemon
+
+        hooks = load_plugins(parse_args, args)
+        print(f"Listening on {args.serve_socket}", file=sys.stderr)
+        try:
+            Daemon(args.serve_socket).serve_forever()
+        except KeyboardInterrupt:
+            pass
+        hooks.close()
+        sys.exit(0)
 
-    body = args.markdown_file.read()
+    if args.daemon_socket is not None and args.lint_paths is not None:
+        sys.exit(send_to_daemon(parse_args, args, 'lint', paths=args.lint_paths, format=args.lint_format,
+                                jobs=args.jobs))
+
+    if args.lint_paths is not None:
+        from mechanical_markdown.lint import lint_paths, print_diagnostics, ERROR
+
+        files, diagnostics = lint_paths(args.lint_paths, jobs=args.jobs)
+        print_diagnostics(diagnostics, sys.stdout, args.lint_format)
+        errors = sum(1 for d in diagnostics if d.severity == ERROR)
+        print(f"{len(files)} files checked: {errors} errors, {len(diagnostics) - errors} warnings", file=sys.stderr)
+        sys.exit(1 if errors else 0)
+
+    if args.record_dir is not None and args.replay_dir is not None:
+        parse_args.error('--record and --replay can not be used together')
+
+    if len(args.markdown_files) == 0:
+        parse_args.error('You must provide at least one markdown file to operate on.\n\
+                         Try "{} -h" for more info'.format(parse_args.prog))
 
     # Enable color terminal support on Windows
     # The colorama.init() call is supposed to be a no-op on Linux, but calling it breaks color output on github actions
     if platform.system() == 'Windows':
+        import colorama
         colorama.init()
 
-    r = mechanical_markdown.MechanicalMarkdown(body, shell=args.shell_cmd)
+    if args.trace_file is not None:
+        from mechanical_markdown.trace import tracer
+        tracer.enable()
+
+    if args.daemon_socket is not None and not args.dry_run:
+        if args.manual or args.live or args.trace_file is not None:
+            parse_args.error('--daemon can not be used with --manual, --live or --trace')
+        sys.exit(send_to_daemon(parse_args, args, 'run',
+                                files=read_markdown_files(args.markdown_files),
+                                fixtures=read_markdown_files(args.fixture_files),
+                                shell=args.shell_cmd,
+                                validate_links=args.validate_links,
+                                validate_local_links=args.validate_local_links,
+                                link_retries=args.link_retries,
+                                tags=args.tags,
+                                strict_tags=args.strict_tags,
+                                steps=args.steps,
+                                from_step=args.from_step,
+                                until_step=args.until_step,
+                                json_report=args.json_report is not None,
+                                junit_report=args.junit_report is not None,
+                                record_dir=args.record_dir,
+                                replay_dir=args.replay_dir,
+                                update_golden=args.update_golden,
+                                isolate=args.isolate,
+                                deadline=args.deadline,
+                                capacities=capacities,
+                                jobs=args.jobs))
+
+    # Every step of the run shares one snapshot of the environment
+    env = dict(os.environ)
+    recipes = []
+    for markdown_file in args.markdown_files:
+        recipes.append(mechanical_markdown.MechanicalMarkdown(markdown_file.read(), shell=args.shell_cmd,
+                                                              filename=markdown_file.name, env=env))
     success = True
 
+    from mechanical_markdown.selection import StepSelection, SelectionError
+    try:
+        selection = StepSelection(args.tags, args.steps, args.from_step, args.until_step, args.strict_tags)
+        selection.check(recipes)
+    except SelectionError as e:
+        parse_args.error(str(e))
+
     if args.dry_run:
         print("Would run the following validation steps:")
-        print(r.dryrun())
-        sys.exit(0)
+        for r in recipes:
+            if len(recipes) > 1:
+                print(f"File: {r.filename}")
+            print(r.dryrun(selection))
+    else:
+        from mechanical_markdown.cassette import CassetteError
+        from mechanical_markdown.report import TerminalWriter, JSONLinesWriter, JUnitXMLWriter
+
+        hooks = load_plugins(parse_args, args)
 
-    success, report = r.execute_steps(args.manual,
+        writers = [TerminalWriter(sys.stdout)]
+        if args.json_report is not None:
+            writers.append(JSONLinesWriter(args.json_report))
+        if args.junit_report is not None:
+            writers.append(JUnitXMLWriter(args.junit_report, suite_name=args.markdown_files[0].name))
+        live = None
+        if args.live:
+            from mechanical_markdown.live import LivePrinter
+            live = LivePrinter(sys.stdout)
+        from mechanical_markdown.capacity import Capacity
+        try:
+            if len(recipes) == 1 and len(args.fixture_files) == 0:
+                success = recipes[0].run(args.manual,
+                                         writers,
+                                         validate_links=args.validate_links,
+                                         link_retries=args.link_retries,
+                                         selection=selection,
+                                         live=live,
+                                         validate_local_links=args.validate_local_links,
+                                         record_dir=args.record_dir,
+                                         replay_dir=args.replay_dir,
+                                         update_golden=args.update_golden,
+                                         isolate=args.isolate,
+                                         deadline=deadline,
+                                         capacity=Capacity(capacities))
+            else:
+                # Links shared between files are only checked once, fixtures are only started once
+                from mechanical_markdown.recipe import run_recipes
+                shared_fixtures = [mechanical_markdown.MechanicalMarkdown(f.read(), shell=args.shell_cmd,
+                                                                          filename=f.name, env=env)
+                                   for f in args.fixture_files]
+                success = run_recipes(recipes,
+                                      args.manual,
+                                      writers,
                                       validate_links=args.validate_links,
                                       link_retries=args.link_retries,
-                                      tags=args.tags)
-    print(report)
+                                      selection=selection,
+                                      live=live,
+                                      validate_local_links=args.validate_local_links,
+                                      record_dir=args.record_dir,
+                                      replay_dir=args.replay_dir,
+                                      update_golden=args.update_golden,
+                                      isolate=args.isolate,
+                                      jobs=args.jobs or 1,
+                                      shared_fixtures=shared_fixtures,
+                                      deadline=deadline,
+                                      capacity=Capacity(capacities))
+        except CassetteError as e:
+            parse_args.exit(status=1, message=f"{e}\n")
+        hooks.close()
+        if live is not None:
+            live.close()
+        for report_file in args.json_report, args.junit_report:
+            if report_file is not None:
+                report_file.close()
+
+    if args.trace_file is not None:
+        tracer.write(args.trace_file)
+
     if not success:
         sys.exit(1)
 
 
+def load_plugins(parse_args, args):
+    from mechanical_markdown.hooks import hooks, entry_point_plugins, load_plugin
+
+    try:
+        plugins = entry_point_plugins() + [load_plugin(spec) for spec in args.plugins]
+    except (ImportError, AttributeError, ValueError) as e:
+        parse_args.error(f'Unable to load plugin: {e}')
+    if args.metrics_file is not None:
+        from mechanical_markdown.metrics import PrometheusExporter
+        plugins.append(PrometheusExporter(args.metrics_file, args.metrics_interval))
+    for plugin in plugins:
+        hooks.add(plugin)
+    return hooks
+
+
+def read_markdown_files(files):
+    return [{'name': f.name, 'markdown': f.read()} for f in files]
+
+
+def send_to_daemon(parse_args, args, command, **options):
+    # Only what's needed to talk to the daemon is imported, it has everything else loaded already
+    from mechanical_markdown.daemon import client_request, send_request
+
+    streams = {'stdout': sys.stdout, 'stderr': sys.stderr,
+               'json_report': args.json_report, 'junit_report': args.junit_report}
+    try:
+        status = send_request(args.daemon_socket, client_request(command, **options), streams)
+    except (FileNotFoundError, ConnectionRefusedError):
+        parse_args.error(f'No daemon is listening on {args.daemon_socket}, start one with --serve')
+    for report_file in args.json_report, args.junit_report:
+        if report_file is not None:
+            report_file.close()
+    return status
+
+
 if __name__ == "__main__":
     main()
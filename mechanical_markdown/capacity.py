@@ -0,0 +1,119 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+"""
+
+import os
+
+from threading import Condition
+
+# Resources nobody declared a capacity for can only be used by one step at a time, like a lock
+default_capacity = 1
+
+
+def machine_capacities():
+    """The cpus and memory_mb of this machine, as far as they can be found out."""
+    capacities = {'cpus': os.cpu_count() or 1}
+    try:
+        capacities['memory_mb'] = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+    except (AttributeError, ValueError, OSError):
+        # Not on this platform, don't limit memory at all
+        capacities['memory_mb'] = float('inf')
+    return capacities
+
+
+def parse_capacity(text):
+    """Parse a NAME=AMOUNT capacity, raising a ValueError if it isn't one."""
+    name, _, amount = text.partition('=')
+    if name == '' or amount == '':
+        raise ValueError(f"Capacity '{text}' should look like NAME=AMOUNT")
+    amount = float(amount)
+    if amount < 0:
+        raise ValueError(f"Capacity '{text}' can't be negative")
+    return name, amount
+
+
+class Capacity:
+    """How much of every resource the steps running at the same time may use together.
+
+    A step declaring `resources: {cpus: 2, docker: 1}` only starts once two cpus and a docker token are free,
+    and holds them until its commands have finished. cpus and memory_mb default to the size of the machine,
+    any other resource to a capacity of 1, so steps using it never run at the same time. A step asking for
+    more than the capacity gets all of it. This holds for the steps of one owner, a recipe, too. An owner may
+    wait while it holds resources, as long as what it holds is released once its commands finish, whether or
+    not the owner is waiting. It must not wait for what it holds itself, fits_beside() tells whether waiting
+    can help at all.
+    """
+
+    def __init__(self, capacities=None):
+        self.capacities = machine_capacities()
+        self.capacities.update(capacities or {})
+        # owner -> {resource: amount}
+        self.held = {}
+        self._condition = Condition()
+
+    def capacity(self, name):
+        return self.capacities.get(name, default_capacity)
+
+    def _fits(self, costs, owners=None):
+        for name, amount in costs.items():
+            used = sum(held.get(name, 0) for owner, held in self.held.items() if owners is None or owner in owners)
+            if used + min(amount, self.capacity(name)) > self.capacity(name):
+                return False
+        return True
+
+    def _take(self, owner, costs):
+        held = self.held.setdefault(owner, {})
+        for name, amount in costs.items():
+            held[name] = held.get(name, 0) + min(amount, self.capacity(name))
+
+    def fits(self, costs):
+        """True if costs are free right now."""
+        with self._condition:
+            return self._fits(costs)
+
+    def fits_beside(self, owners, costs):
+        """True if costs fit once everyone but owners has released what they hold."""
+        with self._condition:
+            return self._fits(costs, owners)
+
+    def try_acquire(self, owner, costs):
+        """Take costs for owner if they are free right now, without waiting. Returns True if they were."""
+        with self._condition:
+            if not self._fits(costs):
+                return False
+            self._take(owner, costs)
+        return True
+
+    def acquire(self, owner, costs, deadline=None):
+        """Wait until costs fit, and take them for owner. Returns False if deadline was reached first."""
+        if len(costs) == 0:
+            return True
+        with self._condition:
+            while not self._fits(costs):
+                if deadline is None:
+                    self._condition.wait()
+                elif deadline.reached():
+                    return False
+                else:
+                    self._condition.wait(deadline.remaining())
+            self._take(owner, costs)
+        return True
+
+    def release(self, owner, costs):
+        if len(costs) == 0:
+            return
+        with self._condition:
+            held = self.held.get(owner, {})
+            for name, amount in costs.items():
+                held[name] = held.get(name, 0) - min(amount, self.capacity(name))
+                if held[name] <= 0:
+                    del held[name]
+            if len(held) == 0:
+                self.held.pop(owner, None)
+            self._condition.notify_all()
+
+    def release_all(self, owner):
+        with self._condition:
+            self.held.pop(owner, None)
+            self._condition.notify_all()
@@ -0,0 +1,82 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+"""
+
+import json
+import os
+
+cassette_version = 1
+
+
+class CassetteError(Exception):
+    pass
+
+
+class Cassette:
+    """The recorded output, return code and timing of every command of a recipe.
+
+    A cassette is a compact JSON file per markdown file. Steps are looked up by their name and commands, so
+    changing the expectations of a step keeps its recording usable, but changing its commands doesn't.
+    Commands are compared before placeholders such as ${PORT:app} were substituted.
+    """
+
+    def __init__(self, path, steps=None):
+        self.path = path
+        self.steps = steps if steps is not None else []
+        self._replayed = set()
+
+    @classmethod
+    def path_for(cls, directory, filename):
+        name = os.path.normpath(os.path.relpath(filename)).replace(os.sep, '--') if filename else 'recipe.md'
+        return os.path.join(directory, name + '.json')
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path) as f:
+                cassette = json.load(f)
+        except FileNotFoundError:
+            raise CassetteError(f"No cassette found at {path}, record one with --record first")
+        if cassette.get('version') != cassette_version:
+            raise CassetteError(f"Unsupported cassette version {cassette.get('version')} in {path}")
+        return cls(path, cassette['steps'])
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump({'version': cassette_version, 'steps': self.steps}, f, separators=(',', ':'))
+
+    def record(self, step):
+        started = [c for c in step.commands if c.started]
+        if len(started) == 0:
+            return
+        step_start = min(c.start_monotonic for c in started)
+        self.steps.append({
+            'name': step.name,
+            'commands': [{
+                'command': c.template,
+                'return_code': c.return_code,
+                'duration_seconds': round(c.duration_seconds, 6),
+                'start_seconds': round(c.start_monotonic - step_start, 6),
+                'stdout': c.output['stdout'],
+                'stderr': c.output['stderr'],
+                'line_times': {out: [round(t - c.start_monotonic, 6) for t in c.line_times[out]]
+                               for out in ('stdout', 'stderr')},
+                'resource_usage': c.resource_usage,
+                'attempts': c.attempts,
+            } for c in started],
+        })
+
+    def recording_for(self, step):
+        """The recorded commands of step, in the order they ran."""
+        commands = [c.template for c in step.commands]
+        for idx, recorded in enumerate(self.steps):
+            if idx in self._replayed or recorded['name'] != step.name:
+                continue
+            recorded_commands = [c['command'] for c in recorded['commands']]
+            if recorded_commands == commands[:len(recorded_commands)]:
+                self._replayed.add(idx)
+                return recorded['commands']
+        raise CassetteError(f"Step '{step.name}' has no recording in {self.path} matching its commands, "
+                            "record it again with --record")
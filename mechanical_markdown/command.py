@@ -5,32 +5,148 @@ Licensed under the MIT License.
 """
 
 import os
+import subprocess
+import sys
 import time
 
-from subprocess import Popen, PIPE, TimeoutExpired
+from array import array
+from subprocess import PIPE, TimeoutExpired
 from threading import Thread
 
+from mechanical_markdown.hooks import hooks
+from mechanical_markdown.trace import tracer
+
+
+class Popen(subprocess.Popen):
+    """A Popen that keeps the resource usage of the child process, from os.wait4(), when communicate() reaps it.
+
+    communicate() reads stdout and stderr line by line, calling line_callback(stream_name, line) for every
+    line as it arrives, and otherwise behaves like the standard library version. The time.monotonic()
+    timestamp at which each line was read is kept in line_times.
+    """
+    rusage = None
+    line_callback = None
+    line_times = None
+    _line_readers = None
+
+    def communicate(self, input=None, timeout=None):
+        if input is not None or self.stdout is None or self.stderr is None:
+            return super().communicate(input, timeout)
+
+        if self._line_readers is None:
+            self._captured = {'stdout': [], 'stderr': []}
+            self.line_times = {'stdout': [], 'stderr': []}
+            self._line_readers = [Thread(target=self._read_lines, args=(name, pipe), daemon=True)
+                                  for name, pipe in (('stdout', self.stdout), ('stderr', self.stderr))]
+            for reader in self._line_readers:
+                reader.start()
+
+        endtime = None if timeout is None else time.monotonic() + timeout
+        for reader in self._line_readers:
+            reader.join(None if endtime is None else max(0, endtime - time.monotonic()))
+            if reader.is_alive():
+                raise TimeoutExpired(self.args, timeout)
+        self._reap(None if endtime is None else max(0, endtime - time.monotonic()))
+
+        stdout, stderr = "".join(self._captured['stdout']), "".join(self._captured['stderr'])
+        # Don't keep every line around a second time, nor a float object for every timestamp
+        self._captured = {'stdout': [stdout], 'stderr': [stderr]}
+        self.line_times = {name: array('d', times) for name, times in self.line_times.items()}
+        return stdout, stderr
+
+    def _read_lines(self, name, pipe):
+        for line in iter(pipe.readline, ''):
+            self.line_times[name].append(time.monotonic())
+            self._captured[name].append(line)
+            if self.line_callback is not None:
+                self.line_callback(name, line)
+        pipe.close()
+
+    def _reap(self, timeout):
+        """wait() for the process, keeping its resource usage, where os.wait4() is available."""
+        if not hasattr(os, 'wait4') or self.returncode is not None:
+            return self.wait(timeout)
+        endtime = None if timeout is None else time.monotonic() + timeout
+        delay = 0.0005
+        try:
+            while True:
+                pid, status, rusage = os.wait4(self.pid, 0 if endtime is None else os.WNOHANG)
+                if pid == self.pid:
+                    break
+                remaining = endtime - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutExpired(self.args, timeout)
+                # Poll like Popen.wait() does with a timeout
+                delay = min(delay * 2, remaining, .05)
+                time.sleep(delay)
+        except ChildProcessError:
+            # Reaped already, or SIGCHLD is ignored, Popen knows how to deal with that
+            return self.wait(None if endtime is None else max(0, endtime - time.monotonic()))
+        self.rusage = rusage
+        self.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        return self.returncode
+
+
+# How long a command that timed out is given to exit after SIGTERM, before it is killed
+terminate_grace_seconds = 10
+
+
+def resource_usage_from_rusage(rusage):
+    # ru_maxrss is reported in kilobytes on Linux but in bytes on macOS
+    rss_unit = 1 if sys.platform == 'darwin' else 1024
+    return {
+        'user_cpu_seconds': rusage.ru_utime,
+        'system_cpu_seconds': rusage.ru_stime,
+        'max_rss_mb': rusage.ru_maxrss * rss_unit / (1024 * 1024),
+        'block_input_ops': rusage.ru_inblock,
+        'block_output_ops': rusage.ru_oublock,
+        'voluntary_context_switches': rusage.ru_nvcsw,
+        'involuntary_context_switches': rusage.ru_nivcsw,
+    }
+
 
 class Command(Thread):
     def __init__(self, command_string, cwd, env, shell, timeout):
         super().__init__()
         self.command = command_string
+        # The command as written in the markdown, before placeholders were substituted
+        self.template = command_string
         self.process = None
         self.return_code = -1
         self.output = {'stdout': '', 'stderr': ''}
         self.env = env
         self.shell = shell
         self.timeout = timeout
+        # The Deadline of the run, if any, which the grace period after a timeout doesn't run past either
+        self.deadline = None
         self.cwd = cwd
         self.start_time = 0
+        self.start_monotonic = 0.0
+        # time.monotonic() timestamp of every captured output line, when available
+        self.line_times = {'stdout': [], 'stderr': []}
         self.duration_seconds = 0.0
+        self.resource_usage = None
+        # Called with (stream_name, line) for every line of output while the command runs
+        self.line_callback = None
+        self.replayed = False
+        # The outcome of every earlier attempt, if the command was retried
+        self.attempts = []
+
+    @property
+    def started(self):
+        return self.process is not None or self.replayed
 
     def _wait_or_timeout(self):
         try:
             self.output['stdout'], self.output['stderr'] = self.process.communicate(timeout=self.timeout)
         except TimeoutExpired:
             self.process.terminate()
-            time.sleep(10)
+            # Give it a chance to exit cleanly, but don't hold up the run past its deadline
+            grace = terminate_grace_seconds if self.deadline is None else self.deadline.limit(terminate_grace_seconds)
+            try:
+                self.process.wait(grace)
+            except TimeoutExpired:
+                pass
             self.process.kill()
             try:
                 self.output['stdout'], self.output['stderr'] = self.process.communicate(timeout=self.timeout)
@@ -39,18 +155,67 @@ class Command(Thread):
 
         self.return_code = self.process.returncode
         self.duration_seconds = time.time() - self.start_time
+        line_times = getattr(self.process, 'line_times', None)
+        if isinstance(line_times, dict):
+            self.line_times = line_times
+        rusage = getattr(self.process, 'rusage', None)
+        if isinstance(rusage, tuple):
+            self.resource_usage = resource_usage_from_rusage(rusage)
 
     def run(self):
-        args_list = self.shell.split()
-        args_list.append(self.command)
-        pwd = os.getcwd()
-        os.chdir(self.cwd)
-        print("Running shell '{}' with command: `{}`".format(self.shell, self.command))
-        self.start_time = time.time()
-        self.process = Popen(args_list, universal_newlines=True, stdout=PIPE, stderr=PIPE, env=self.env)
-        os.chdir(pwd)
-
-        self._wait_or_timeout()
+        with tracer.span(self.command, 'command', shell=self.shell, cwd=self.cwd) as trace_args:
+            args_list = self.shell.split()
+            args_list.append(self.command)
+            print("Running shell '{}' with command: `{}`".format(self.shell, self.command))
+            self.start_time = time.time()
+            self.start_monotonic = time.monotonic()
+            with tracer.span('spawn', 'command'):
+                self.process = Popen(args_list, universal_newlines=True, stdout=PIPE, stderr=PIPE, env=self.env,
+                                     cwd=self.cwd)
+                self.process.line_callback = self.hook_line if hooks.lines_enabled else self.line_callback
+
+            hooks.emit('command_started', self.command, self.cwd, self.process.pid)
+            self._wait_or_timeout()
+            hooks.emit('command_finished', self.command, self.return_code, self.duration_seconds,
+                       self.resource_usage, dict(self.output))
+            trace_args['return_code'] = self.return_code
+            if self.resource_usage is not None:
+                trace_args.update(self.resource_usage)
+
+    def attempt(self):
+        """The outcome of this run of the command, to be kept when it is retried."""
+        return {
+            'return_code': self.return_code,
+            'duration_seconds': self.duration_seconds,
+            'stdout': self.output['stdout'],
+            'stderr': self.output['stderr'],
+        }
+
+    def retry(self):
+        """A new Command, ready to be started, to run this one again. Threads can only be started once."""
+        command = Command(self.command, self.cwd, self.env, self.shell, self.timeout)
+        command.template = self.template
+        command.deadline = self.deadline
+        command.line_callback = self.line_callback
+        command.attempts = self.attempts + [self.attempt()]
+        return command
+
+    def hook_line(self, stream, line):
+        hooks.emit('output_line', self.command, stream, line, time.time())
+        if self.line_callback is not None:
+            self.line_callback(stream, line)
+
+    def replay(self, recording, step_start):
+        """Take the results of a recorded run instead of running the command."""
+        self.replayed = True
+        self.return_code = recording['return_code']
+        self.duration_seconds = recording['duration_seconds']
+        self.start_monotonic = step_start + recording['start_seconds']
+        self.output = {out: recording[out] for out in ('stdout', 'stderr')}
+        self.line_times = {out: [self.start_monotonic + t for t in recording['line_times'][out]]
+                           for out in ('stdout', 'stderr')}
+        self.resource_usage = recording['resource_usage']
+        self.attempts = recording.get('attempts', [])
 
     def wait(self):
         try:
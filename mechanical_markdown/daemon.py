@@ -0,0 +1,282 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+"""
+
+import json
+import os
+import socket
+import socketserver
+import time
+import traceback
+
+from contextlib import redirect_stdout
+from threading import Lock, Thread
+
+# Link results are reused by later requests for this long, links that failed are always checked again
+link_cache_seconds = 300
+
+
+class Channel:
+    """The connection to a client, every message is sent as one line of JSON.
+
+    A client that went away stops receiving messages, but the request it sent still runs to completion so
+    background commands, fixtures and placeholders are cleaned up.
+    """
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.connected = True
+        self._lock = Lock()
+
+    def send(self, message):
+        data = (json.dumps(message) + "\n").encode('utf-8')
+        with self._lock:
+            if not self.connected:
+                return
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except OSError:
+                self.connected = False
+
+    def stream(self, name):
+        return ChannelStream(self, name)
+
+
+class ChannelStream:
+    """A text stream forwarding everything written to it to the stream called name on the client."""
+
+    def __init__(self, channel, name):
+        self.channel = channel
+        self.name = name
+
+    def write(self, text):
+        if text:
+            self.channel.send({'stream': self.name, 'data': text})
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.server.mm_daemon.handle(self.rfile, self.wfile)
+
+
+class Daemon:
+    """Runs, lints and checks the links of markdown files for clients connecting to a Unix socket.
+
+    Python itself, mistune, yaml and requests are only loaded once. Lint diagnostics are kept until the file
+    changes, link results for link_cache_seconds, and links are requested through one requests.Session so
+    connections to hosts seen before stay open. Recipes are parsed for every request, since they resolve
+    their working directories when they are parsed.
+
+    Requests are handled one at a time. Their steps run in the working directory and environment of the client
+    that sent them, which are handed to the recipes rather than changed for the whole process, and relative
+    paths are resolved against that directory. A request is a line of JSON with a 'command' of 'run', 'lint' or
+    'shutdown', see client_request(). The daemon answers with lines of JSON: {"stream": name, "data": text} for output,
+    followed by {"exit": status}.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # absolute path -> ((st_mtime_ns, st_size), [(line, severity, message), ...])
+        self.lint_cache = {}
+        # link retries -> LinkChecker
+        self.link_checkers = {}
+        self.link_checkers_created = time.monotonic()
+        self.session = None
+        self.server = None
+        self.handlers = {'run': self.run, 'lint': self.lint}
+
+    def serve_forever(self):
+        if not hasattr(socket, 'AF_UNIX'):
+            raise OSError("Unix sockets aren't supported on this platform")
+        # Pay for the expensive imports once, before the first request comes in
+        import requests
+        import mechanical_markdown.lint  # noqa: F401
+        import mechanical_markdown.recipe  # noqa: F401
+
+        self.session = requests.Session()
+        self.remove_stale_socket()
+        # Only the user running the daemon may have it run commands, from the moment the socket exists
+        umask = os.umask(0o077)
+        try:
+            self.server = socketserver.UnixStreamServer(self.path, RequestHandler)
+        finally:
+            os.umask(umask)
+        os.chmod(self.path, 0o600)
+        self.server.mm_daemon = self
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            self.session.close()
+            os.unlink(self.path)
+
+    def remove_stale_socket(self):
+        if not os.path.exists(self.path):
+            return
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            try:
+                s.connect(self.path)
+            except ConnectionRefusedError:
+                # Left behind by a daemon that didn't exit cleanly
+                os.unlink(self.path)
+                return
+        raise OSError(f"A daemon is already listening on {self.path}")
+
+    def handle(self, rfile, wfile):
+        channel = Channel(wfile)
+        status = 1
+        try:
+            request = json.loads(rfile.readline())
+            command = request.get('command')
+            if command == 'shutdown':
+                # shutdown() waits for serve_forever() to return, which is waiting for this request
+                Thread(target=self.server.shutdown).start()
+                status = 0
+            elif command in self.handlers:
+                with redirect_stdout(channel.stream('stdout')):
+                    status = self.handlers[command](request, channel)
+            else:
+                channel.stream('stderr').write(f"Unknown command: {command}\n")
+        except Exception:
+            channel.stream('stderr').write(traceback.format_exc())
+        channel.send({'exit': status})
+
+    def link_checker(self, retries):
+        if time.monotonic() - self.link_checkers_created > link_cache_seconds:
+            self.link_checkers = {}
+            self.link_checkers_created = time.monotonic()
+        if retries not in self.link_checkers:
+            from mechanical_markdown.links import LinkChecker
+            self.link_checkers[retries] = LinkChecker(retries, session=self.session)
+        return self.link_checkers[retries]
+
+    def parse(self, request, key='files'):
+        from mechanical_markdown.recipe import Recipe
+
+        shell = request.get('shell', 'bash -c')
+        return [Recipe(f['markdown'], shell=shell, filename=f['name'], cwd=request['cwd'], env=request['env'])
+                for f in request.get(key, [])]
+
+    def run(self, request, channel):
+        from mechanical_markdown.capacity import Capacity
+        from mechanical_markdown.cassette import CassetteError
+        from mechanical_markdown.deadline import Deadline
+        from mechanical_markdown.recipe import run_recipes
+        from mechanical_markdown.report import TerminalWriter, JSONLinesWriter, JUnitXMLWriter
+        from mechanical_markdown.selection import SelectionError, StepSelection
+
+        deadline = Deadline(request['deadline']) if request.get('deadline') is not None else None
+
+        recipes = self.parse(request)
+        shared_fixtures = self.parse(request, 'fixtures')
+        writers = [TerminalWriter(channel.stream('stdout'))]
+        if request.get('json_report'):
+            writers.append(JSONLinesWriter(channel.stream('json_report')))
+        if request.get('junit_report'):
+            writers.append(JUnitXMLWriter(channel.stream('junit_report'), suite_name=recipes[0].filename))
+        link_retries = request.get('link_retries', 3)
+        link_checker = self.link_checker(link_retries)
+        options = {key: request[key] for key in ('validate_links', 'validate_local_links', 'update_golden',
+                                                 'isolate') if key in request}
+        for key in 'record_dir', 'replay_dir':
+            if request.get(key) is not None:
+                options[key] = os.path.join(request['cwd'], request[key])
+        try:
+            options['deadline'] = deadline
+            options['capacity'] = Capacity(request.get('capacities'))
+            options['selection'] = StepSelection(request.get('tags', []), request.get('steps', []),
+                                                 request.get('from_step'), request.get('until_step'),
+                                                 request.get('strict_tags', False))
+            if len(recipes) == 1 and len(shared_fixtures) == 0:
+                success = recipes[0].run(False, writers, link_retries=link_retries, link_checker=link_checker,
+                                         **options)
+            else:
+                success = run_recipes(recipes, False, writers, link_retries=link_retries, jobs=request.get('jobs') or 1,
+                                      shared_fixtures=shared_fixtures, link_checker=link_checker, **options)
+        except (CassetteError, SelectionError) as e:
+            channel.stream('stderr').write(f"{e}\n")
+            return 1
+        finally:
+            link_checker.forget_failed()
+        return 0 if success else 1
+
+    def lint(self, request, channel):
+        from mechanical_markdown.hooks import hooks
+        from mechanical_markdown.lint import Diagnostic, ERROR, find_markdown_files, lint_paths, print_diagnostics
+
+        # Files are found relative to the client, and named the way it named them
+        names = {}
+        for given in request['paths']:
+            for path in find_markdown_files([os.path.join(request['cwd'], given)]):
+                names[path] = path if os.path.isabs(given) else os.path.relpath(path, request['cwd'])
+        files = list(names)
+        signatures = {}
+        for path in files:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            signatures[path] = (st.st_mtime_ns, st.st_size)
+
+        def cached(path):
+            entry = self.lint_cache.get(path)
+            hit = entry is not None and entry[0] == signatures.get(path)
+            hooks.emit('cache_lookup', 'lint', hit)
+            return hit
+
+        changed = [path for path in files if not cached(path)]
+        if len(changed) > 0:
+            _, diagnostics = lint_paths(changed, jobs=request.get('jobs'))
+            by_file = {path: [] for path in changed}
+            for d in diagnostics:
+                by_file[d.filename].append((d.line, d.severity, d.message))
+            for path in changed:
+                if path in signatures:
+                    self.lint_cache[path] = (signatures[path], by_file[path])
+                else:
+                    self.lint_cache.pop(path, None)
+        else:
+            by_file = {}
+
+        diagnostics = []
+        for path in files:
+            entry = by_file[path] if path in by_file else self.lint_cache[path][1]
+            diagnostics.extend(Diagnostic(names[path], line, severity, message) for line, severity, message in entry)
+        print_diagnostics(diagnostics, channel.stream('stdout'), request.get('format', 'text'))
+        errors = sum(1 for d in diagnostics if d.severity == ERROR)
+        channel.stream('stderr').write(f"{len(files)} files checked: {errors} errors, "
+                                       f"{len(diagnostics) - errors} warnings\n")
+        return 1 if errors else 0
+
+
+def client_request(command, **options):
+    """A request for the daemon, to be run in the working directory and environment of this process."""
+    return dict(options, command=command, cwd=os.getcwd(), env=dict(os.environ))
+
+
+def send_request(path, request, streams):
+    """Send request to the daemon listening at path and write the output it sends back to streams.
+
+    streams maps the names of the daemon's streams, 'stdout', 'stderr', 'json_report' and 'junit_report', to
+    files. Returns the exit status of the request.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        s.sendall((json.dumps(request) + "\n").encode('utf-8'))
+        with s.makefile('r', encoding='utf-8') as responses:
+            for line in responses:
+                message = json.loads(line)
+                if 'exit' in message:
+                    return message['exit']
+                stream = streams.get(message['stream'])
+                if stream is not None:
+                    stream.write(message['data'])
+                    stream.flush()
+    # The daemon went away before the request finished
+    return 1
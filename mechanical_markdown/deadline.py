@@ -0,0 +1,36 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+"""
+
+import time
+
+# A step isn't started anymore with less than this left, it would only be killed half way through
+min_step_seconds = 1.0
+
+
+class Deadline:
+    """A wall-clock budget for a whole run, such as the time a CI job is given.
+
+    Commands never run longer than what is left of the budget, so background commands and fixtures still
+    running when it runs out are terminated. Once reached(), no more steps are started, they are reported
+    as skipped instead.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires - time.monotonic())
+
+    def reached(self):
+        return self.remaining() < min_step_seconds
+
+    def limit(self, timeout):
+        """timeout, capped to what is left of the budget."""
+        return min(timeout, self.remaining())
+
+    @property
+    def reason(self):
+        return f"the run deadline of {self.seconds}s was reached"
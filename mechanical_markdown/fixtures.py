@@ -0,0 +1,175 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+"""
+
+from threading import Lock
+
+from mechanical_markdown.hooks import hooks
+from mechanical_markdown.isolate import IsolatedDirectory
+from mechanical_markdown.parsers import MarkdownAnnotationError
+from mechanical_markdown.report import StepResult
+from mechanical_markdown.resources import Resources
+from mechanical_markdown.trace import tracer
+
+
+class Fixture:
+    def __init__(self, name):
+        self.name = name
+        self.setup = None
+        self.teardown = None
+        # Number of recipes using the fixture that haven't finished yet
+        self.users = 0
+        self.started = False
+        self.ready = False
+        self.lock = Lock()
+        # Placeholders and working directory copy of the setup and teardown steps, which outlive the recipe
+        # declaring them and are only released once the fixture has been torn down
+        self.resources = Resources()
+        self.isolated = None
+
+
+class FixtureRegistry:
+    """Shares fixtures, long lived services started by a STEP with `fixture: name`, between several recipes.
+
+    A fixture is started by the first recipe that needs it, and whether it came up successfully is tracked
+    once for all of them. Recipes that declare the same fixture again don't start it a second time. Its
+    `teardown_fixture: name` step only runs once the last recipe using the fixture has finished. Fixtures can
+    also be declared in markdown files that only hold fixtures (shared), and used from any step with
+    `fixtures: [name, ...]`. With isolate, every fixture runs in its own private copy of the working directory.
+    With capacity, a Capacity, a fixture only starts once the resources its setup step declares are free, and
+    holds them until it has been torn down.
+    """
+
+    def __init__(self, recipes, shared=(), deadline=None, isolate=False, capacity=None):
+        self.fixtures = {}
+        self.isolate = isolate
+        # Fixtures don't run past the deadline of the run either
+        self.deadline = deadline
+        self.capacity = capacity
+        for recipe in list(shared) + list(recipes):
+            for step in recipe.all_steps:
+                if step.fixture is not None and self.get(step.fixture).setup is None:
+                    self.get(step.fixture).setup = step
+                if step.teardown_fixture is not None and self.get(step.teardown_fixture).teardown is None:
+                    self.get(step.teardown_fixture).teardown = step
+
+        for recipe in recipes:
+            for name in self.fixture_names(recipe):
+                self.get(name).users += 1
+
+        for fixture in self.fixtures.values():
+            if fixture.setup is None:
+                raise MarkdownAnnotationError(f"Fixture '{fixture.name}' is used but no step declares it")
+
+    def get(self, name):
+        if name not in self.fixtures:
+            self.fixtures[name] = Fixture(name)
+        return self.fixtures[name]
+
+    @classmethod
+    def fixture_names(cls, recipe):
+        names = set()
+        for step in recipe.all_steps:
+            names.update(step.fixtures)
+            names.update(name for name in (step.fixture, step.teardown_fixture) if name is not None)
+        return names
+
+    def owns(self, step):
+        """True for the fixture and teardown steps, which only run through the registry."""
+        return step.fixture is not None or step.teardown_fixture is not None
+
+    def bind(self, fixture, step):
+        """step, ready to run with the placeholders and working directory copy of fixture."""
+        step = step.bind(fixture.resources)
+        if fixture.isolated is not None:
+            step.working_dir = fixture.isolated.map(step.working_dir)
+            for command in step.commands:
+                command.cwd = fixture.isolated.map(command.cwd)
+        return step
+
+    def costs(self, step):
+        """The resources the fixtures step needs, and that haven't been started yet, take together."""
+        costs = {}
+        for name in list(step.fixtures) + ([step.fixture] if step.fixture is not None else []):
+            fixture = self.fixtures[name]
+            if not fixture.started:
+                for resource, amount in fixture.setup.resource_costs.items():
+                    costs[resource] = costs.get(resource, 0) + amount
+        return costs
+
+    def running(self, step):
+        """The fixtures step needs that already run in the background, holding their resources until teardown."""
+        names = list(step.fixtures) + ([step.fixture] if step.fixture is not None else [])
+        return [self.fixtures[name] for name in names
+                if self.fixtures[name].started and self.fixtures[name].setup.background]
+
+    def prepare(self, step, writers):
+        """Start the fixtures step needs, if they aren't running yet. Returns True if they are all ready."""
+        names = list(step.fixtures) + ([step.fixture] if step.fixture is not None else [])
+        return all([self.acquire(name, writers) for name in names])
+
+    def acquire(self, name, writers):
+        fixture = self.fixtures[name]
+        with fixture.lock:
+            if not fixture.started:
+                fixture.started = True
+                if self.isolate:
+                    with tracer.span(name, 'isolate'):
+                        fixture.isolated = IsolatedDirectory(fixture.setup.cwd)
+                setup = fixture.setup = self.bind(fixture, fixture.setup)
+                if self.capacity is not None:
+                    with tracer.span(name, 'resources'):
+                        if not self.capacity.acquire(fixture, setup.resource_costs, self.deadline):
+                            result = StepResult(setup.name, [], [], skipped=self.deadline.reason)
+                            hooks.emit('step_finished', result)
+                            for writer in writers:
+                                writer.step_finished(result)
+                            return fixture.ready
+                hooks.emit('step_started', setup.name)
+                with tracer.span(name, 'fixture'):
+                    fixture.ready = setup.run_all_commands(False, deadline=self.deadline)
+                if not setup.background:
+                    if self.capacity is not None:
+                        self.capacity.release_all(fixture)
+                    setup.finish_isolation()
+                    result = setup.validate()
+                    fixture.ready = fixture.ready and result.success
+                    hooks.emit('step_finished', result)
+                    for writer in writers:
+                        writer.step_finished(result)
+            return fixture.ready
+
+    def release(self, recipe, writers):
+        """Called when recipe has finished. Tears down the fixtures no other recipe needs anymore."""
+        success = True
+        for name in sorted(self.fixture_names(recipe)):
+            fixture = self.fixtures[name]
+            with fixture.lock:
+                fixture.users -= 1
+                if fixture.users > 0 or not fixture.started:
+                    continue
+                steps = []
+                if fixture.teardown is not None:
+                    teardown = self.bind(fixture, fixture.teardown)
+                    hooks.emit('step_started', teardown.name)
+                    teardown.run_all_commands(False)
+                    steps.append(teardown)
+                if fixture.setup.background:
+                    steps.append(fixture.setup)
+                for step in steps:
+                    if not step.wait_for_all_background_commands():
+                        success = False
+                    step.finish_isolation()
+                    result = step.validate()
+                    if not result.success:
+                        success = False
+                    hooks.emit('step_finished', result)
+                    for writer in writers:
+                        writer.step_finished(result)
+                if self.capacity is not None:
+                    self.capacity.release_all(fixture)
+                if fixture.isolated is not None:
+                    fixture.isolated.cleanup()
+                fixture.resources.release()
+        return success
@@ -0,0 +1,180 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+"""
+
+import importlib
+import queue
+import sys
+import threading
+import traceback
+
+# Installed packages register plugin classes under this entry point group
+entry_point_group = 'mechanical_markdown.plugins'
+
+# Hooks whose events may be dropped when plugins can't keep up, all others are always delivered
+lossy_hooks = ('output_line',)
+
+
+class Plugin:
+    """Base class for plugins observing runs, override the hooks you are interested in.
+
+    Hooks are called from a single dispatcher thread, in the order the events happened, and never from the
+    threads running commands. Results are the same StepResult/LinkResult objects report writers get.
+    """
+
+    def recipe_started(self, filename):
+        pass
+
+    def recipe_finished(self, filename, success):
+        pass
+
+    def step_started(self, name):
+        pass
+
+    def step_finished(self, result):
+        pass
+
+    def command_started(self, command, cwd, pid):
+        pass
+
+    def command_finished(self, command, return_code, duration_seconds, resource_usage, output):
+        """output is a dict of the captured 'stdout' and 'stderr' text, resource_usage may be None."""
+        pass
+
+    def output_line(self, command, stream, line, timestamp):
+        """A line of output, as it was read while the command ran. timestamp is a time.time() value."""
+        pass
+
+    def line_matched(self, step_name, stream, expected_line, index):
+        """An expected line was looked for in the output of a step. index is None if it wasn't found."""
+        pass
+
+    def link_checked(self, result):
+        pass
+
+    def link_requested(self, url, status, duration_seconds):
+        """An external link was actually requested, rather than taken from the results of earlier checks."""
+        pass
+
+    def cache_lookup(self, cache, hit):
+        """Something was looked up in one of the caches: 'links', 'anchors' or, in the daemon, 'lint'."""
+        pass
+
+    def close(self):
+        """Called once, after the last event."""
+        pass
+
+
+def overrides(plugin, hook):
+    """True if plugin implements hook, rather than inheriting the Plugin one that does nothing."""
+    implementation = getattr(type(plugin), hook, None)
+    return implementation is not None and implementation is not getattr(Plugin, hook, None)
+
+
+class Hooks:
+    """Dispatches events to plugins through a bounded queue, from a background thread.
+
+    Output lines are emitted from the threads reading command output, which must never wait for a slow
+    plugin: when the queue is full, they are dropped, and counted in dropped, instead. They are only emitted at
+    all (lines_enabled) if a plugin implements output_line. Every other event waits for room in the queue, so
+    plugins such as metrics always see all of them. Without plugins, emit() costs next to nothing.
+    """
+
+    def __init__(self, queue_size=10000):
+        self.queue_size = queue_size
+        self.enabled = False
+        self.lines_enabled = False
+        self.plugins = []
+        self.dropped = 0
+        self._queue = None
+        self._worker = None
+        self._lock = threading.Lock()
+        # (plugin, hook) pairs that raised, so a broken plugin doesn't flood stderr
+        self._failed = set()
+
+    def add(self, plugin):
+        self.plugins.append(plugin)
+        if self._worker is None:
+            self._queue = queue.Queue(self.queue_size)
+            self._worker = threading.Thread(target=self._dispatch, name='hooks', daemon=True)
+            self._worker.start()
+        self.enabled = True
+        self.lines_enabled = self.lines_enabled or overrides(plugin, 'output_line')
+
+    def emit(self, hook, *args):
+        if not self.enabled:
+            return
+        if hook not in lossy_hooks:
+            self._queue.put((hook, args))
+            return
+        try:
+            self._queue.put_nowait((hook, args))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def _dispatch(self):
+        while True:
+            event = self._queue.get()
+            if event is None:
+                return
+            hook, args = event
+            for plugin in self.plugins:
+                self._call(plugin, hook, *args)
+
+    def _call(self, plugin, hook, *args):
+        try:
+            getattr(plugin, hook)(*args)
+        except Exception:
+            if (id(plugin), hook) not in self._failed:
+                self._failed.add((id(plugin), hook))
+                print(f"Plugin {type(plugin).__name__} failed in {hook}:\n{traceback.format_exc()}", file=sys.stderr)
+
+    def close(self):
+        """Deliver the events that are still queued, then close the plugins."""
+        if self._worker is None:
+            return
+        self.enabled = False
+        self.lines_enabled = False
+        self._queue.put(None)
+        self._worker.join()
+        for plugin in self.plugins:
+            self._call(plugin, 'close')
+        if self.dropped:
+            print(f"Plugins were too slow to keep up, {self.dropped} output lines were dropped", file=sys.stderr)
+        self.plugins = []
+        self.dropped = 0
+        self._queue = None
+        self._worker = None
+
+
+def load_plugin(spec):
+    """Create a plugin from a 'module:Class' spec."""
+    module_name, _, attribute = spec.partition(':')
+    if module_name == '' or attribute == '':
+        raise ValueError(f"Plugin '{spec}' should look like module:Class")
+    plugin_class = importlib.import_module(module_name)
+    for name in attribute.split('.'):
+        plugin_class = getattr(plugin_class, name)
+    return plugin_class()
+
+
+def entry_point_plugins():
+    """Create the plugins installed packages registered in the mechanical_markdown.plugins entry point group."""
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        # Python 3.7
+        import pkg_resources
+        return [entry_point.load()() for entry_point in pkg_resources.iter_entry_points(entry_point_group)]
+
+    found = entry_points()
+    if hasattr(found, 'select'):
+        found = found.select(group=entry_point_group)
+    else:
+        found = found.get(entry_point_group, [])
+    return [entry_point.load()() for entry_point in found]
+
+
+hooks = Hooks()
@@ -0,0 +1,112 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+"""
+
+import os
+import shutil
+import tempfile
+
+# ioctl request to share the data blocks of a file with another one on Linux (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# st_dev of file systems that turned out not to support reflinks, so they aren't tried again for every file
+_no_reflink_devices = set()
+
+
+def clone_file(src, dst):
+    """Copy src to dst as a reflink when the file system supports it, so data is only copied once it's modified."""
+    device = os.stat(src).st_dev
+    if device not in _no_reflink_devices:
+        try:
+            import fcntl
+            with open(src, 'rb') as s, open(dst, 'wb') as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            shutil.copystat(src, dst)
+            return
+        except (ImportError, OSError):
+            _no_reflink_devices.add(device)
+    shutil.copy2(src, dst)
+
+
+class IsolatedDirectory:
+    """A private scratch copy of a directory tree.
+
+    Files are copied with clone_file(), which makes the copy nearly free on copy-on-write file systems. The
+    copy is made next to the directory, as reflinks only work within one file system, and /tmp often is another.
+    The size and modification time of every file is remembered, so changes made to the copy can be found,
+    and optionally collected back into the original directory, afterwards.
+    """
+
+    def __init__(self, source):
+        self.source = os.path.abspath(source)
+        try:
+            self.path = tempfile.mkdtemp(prefix='.mm-isolated-', dir=os.path.dirname(self.source))
+        except OSError:
+            # The parent directory isn't writable, a full copy in /tmp it is
+            self.path = tempfile.mkdtemp(prefix='mm-isolated-')
+        self.snapshot = {}
+        self.copy_tree()
+
+    def copy_tree(self):
+        for root, dirs, files in os.walk(self.source):
+            relative_root = os.path.relpath(root, self.source)
+            target_root = os.path.normpath(os.path.join(self.path, relative_root))
+            for name in dirs + files:
+                src = os.path.join(root, name)
+                dst = os.path.join(target_root, name)
+                if os.path.islink(src):
+                    os.symlink(os.readlink(src), dst)
+                elif os.path.isdir(src):
+                    os.mkdir(dst)
+                elif os.path.isfile(src):
+                    clone_file(src, dst)
+                    self.snapshot[os.path.normpath(os.path.join(relative_root, name))] = self.signature(dst)
+
+    @classmethod
+    def signature(cls, path):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+
+    def map(self, path):
+        """The path inside the copy for a path inside the source directory. Other paths are left as they are."""
+        path = os.path.abspath(path)
+        if path == self.source or path.startswith(self.source + os.sep):
+            return os.path.join(self.path, os.path.relpath(path, self.source))
+        return path
+
+    def changes(self):
+        """Relative paths of the (added, modified, deleted) files of the copy."""
+        added = []
+        modified = []
+        seen = set()
+        for root, dirs, files in os.walk(self.path):
+            for name in files:
+                path = os.path.join(root, name)
+                if os.path.islink(path) or not os.path.isfile(path):
+                    continue
+                relative = os.path.relpath(path, self.path)
+                seen.add(relative)
+                if relative not in self.snapshot:
+                    added.append(relative)
+                elif self.snapshot[relative] != self.signature(path):
+                    modified.append(relative)
+        deleted = [relative for relative in self.snapshot if relative not in seen]
+        return sorted(added), sorted(modified), sorted(deleted)
+
+    def collect(self):
+        """Apply the changes made to the copy to the source directory and return them."""
+        added, modified, deleted = self.changes()
+        for relative in added + modified:
+            target = os.path.join(self.source, relative)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copy2(os.path.join(self.path, relative), target)
+        for relative in deleted:
+            try:
+                os.remove(os.path.join(self.source, relative))
+            except FileNotFoundError:
+                pass
+        return added, modified, deleted
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
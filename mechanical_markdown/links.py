@@ -0,0 +1,205 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+"""
+
+import html
+import os
+import re
+import time
+
+from concurrent.futures import Future
+from mistune import HTMLRenderer, Markdown
+from threading import Lock, Thread
+from urllib.parse import unquote
+from mechanical_markdown.hooks import hooks
+from mechanical_markdown.report import LinkResult
+from mechanical_markdown.trace import tracer
+from time import sleep
+
+url_scheme = re.compile(r'[a-zA-Z][a-zA-Z0-9+.-]*:')
+html_tag = re.compile(r'<[^>]*>')
+html_anchor = re.compile(r'<a\s[^>]*?\b(?:name|id)\s*=\s*["\']([^"\']+)["\']', re.IGNORECASE)
+
+
+def is_local_link(url):
+    """True for links into the docs tree, i.e. neither external (https://, mailto:, ...) nor empty."""
+    return url is not None and url != "" and url_scheme.match(url) is None and not url.startswith('//')
+
+
+def heading_anchor(text):
+    """The anchor GitHub renders for a heading, given the heading rendered as inline HTML."""
+    text = html.unescape(html_tag.sub('', text)).strip().lower()
+    return re.sub(r'[^\w\- ]', '', text).replace(' ', '-')
+
+
+def unique_anchors(headings):
+    """Anchors for a list of headings, numbering duplicates the way GitHub does: foo, foo-1, foo-2."""
+    anchors = set()
+    counts = {}
+    for heading in headings:
+        anchor = heading_anchor(heading)
+        if anchor in counts:
+            counts[anchor] += 1
+            anchor = f"{anchor}-{counts[anchor]}"
+        else:
+            counts[anchor] = 0
+        anchors.add(anchor)
+    return anchors
+
+
+class HeadingCollector(HTMLRenderer):
+    """Collects the headings of a document, rendered as inline HTML for heading_anchor(), links and code included."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.headings = []
+
+    def heading(self, text, level, **attrs):
+        self.headings.append(text)
+        return ""
+
+
+def markdown_anchors(markdown):
+    collector = HeadingCollector()
+    Markdown(collector)(markdown)
+    return unique_anchors(collector.headings) | set(html_anchor.findall(markdown))
+
+
+class HeadingIndex:
+    """Resolves relative links and their #fragments against the files of a docs tree without any network access.
+
+    Every file is looked at, and every markdown file parsed for its heading anchors, at most once, so one index
+    can be shared by all the recipes of a run. Links starting with / are resolved against root.
+    """
+
+    def __init__(self, root=None):
+        self.root = os.path.abspath(root or os.getcwd())
+        self._exists = {}
+        self._anchors = {}
+
+    def add(self, path, anchors):
+        """Register the anchors of a document that has already been parsed."""
+        path = os.path.abspath(path)
+        self._exists[path] = True
+        self._anchors[path] = anchors
+
+    def exists(self, path):
+        if path not in self._exists:
+            self._exists[path] = os.path.exists(path)
+        return self._exists[path]
+
+    def anchors(self, path):
+        """The anchors of the file at path, or None if they can't be known (e.g. it isn't a markdown file)."""
+        hooks.emit('cache_lookup', 'anchors', path in self._anchors)
+        if path not in self._anchors:
+            anchors = None
+            if os.path.splitext(path)[1].lower() in ('.md', '.markdown') and os.path.isfile(path):
+                with open(path, encoding='utf-8') as f:
+                    anchors = markdown_anchors(f.read())
+            self._anchors[path] = anchors
+        return self._anchors[path]
+
+    def resolve(self, url, base_path):
+        """Split a relative link into the absolute path it points to and its decoded fragment."""
+        url, _, fragment = url.partition('#')
+        url = unquote(url.split('?', 1)[0])
+        if url == "":
+            path = base_path
+        elif url.startswith('/'):
+            path = os.path.join(self.root, url.lstrip('/'))
+        else:
+            path = os.path.join(os.path.dirname(base_path), url)
+        return os.path.normpath(path), unquote(fragment)
+
+    def check(self, url, base_path):
+        """Return a LinkResult for url, a link found in the document at base_path."""
+        path, fragment = self.resolve(url, os.path.abspath(base_path))
+        if not self.exists(path):
+            return LinkResult(url, "File not found", local=True)
+        if fragment:
+            anchors = self.anchors(path)
+            if anchors is not None and fragment not in anchors and fragment.lower() not in anchors:
+                return LinkResult(url, "Anchor not found", local=True)
+        return LinkResult(url, "Found", local=True)
+
+
+def check_link(link, retries=3, session=None):
+    # requests is expensive to import, only load it when we actually check links
+    import requests
+
+    # A requests.Session keeps connections to the hosts it has seen open for the next links
+    get = requests.get if session is None else session.get
+    with tracer.span(link, 'link') as trace_args:
+        while True:
+            try:
+                status = get(link).status_code
+            except requests.exceptions.ConnectionError:
+                status = "Connection Failed"
+            trace_args['status'] = status
+            retries -= 1
+            if (isinstance(status, int) and status < 400) or retries <= 0:
+                return LinkResult(link, status)
+            sleep(0.5)
+
+
+class LinkChecker:
+    """Checks every unique external URL at most once and hands the same LinkResult to every occurrence.
+
+    Share one LinkChecker between recipes to validate the links of a whole docs tree without requesting
+    the same URL over and over. start() checks the links in a background thread, so they can be validated
+    while the steps run; check() then only waits for URLs that haven't been checked yet. Links are requested
+    through session, a requests.Session, if one is given.
+    """
+
+    def __init__(self, retries=3, session=None):
+        self.retries = retries
+        self.session = session
+        # url -> Future of its LinkResult, whichever thread gets to a URL first checks it
+        self.results = {}
+        self._lock = Lock()
+        self._worker = None
+
+    def check(self, url):
+        with self._lock:
+            future = self.results.get(url)
+            owner = future is None
+            if owner:
+                future = self.results[url] = Future()
+        hooks.emit('cache_lookup', 'links', not owner)
+        if owner:
+            start = time.monotonic()
+            try:
+                result = check_link(url, self.retries, session=self.session)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                hooks.emit('link_requested', url, result.status, time.monotonic() - start)
+                future.set_result(result)
+        return future.result()
+
+    def check_all(self, links):
+        """Check every link of an iterable of (url, ignore) pairs. Ignored occurrences aren't checked."""
+        for url, ignore in links:
+            if not ignore:
+                self.check(url)
+
+    def start(self, links):
+        """Check links, an iterable of (url, ignore) pairs, in a background thread."""
+        links = list(links)
+        if len(links) == 0:
+            return
+        self._worker = Thread(target=self.check_all, args=(links,), name='link-checker', daemon=True)
+        self._worker.start()
+
+    def forget_failed(self):
+        """Drop the results of links that failed, so they are checked again the next time they are needed."""
+        with self._lock:
+            for url, future in list(self.results.items()):
+                if future.done() and (future.exception() is not None or not future.result().success):
+                    del self.results[url]
+
+    def result(self, url, ignore=False):
+        if ignore:
+            return LinkResult(url, "Ignored", ignored=True)
+        return self.check(url)
@@ -0,0 +1,111 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+"""
+
+import json
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+from mistune import Markdown
+from mechanical_markdown.parsers import RecipeParser, MarkdownAnnotationError, end_token, end_ignore_links_token
+
+ERROR = 'error'
+WARNING = 'warning'
+
+
+class Diagnostic:
+    def __init__(self, filename, line, severity, message):
+        self.filename = filename
+        self.line = line
+        self.severity = severity
+        self.message = message
+
+    def to_dict(self):
+        return {'file': self.filename, 'line': self.line, 'severity': self.severity, 'message': self.message}
+
+    def __str__(self):
+        return f"{self.filename}:{self.line or 0}: {self.severity}: {self.message}"
+
+
+def lint_markdown(markdown, filename=None):
+    """Check the annotations of a markdown document without running anything and return a list of Diagnostics."""
+    if '<!--' not in markdown:
+        return []
+
+    errors = []
+    parser = RecipeParser('bash -c', source=markdown, errors=errors)
+    try:
+        Markdown(parser)(markdown)
+    except MarkdownAnnotationError as e:
+        errors.append(e)
+    if parser.current_step is not None:
+        errors.append(MarkdownAnnotationError(f'Reached end of input searching for <!-- {end_token} -->',
+                                              parser.current_step.line))
+        parser.all_steps.append(parser.current_step)
+    if parser.ignore_links:
+        errors.append(MarkdownAnnotationError(f'Reached end of input searching for <!-- {end_ignore_links_token} -->',
+                                              parser.ignore_links_line))
+
+    diagnostics = [Diagnostic(filename, e.line, ERROR, e.message) for e in errors]
+    names = set(step.name for step in parser.all_steps)
+    earlier = set()
+    for step in parser.all_steps:
+        for name in step.depends_on:
+            if name not in names:
+                diagnostics.append(Diagnostic(filename, step.line, ERROR,
+                                              f"Step '{step.name}' depends on '{name}', but there is no such step"))
+            elif name not in earlier:
+                diagnostics.append(Diagnostic(filename, step.line, ERROR,
+                                              f"Step '{step.name}' depends on '{name}', which only comes after it"))
+        earlier.add(step.name)
+        for key in step.unknown_keys:
+            diagnostics.append(Diagnostic(filename, step.line, WARNING, f"Unknown step key '{key}'"))
+        if len(step.commands) == 0 and step.pause_message is None:
+            name = f" '{step.name}'" if step.name else ""
+            diagnostics.append(Diagnostic(filename, step.line, WARNING,
+                                          f"Step{name} has no bash, sh, shell or shell-script code blocks"))
+
+    diagnostics.sort(key=lambda d: d.line or 0)
+    return diagnostics
+
+
+def lint_file(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            markdown = f.read()
+    except (OSError, UnicodeDecodeError) as e:
+        return [Diagnostic(path, None, ERROR, f"Unable to read file: {e}")]
+    return lint_markdown(markdown, path)
+
+
+def find_markdown_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+                for name in sorted(files):
+                    if name.endswith('.md'):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def lint_paths(paths, jobs=None):
+    """Lint every markdown file in paths (files or directories searched recursively) using jobs processes."""
+    files = list(find_markdown_files(paths))
+    if jobs == 1 or len(files) < 2:
+        results = map(lint_file, files)
+    else:
+        workers = jobs or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lint_file, files, chunksize=max(1, len(files) // (workers * 4))))
+    return files, [diagnostic for diagnostics in results for diagnostic in diagnostics]
+
+
+def print_diagnostics(diagnostics, stream, output_format='text'):
+    for diagnostic in diagnostics:
+        if output_format == 'json':
+            stream.write(json.dumps(diagnostic.to_dict()) + "\n")
+        else:
+            stream.write(str(diagnostic) + "\n")
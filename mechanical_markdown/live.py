@@ -0,0 +1,61 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+"""
+
+import datetime
+
+from queue import Queue
+from termcolor import colored
+from threading import Thread
+
+default_max_queued_lines = 1000
+
+
+class LivePrinter(Thread):
+    """Prints the output of commands while they run, prefixed with a timestamp and the step name.
+
+    Lines are handed over through a bounded queue. When the terminal can't keep up the queue fills up and the
+    threads reading command output block, which in turn makes the commands block on their full pipes,
+    instead of buffering an unbounded amount of output in memory.
+    """
+
+    def __init__(self, stream, max_queued_lines=default_max_queued_lines, color=True):
+        super().__init__(daemon=True)
+        self.stream = stream
+        self.color = color
+        self.queue = Queue(maxsize=max_queued_lines)
+        self.start()
+
+    def listener(self, step):
+        """Return a line callback for the commands of step."""
+        def on_line(stream_name, line):
+            self.queue.put((datetime.datetime.now(), step, stream_name, line.rstrip("\n")))
+        return on_line
+
+    @classmethod
+    def is_expected(cls, step, stream_name, line):
+        for expected in step.expected_lines[stream_name]:
+            if step.match_mode == 'exact' and line == expected:
+                return True
+            if step.match_mode == 'substring' and expected in line:
+                return True
+        return False
+
+    def format_line(self, timestamp, step, stream_name, line):
+        if self.color and self.is_expected(step, stream_name, line):
+            line = colored(line, 'green')
+        return "{} [{}] {}: {}\n".format(timestamp.strftime('%H:%M:%S.%f')[:-3], step.name, stream_name, line)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self.stream.write(self.format_line(*item))
+            self.stream.flush()
+
+    def close(self):
+        """Print whatever is still queued and stop the printer thread."""
+        self.queue.put(None)
+        self.join()
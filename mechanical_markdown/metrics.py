@@ -0,0 +1,155 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+"""
+
+import os
+import tempfile
+import time
+
+from threading import Event, Lock, Thread
+from mechanical_markdown.hooks import Plugin
+
+duration_buckets = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+link_buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+histograms = {
+    'mm_step_duration_seconds': ('Duration of steps', duration_buckets),
+    'mm_command_duration_seconds': ('Duration of commands', duration_buckets),
+    'mm_link_check_duration_seconds': ('Time taken to request external links, including retries', link_buckets),
+}
+
+counters = {
+    'mm_recipes': 'Recipes run, by result',
+    'mm_steps': 'Steps run, by result',
+    'mm_command_return_codes': 'Commands run, by return code',
+    'mm_command_output_bytes': 'Bytes of output captured from commands, by stream',
+    'mm_links_checked': 'Links validated, by kind and status',
+    'mm_cache_lookups': 'Cache lookups, by cache and result',
+}
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in labels) + '}'
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name):
+        for bound, count in zip(self.buckets, self.counts):
+            yield f'{name}_bucket{{le="{bound}"}} {count}'
+        yield f'{name}_bucket{{le="+Inf"}} {self.count}'
+        yield f'{name}_sum {self.sum}'
+        yield f'{name}_count {self.count}'
+
+
+class PrometheusExporter(Plugin):
+    """Writes metrics of the run to path in the Prometheus text format, e.g. for a node_exporter textfile collector.
+
+    This is version 0.0.4 of the format, which the textfile collector parses, not OpenMetrics. The file is replaced
+    atomically at the end of the run and, with interval, every interval seconds while it runs, so a collector never
+    reads a partially written file.
+    """
+
+    def __init__(self, path, interval=None):
+        self.path = path
+        self.histograms = {name: Histogram(buckets) for name, (_, buckets) in histograms.items()}
+        # name -> {((label, value), ...): count}
+        self.counters = {name: {} for name in counters}
+        self._lock = Lock()
+        self._stop = Event()
+        self._writer = None
+        if interval:
+            self._writer = Thread(target=self._write_periodically, args=(interval,), name='metrics', daemon=True)
+            self._writer.start()
+
+    def observe(self, name, value):
+        with self._lock:
+            self.histograms[name].observe(value)
+
+    def count(self, name, amount=1, **labels):
+        key = tuple(sorted((label, str(value)) for label, value in labels.items()))
+        with self._lock:
+            self.counters[name][key] = self.counters[name].get(key, 0) + amount
+
+    def recipe_finished(self, filename, success):
+        self.count('mm_recipes', result='success' if success else 'failure')
+
+    def step_finished(self, result):
+        self.observe('mm_step_duration_seconds', result.duration_seconds)
+        if result.skipped is not None:
+            self.count('mm_steps', result='skipped')
+            return
+        self.count('mm_steps', result='success' if result.success else 'failure')
+
+    def command_finished(self, command, return_code, duration_seconds, resource_usage, output):
+        self.observe('mm_command_duration_seconds', duration_seconds)
+        self.count('mm_command_return_codes', code=return_code)
+        for stream, text in output.items():
+            self.count('mm_command_output_bytes', len(text.encode('utf-8', errors='replace')), stream=stream)
+
+    def link_checked(self, result):
+        self.count('mm_links_checked', kind='local' if result.local else 'external', status=result.status)
+
+    def link_requested(self, url, status, duration_seconds):
+        self.observe('mm_link_check_duration_seconds', duration_seconds)
+
+    def cache_lookup(self, cache, hit):
+        self.count('mm_cache_lookups', cache=cache, result='hit' if hit else 'miss')
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, (help_text, _) in histograms.items():
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+                lines += self.histograms[name].samples(name)
+            for name, help_text in counters.items():
+                # Counters are named with their _total suffix, unlike in OpenMetrics
+                lines += [f'# HELP {name}_total {help_text}', f'# TYPE {name}_total counter']
+                for labels, value in sorted(self.counters[name].items()):
+                    lines.append(f'{name}_total{format_labels(labels)} {value}')
+        lines += ['# HELP mm_last_update_timestamp_seconds When these metrics were written',
+                  '# TYPE mm_last_update_timestamp_seconds gauge',
+                  f'mm_last_update_timestamp_seconds {time.time()}']
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(self.path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.render())
+            # mkstemp creates files only their owner can read, the collector usually runs as another user
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _write_periodically(self, interval):
+        while not self._stop.wait(interval):
+            self.write()
+
+    def close(self):
+        self._stop.set()
+        if self._writer is not None:
+            self._writer.join()
+        self.write()
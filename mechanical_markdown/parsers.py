@@ -1,15 +1,16 @@
-
 """
 Copyright (c) Microsoft Corporation.
 Licensed under the MIT License.
 """
 
+import os
 import re
 import yaml
 
 from html.parser import HTMLParser
-from mistune import HTMLRenderer
-from mechanical_markdown.step import Step
+from mechanical_markdown.links import HeadingCollector, is_local_link
+from mechanical_markdown.resources import placeholder
+from mechanical_markdown.step import Step, VALID_STEP_KEYS
 
 start_token = 'STEP'
 end_token = 'END_STEP'
@@ -19,7 +20,21 @@ end_ignore_links_token = 'END_IGNORE'
 
 
 class MarkdownAnnotationError(Exception):
-    pass
+    def __init__(self, message, line=None, filename=None):
+        super().__init__(message)
+        self.message = message
+        self.line = line
+        self.filename = filename
+
+    def __str__(self):
+        location = ""
+        if self.filename is not None:
+            location = f"{self.filename}:"
+        if self.line is not None:
+            location += f"{self.line}:"
+        if location:
+            return f"{location} {self.message}"
+        return self.message
 
 
 class HTMLCommentParser(HTMLParser):
@@ -31,20 +46,61 @@ class HTMLCommentParser(HTMLParser):
         self.comment_text += comment
 
 
-class RecipeParser(HTMLRenderer):
-    def __init__(self, shell, **kwargs):
+class RecipeParser(HeadingCollector):
+    """Collects steps and links from a markdown document.
+
+    If source (the markdown text being rendered) is given, annotation errors and steps carry the line they
+    were found on. If errors is a list, annotation errors are appended to it and parsing carries on instead
+    of raising the first one. Placeholders are left as they are, steps using them keep their annotation as a
+    template to substitute them from for every run, see Step.bind(). Steps run in cwd with env, the current
+    working directory and a snapshot of the environment of the process by default.
+    """
+
+    def __init__(self, shell, source=None, errors=None, cwd=None, env=None, **kwargs):
         super().__init__(**kwargs)
         self.current_step = None
         self.all_steps = []
         self.external_links = []
+        self.local_links = []
         self.ignore_links = False
+        self.ignore_links_line = None
         self.shell = shell
+        self.source = source
+        self.errors = errors
+        self.cwd = cwd
+        # One snapshot shared by all steps, their env only holds the variables they override
+        self.env = dict(os.environ) if env is None else env
+        # The annotation of the current step, before it was parsed
+        self._annotation = None
+        self._source_pos = 0
+        self._source_line = 1
+
+    def error(self, message, line):
+        error = MarkdownAnnotationError(message, line)
+        if self.errors is None:
+            raise error
+        self.errors.append(error)
+
+    def locate(self, html):
+        """Return the line number of an html block in the source, searching forward from the previous one."""
+        if self.source is None:
+            return None
+        # Blocks nested in quotes or lists lose their prefixes, so only look for the first line
+        needle = html.strip().split("\n", 1)[0]
+        pos = self.source.find(needle, self._source_pos)
+        if pos < 0:
+            return None
+        self._source_line += self.source.count("\n", self._source_pos, pos)
+        self._source_pos = pos
+        return self._source_line
 
     def block_code(self, code: str, info=None):
         if info:
             lang = info.split(None, 1)[0]
             if (lang is not None and lang.strip() in ('bash', 'sh', 'shell-script', 'shell')
                     and self.current_step is not None):
+                if self.current_step.template is None and placeholder.search(code) is not None:
+                    self.current_step.template = self._annotation
                 self.current_step.add_command_block(code)
         return ""
 
@@ -53,21 +109,27 @@ class RecipeParser(HTMLRenderer):
         comment_parser.feed(html)
 
         comment_body = comment_parser.comment_text
+        if not comment_body:
+            return ""
+        line = self.locate(html)
+
         if comment_body.find(end_token) >= 0:
             if self.current_step is None:
-                raise MarkdownAnnotationError("Unexpected <!-- {} --> found".format(end_token))
+                self.error("Unexpected <!-- {} --> found".format(end_token), line)
+                return ""
             self.all_steps.append(self.current_step)
             self.current_step = None
             return ""
 
         elif comment_body.find(ignore_links_token) >= 0:
             if self.ignore_links:
-                raise MarkdownAnnotationError(f"Duplicate <!-- {ignore_links_token} --> found")
+                self.error(f"Duplicate <!-- {ignore_links_token} --> found", line)
             self.ignore_links = True
+            self.ignore_links_line = line
 
         elif comment_body.find(end_ignore_links_token) >= 0:
             if not self.ignore_links:
-                raise MarkdownAnnotationError("Unexpected <!-- {} --> found".format(end_ignore_links_token))
+                self.error("Unexpected <!-- {} --> found".format(end_ignore_links_token), line)
             self.ignore_links = False
 
         start_pos = comment_body.find(start_token)
@@ -76,15 +138,56 @@ class RecipeParser(HTMLRenderer):
             return ""
 
         if self.current_step is not None:
-            raise MarkdownAnnotationError(f"<!-- {start_token} --> found while still processing previous step")
+            self.error(f"<!-- {start_token} --> found while still processing previous step", line)
+            self.all_steps.append(self.current_step)
 
         start_pos += len(start_token)
-        self.current_step = Step(yaml.safe_load(comment_body[start_pos:]), self.shell)
+        self.current_step = self.create_step(comment_body[start_pos:], line)
 
         return ""
 
+    def create_step(self, annotation, line):
+        self._annotation = annotation
+        try:
+            parameters = yaml.safe_load(annotation)
+        except yaml.YAMLError as e:
+            mark = getattr(e, 'problem_mark', None)
+            error_line = line + mark.line if line is not None and mark is not None else line
+            problem = getattr(e, 'problem', None) or str(e)
+            self.error(f"Invalid YAML in <!-- {start_token} -->: {problem}", error_line)
+            parameters = {}
+        if parameters is None:
+            parameters = {}
+        if not isinstance(parameters, dict):
+            self.error(f"<!-- {start_token} --> must contain a YAML mapping", line)
+            parameters = {}
+
+        try:
+            step = Step(parameters, self.shell, self.cwd, self.env)
+        except MarkdownAnnotationError as e:
+            if e.line is None:
+                e.line = line
+            if self.errors is None:
+                raise
+            self.errors.append(e)
+            # Carry on with a default step so the rest of the document can still be checked
+            step = Step({'name': parameters.get('name', '')}, self.shell, self.cwd, self.env)
+            step.unknown_keys = [key for key in parameters if key not in VALID_STEP_KEYS]
+        step.line = line
+        if placeholder.search(annotation) is not None:
+            step.template = annotation
+        return step
+
     def link(self, text, url=None, title=None):
         if re.match("https?://", url) is not None:
             self.external_links.append((url, self.ignore_links))
+        elif is_local_link(url):
+            self.local_links.append((url, self.ignore_links))
+
+        # The text of a link is part of the heading it is in, and so of its anchor
+        return super().link(text, url, title)
 
+    def image(self, text, url, title=None):
+        if is_local_link(url):
+            self.local_links.append((url, self.ignore_links))
         return ""
@@ -0,0 +1,219 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+
+A pytest plugin that collects annotated markdown files as test items.
+
+Enable it with `pytest --mm`, or by setting `mm = true` in your pytest ini file. By default every markdown file
+containing STEP annotations becomes a single test item, which lets pytest-xdist spread files over all cores.
+With --mm-per-step every step becomes its own item, marked with its tags. `-m` selects steps the way `--tags` does:
+steps without tags, and the steps the selected steps depend on, run too. In a file item, only those steps run. The
+steps of a file share state and have to run in order on the same worker, so use `--dist loadgroup` with pytest-xdist.
+"""
+
+import re
+import warnings
+
+import pytest
+
+# Not public, but how pytest applies -k, which has to be applied to markdown items the same way
+from _pytest.mark import deselect_by_keyword
+
+from mechanical_markdown.report import ReportWriter, TerminalWriter
+
+step_annotation = re.compile(r'<!--\s*STEP\b')
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('mechanical-markdown')
+    group.addoption('--mm', dest='mm', action='store_true', default=None,
+                    help='Collect markdown files with STEP annotations as tests')
+    group.addoption('--mm-per-step', dest='mm_per_step', action='store_true', default=None,
+                    help='Collect every step as its own test item instead of one item per file')
+    group.addoption('--mm-shell', dest='mm_shell', default=None,
+                    help="Shell used to run the steps [Default: 'bash -c']")
+    parser.addini('mm', type='bool', default=False, help='Collect markdown files with STEP annotations as tests')
+    parser.addini('mm_per_step', type='bool', default=False, help='Collect every step as its own test item')
+    parser.addini('mm_shell', default='bash -c', help='Shell used to run the steps')
+
+
+def pytest_configure(config):
+    # Normally registered by pytest-xdist, which is optional
+    config.addinivalue_line('markers', 'xdist_group(name): run all tests of the group on the same worker')
+
+
+def get_option(config, name):
+    value = config.getoption(name)
+    return config.getini(name) if value is None else value
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_collection_modifyitems(session, config, items):
+    # Markers can't select the steps a selected step depends on, -m is applied to markdown items here instead
+    from mechanical_markdown.selection import SelectionError, StepSelection
+
+    markdown_items = [item for item in items if isinstance(item, MarkdownItem)]
+    if not config.option.markexpr or len(markdown_items) == 0:
+        yield
+        return
+    try:
+        # A single word is a tag as it is, unless it is pytest syntax such as `device(serial="1")`
+        words = config.option.markexpr.split()
+        if len(words) == 1 and not words[0].isidentifier():
+            raise SelectionError(f"'{words[0]}' is not a marker name")
+        selection = StepSelection([config.option.markexpr])
+    except SelectionError as e:
+        # Likely a marker expression for the other tests, leave the markdown items to pytest's markers
+        warnings.warn(pytest.PytestConfigWarning(f"Markdown steps are only selected by their markers: {e}"))
+        yield
+        return
+
+    collected = list(items)
+    items[:] = [item for item in items if not isinstance(item, MarkdownItem)]
+    yield
+    selected = {}
+    for item in markdown_items:
+        if item.parent not in selected:
+            item.parent.selection = selection
+            selected[item.parent] = selection.select(item.parent.recipe)
+    kept = []
+    deselected = []
+    for item in markdown_items:
+        steps = selected[item.parent]
+        if isinstance(item, StepItem):
+            steps = [step for step in steps if step is item.step]
+        if len(steps):
+            kept.append(item)
+        else:
+            deselected.append(item)
+    if len(deselected):
+        config.hook.pytest_deselected(items=deselected)
+    # -k still applies to markdown items, the way pytest would have applied it
+    deselect_by_keyword(kept, config)
+    kept = set(items).union(kept)
+    items[:] = [item for item in collected if item in kept]
+
+
+def pytest_collect_file(parent, file_path):
+    if file_path.suffix != '.md' or not get_option(parent.config, 'mm'):
+        return None
+    with open(file_path, encoding='utf-8') as f:
+        if step_annotation.search(f.read()) is None:
+            return None
+    return MarkdownFile.from_parent(parent, path=file_path)
+
+
+class ResultCollector(ReportWriter):
+    def __init__(self):
+        self.results = []
+
+    def step_finished(self, result):
+        self.results.append(result)
+
+
+class MarkdownStepFailure(Exception):
+    def __init__(self, results):
+        formatter = TerminalWriter(None, color=False)
+        super().__init__("".join(formatter.format_step(result) for result in results))
+        self.results = results
+
+
+class MarkdownFile(pytest.File):
+    def collect(self):
+        # Only pay for importing the markdown machinery once there actually is something to collect
+        from mechanical_markdown.recipe import Recipe
+
+        from mechanical_markdown.resources import Resources
+
+        self.failed = False
+        self.background_steps = []
+        # The StepSelection of -m, if it applies to the steps of this file
+        self.selection = None
+        # Placeholders are shared by the steps of the file, like in a run of the whole file
+        self.resources = Resources()
+        # Steps are written to be run from the directory of their markdown file, just like `mm.py file.md`
+        self.recipe = Recipe(self.path.read_text(encoding='utf-8'), shell=get_option(self.config, 'mm_shell'),
+                             cwd=str(self.path.parent))
+        tags = sorted({tag for step in self.recipe.all_steps for tag in step.tags})
+        for tag in tags:
+            self.config.addinivalue_line('markers', f'{tag}: steps tagged {tag} in annotated markdown')
+
+        if not get_option(self.config, 'mm_per_step'):
+            yield RecipeItem.from_parent(self, name='recipe')
+            return
+
+        group = pytest.mark.xdist_group(str(self.path))
+        for idx, step in enumerate(self.recipe.all_steps):
+            item = StepItem.from_parent(self, name=step.name or f'step {idx}', step=step)
+            item.add_marker(group)
+            for tag in step.tags:
+                item.add_marker(tag)
+            yield item
+
+    def teardown(self):
+        # Background steps are only waited for once every step of the file has run, just like mm.py does
+        background_steps, self.background_steps = self.background_steps, []
+        results = []
+        for step in background_steps:
+            step_success = step.wait_for_all_background_commands()
+            step.finish_isolation()
+            result = step.validate()
+            if not step_success or not result.success:
+                results.append(result)
+        if hasattr(self, 'resources'):
+            self.resources.release()
+        if len(results):
+            raise MarkdownStepFailure(results)
+
+
+class MarkdownItem(pytest.Item):
+    def repr_failure(self, excinfo):
+        if isinstance(excinfo.value, MarkdownStepFailure):
+            return str(excinfo.value)
+        return super().repr_failure(excinfo)
+
+    def reportinfo(self):
+        return self.path, None, self.name
+
+    def record_results(self, results):
+        self.results = results
+        for result in results:
+            self.user_properties.append((result.name or 'step', result.to_dict()))
+
+
+class RecipeItem(MarkdownItem):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.results = []
+
+    def runtest(self):
+        collector = ResultCollector()
+        success = self.parent.recipe.run(False, [collector], selection=self.parent.selection)
+        self.record_results(collector.results)
+        if not success:
+            raise MarkdownStepFailure([result for result in collector.results if not result.success]
+                                      or collector.results)
+
+
+class StepItem(MarkdownItem):
+    def __init__(self, step, **kwargs):
+        super().__init__(**kwargs)
+        self.step = step
+        self.results = []
+
+    def runtest(self):
+        if self.parent.failed:
+            pytest.skip('a previous step of this file failed')
+
+        step = self.step.bind(self.parent.resources)
+        step_success = step.run_all_commands(False)
+        if step.background:
+            self.parent.background_steps.append(step)
+            if step_success:
+                return
+        step.finish_isolation()
+        result = step.validate()
+        self.record_results([result])
+        if not step_success or not result.success:
+            self.parent.failed = True
+            raise MarkdownStepFailure([result])
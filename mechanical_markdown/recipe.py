@@ -4,83 +4,400 @@ Copyright (c) Microsoft Corporation.
 Licensed under the MIT License.
 """
 
-import requests
+import io
+import os
+
+from collections import deque
+from threading import Thread
 from mistune import Markdown
+from mechanical_markdown.capacity import Capacity
+from mechanical_markdown.cassette import Cassette
+from mechanical_markdown.fixtures import FixtureRegistry
+from mechanical_markdown.hooks import hooks
+from mechanical_markdown.isolate import IsolatedDirectory
+from mechanical_markdown.links import HeadingIndex, LinkChecker, unique_anchors, html_anchor
 from mechanical_markdown.parsers import RecipeParser, end_token, end_ignore_links_token, MarkdownAnnotationError
-from termcolor import colored
-from time import sleep
+from mechanical_markdown.report import BufferingWriter, LinkResult, StepResult, TerminalWriter
+from mechanical_markdown.resources import Resources
+from mechanical_markdown.selection import StepIndex, StepSelection
+from mechanical_markdown.trace import tracer
 
 
 class Recipe:
-    def __init__(self, markdown, shell='bash -c'):
-        parser = RecipeParser(shell)
+    def __init__(self, markdown, shell='bash -c', filename=None, cwd=None, env=None):
+        """Parse markdown, whose steps run in cwd with env, the working directory and a snapshot of the environment
+        of the process by default. filename and the relative paths of the steps are relative to cwd. Pass the same
+        env to all recipes of a run to share one snapshot between them.
+        """
+        self.filename = filename
+        self.cwd = os.getcwd() if cwd is None else cwd
+        self.env = dict(os.environ) if env is None else env
+        parser = RecipeParser(shell, source=markdown, cwd=self.cwd, env=self.env)
         md = Markdown(parser)
-        md(markdown)
-        if parser.current_step is not None:
-            raise MarkdownAnnotationError(f'Reached end of input searching for <!-- {end_token} -->')
-        if parser.ignore_links:
-            raise MarkdownAnnotationError(f'Reached end of input searching for <!-- {end_ignore_links_token} -->')
+        try:
+            with tracer.span('parse', 'recipe'):
+                md(markdown)
+            if parser.current_step is not None:
+                raise MarkdownAnnotationError(f'Reached end of input searching for <!-- {end_token} -->',
+                                              parser.current_step.line)
+            if parser.ignore_links:
+                raise MarkdownAnnotationError(f'Reached end of input searching for <!-- {end_ignore_links_token} -->',
+                                              parser.ignore_links_line)
+            self.step_index = StepIndex(parser.all_steps)
+        except MarkdownAnnotationError as e:
+            e.filename = filename
+            raise
         self.all_steps = parser.all_steps
         self.external_links = parser.external_links
+        self.local_links = parser.local_links
+        self.anchors = unique_anchors(parser.headings) | set(html_anchor.findall(markdown))
+
+    def execute_steps(self, manual, validate_links=False, link_retries=3, tags=[], validate_local_links=False):
+        report = io.StringIO()
+        success = self.run(manual, [TerminalWriter(report)], validate_links=validate_links,
+                           link_retries=link_retries, tags=tags, validate_local_links=validate_local_links)
+        return success, report.getvalue()
+
+    def run(self, manual, writers, validate_links=False, link_retries=3, tags=[], live=None,
+            validate_local_links=False, heading_index=None, link_checker=None, record_dir=None, replay_dir=None,
+            update_golden=False, isolate=False, selection=None, deadline=None, capacity=None):
+        """Run the steps and hand a StepResult/LinkResult to every writer as soon as each one is available.
+
+        Step results are reported in document order. A step is reported as soon as it and every step
+        before it has finished, so a background step that is still running holds back the ones after it.
+        If live is a LivePrinter, command output is also printed line by line while the commands run.
+        Local links are resolved against heading_index, a HeadingIndex, and external links are checked with
+        link_checker, a LinkChecker. Both can be shared between recipes. External links are checked in the
+        background while the steps run, and reported after them.
+        With record_dir, the results of all commands are saved to a cassette in that directory. With replay_dir,
+        the commands aren't run at all, their results are read from the cassette recorded there instead.
+        With update_golden, the expected_stdout_file/expected_stderr_file of every step are overwritten with
+        the actual output before it is validated. With isolate, the steps run in a private copy of the working
+        directory, which is removed afterwards.
+        Only the steps matching the tag expressions in tags run, or those picked by selection, a StepSelection,
+        if given. A SelectionError is raised if selection names steps the recipe doesn't have.
+        With deadline, a Deadline, no command runs past it. Once it is reached, the steps that haven't started are
+        reported as skipped and the run fails. Steps only start once the resources they declare fit in capacity, a
+        Capacity, which defaults to the size of the machine. A step needing resources held by a running background
+        step of the same recipe fails right away, along with the steps after it, instead of waiting for it.
+        """
+        if selection is None:
+            selection = StepSelection(tags)
+        selection.check([self])
+
+        if validate_links:
+            # Links don't depend on the steps, check them while the steps run
+            if link_checker is None:
+                link_checker = LinkChecker(link_retries)
+            link_checker.start(self.external_links)
+
+        success = self.run_steps(manual, writers, tags, live, record_dir, replay_dir, update_golden, isolate,
+                                 selection=selection, deadline=deadline, capacity=capacity)
+
+        if validate_links and not self.validate_links(writers, link_retries, link_checker):
+            success = False
+
+        if validate_local_links and not self.validate_local_links(writers, heading_index):
+            success = False
+
+        for writer in writers:
+            writer.close(success)
+
+        return success
+
+    def run_steps(self, manual, writers, tags=[], live=None, record_dir=None, replay_dir=None, update_golden=False,
+                  isolate=False, fixtures=None, selection=None, deadline=None, capacity=None):
+        """Run the steps, see run(). With isolate, all steps run in a private copy of the working directory.
+
+        fixtures is the FixtureRegistry of a run of several recipes, which starts and stops fixture steps.
+        capacity is the Capacity shared by recipes running in parallel, steps only start once their resources
+        are free. A recipe running on its own gets a Capacity of the size of the machine.
+        """
+        if capacity is None:
+            capacity = Capacity()
+        hooks.emit('recipe_started', self.filename)
+        player = None if replay_dir is None else Cassette.load(Cassette.path_for(replay_dir, self.filename))
+        recorder = None if record_dir is None else Cassette(Cassette.path_for(record_dir, self.filename))
+        # Ports, temporary directories and unique names substituted for placeholders, until this run is over
+        resources = Resources()
+        isolated = None
+        try:
+            # Fixture steps are run, with their own placeholders, by the registry
+            steps_to_run = [step if fixtures is not None and fixtures.owns(step) else step.bind(resources)
+                            for step in (selection or StepSelection(tags)).select(self)]
+            if isolate and player is None:
+                with tracer.span('isolate', 'recipe'):
+                    isolated = IsolatedDirectory(self.cwd)
+                for step in steps_to_run:
+                    if fixtures is not None and fixtures.owns(step):
+                        continue
+                    step.working_dir = isolated.map(step.working_dir)
+                    for command in step.commands:
+                        command.cwd = isolated.map(command.cwd)
+
+            success = self.run_filtered_steps(steps_to_run, manual, writers, live, player, recorder, update_golden,
+                                              fixtures, deadline, capacity)
+        finally:
+            capacity.release_all(self)
+            if isolated is not None:
+                isolated.cleanup()
+            resources.release()
+
+        if recorder is not None:
+            recorder.save()
+        hooks.emit('recipe_finished', self.filename, success)
+        return success
+
+    def run_filtered_steps(self, steps_to_run, manual, writers, live, player, recorder, update_golden, fixtures=None,
+                           deadline=None, capacity=None):
+        def remaining(start):
+            # Fixture steps are run, and reported, by the registry
+            return [step for step in steps_to_run[start:] if fixtures is None or not fixtures.owns(step)]
+
+        # Background steps keep their resources until their commands have finished. They are released right
+        # then, by a thread of their own, so that they are free again even while the recipe waits for others.
+        releasers = {}
+
+        def release_when_finished(step):
+            for command in step.commands:
+                command.wait()
+            capacity.release(self, step.resource_costs)
+
+        def report(step):
+            if step in releasers:
+                releasers.pop(step).join()
+            return self.report_step(step, writers, recorder, update_golden)
+
+        def blocked(step, costs):
+            # Waiting is pointless if the resources are held by background steps, or fixtures, of this recipe:
+            # those may well run until the recipe is done, e.g. a server waiting for the steps talking to it
+            running = fixtures.running(step) if fixtures is not None else []
+            if capacity.fits_beside([self] + running, costs):
+                return None
+            holders = [f"background step '{held.name}' of the same recipe" for held in releasers
+                       if not held.is_finished() and len(set(held.resource_costs) & set(costs))]
+            holders += [f"fixture '{fixture.name}'" for fixture in running
+                        if len(set(fixture.setup.resource_costs) & set(costs))]
+            if len(holders) == 0:
+                return None
+            return f"Step '{step.name}' needs resources held by {', '.join(holders)}"
+
+        with tracer.span('execute_steps', 'recipe'):
+            success = True
+            pending = deque()
+            skipped = []
+            skip_reason = None
+
+            for idx, step in enumerate(steps_to_run):
+                if deadline is not None and deadline.reached():
+                    success = False
+                    skipped, skip_reason = remaining(idx), deadline.reason
+                    break
+                if fixtures is not None:
+                    reason = blocked(step, fixtures.costs(step)) if capacity is not None else None
+                    if reason is not None:
+                        success = False
+                        skipped, skip_reason = [step] + remaining(idx + 1), reason
+                        break
+                    if not fixtures.prepare(step, writers):
+                        success = False
+                        pending.extend(remaining(idx))
+                        break
+                    if fixtures.owns(step):
+                        continue
+                if capacity is not None and player is None:
+                    with tracer.span(step.name, 'resources'):
+                        if not capacity.try_acquire(self, step.resource_costs):
+                            reason = blocked(step, step.resource_costs)
+                            if reason is not None:
+                                success = False
+                                skipped, skip_reason = remaining(idx), reason
+                                break
+                            if not capacity.acquire(self, step.resource_costs, deadline):
+                                success = False
+                                skipped, skip_reason = remaining(idx), deadline.reason
+                                break
+                pending.append(step)
+                hooks.emit('step_started', step.name)
+                with tracer.span(step.name, 'step'):
+                    if player is not None:
+                        step_success = step.replay(player.recording_for(step))
+                    else:
+                        step_success = step.run_all_commands(manual, live, deadline)
+                if capacity is not None and player is None:
+                    if step.background and len(step.resource_costs):
+                        releasers[step] = Thread(target=release_when_finished, args=(step,))
+                        releasers[step].start()
+                    else:
+                        capacity.release(self, step.resource_costs)
+                while len(pending) and pending[0].is_finished():
+                    if not report(pending.popleft()):
+                        success = False
+                if not step_success:
+                    success = False
+                    if deadline is not None and deadline.reached():
+                        skipped, skip_reason = remaining(idx + 1), deadline.reason
+                    else:
+                        # Steps that never ran are still reported, along with the output they expected
+                        pending.extend(remaining(idx + 1))
+                    break
+
+            while len(pending):
+                if not report(pending.popleft()):
+                    success = False
 
-    def execute_steps(self, manual, validate_links=False, link_retries=3, tags=[]):
+            for step in skipped:
+                self.report_skipped(step, skip_reason, writers)
+
+        return success
+
+    @classmethod
+    def report_step(cls, step, writers, recorder=None, update_golden=False):
         success = True
-        report = ""
-        stepsToRun = list(filter(lambda step: self.filter_steps(tags, step), self.all_steps))
-        for step in stepsToRun:
-            if not step.run_all_commands(manual):
+        with tracer.span(step.name, 'wait'):
+            if not step.wait_for_all_background_commands():
                 success = False
-                break
+        step.finish_isolation()
+        if recorder is not None:
+            recorder.record(step)
+        if update_golden:
+            step.update_expected_files()
 
-        for step in stepsToRun:
-            if not step.wait_for_all_background_commands():
+        with tracer.span(step.name, 'validate'):
+            result = step.validate()
+        if not result.success:
+            success = False
+
+        hooks.emit('step_finished', result)
+        for writer in writers:
+            writer.step_finished(result)
+        return success
+
+    @classmethod
+    def report_skipped(cls, step, reason, writers):
+        result = StepResult(step.name, [], [], skipped=reason)
+        hooks.emit('step_finished', result)
+        for writer in writers:
+            writer.step_finished(result)
+
+    def validate_links(self, writers, link_retries=3, link_checker=None):
+        if link_checker is None:
+            link_checker = LinkChecker(link_retries)
+        success = True
+        for writer in writers:
+            writer.links_started()
+        for link, ignore in self.external_links:
+            result = link_checker.result(link, ignore)
+            if not result.success:
                 success = False
+            hooks.emit('link_checked', result)
+            for writer in writers:
+                writer.link_checked(result)
+        return success
+
+    def validate_local_links(self, writers, heading_index=None):
+        # Without a filename, links are relative to the working directory, like the commands of the steps
+        path = os.path.join(self.cwd, self.filename or '<markdown>')
+        if heading_index is None:
+            heading_index = HeadingIndex(self.cwd)
+        heading_index.add(path, self.anchors)
 
-            s, r = step.validate_and_report()
-            if not s:
+        success = True
+        for writer in writers:
+            writer.local_links_started()
+        for link, ignore in self.local_links:
+            if ignore:
+                result = LinkResult(link, "Ignored", ignored=True, local=True)
+            else:
+                with tracer.span(link, 'link'):
+                    result = heading_index.check(link, path)
+            if not result.success:
                 success = False
-            report += r
+            hooks.emit('link_checked', result)
+            for writer in writers:
+                writer.link_checked(result)
+        return success
 
-        if validate_links:
-            report += "\nExternal link validation:\n"
-            for link, ignore in self.external_links:
-                if ignore:
-                    report += f'\t{link} Status: {colored("Ignored", "yellow")}\n'
-                    continue
-                retries = link_retries
-                while retries > 0:
-                    try:
-                        response = requests.get(link)
-                        if response.status_code >= 400:
-                            retries -= 1
-                            if retries == 0:
-                                success = False
-                                report += f'\t{link} Status: {colored(response.status_code, "red")}\n'
-                        else:
-                            report += f'\t{link} Status: {colored(response.status_code, "green")}\n'
-                            break
-                    except requests.exceptions.ConnectionError:
-                        retries -= 1
-                        if retries == 0:
-                            success = False
-                            report += f'\t{link} Status: {colored("Connection Failed", "red")}\n'
-                    sleep(0.5)
-
-        return success, report
-
-    def dryrun(self):
+    def filter_steps(self, tags, step):
+        """True if the tags of step match the tag expressions in tags. Steps without tags always match."""
+        return StepSelection(tags).matches(step)
+
+    def dryrun(self, selection=None):
         retstr = ""
-        for step in self.all_steps:
+        for step in self.all_steps if selection is None else selection.select(self):
             retstr += step.dryrun()
 
         return retstr
 
-    def filter_steps(self, tags, step):
-        if len(tags) == 0 or len(step.tags) == 0:
-            return True
 
-        for tag in tags:
-            if tag in step.tags:
-                return True
+def run_recipes(recipes, manual, writers, validate_links=False, link_retries=3, tags=[], live=None,
+                validate_local_links=False, record_dir=None, replay_dir=None, update_golden=False, isolate=False,
+                jobs=1, shared_fixtures=(), link_checker=None, selection=None, deadline=None, capacity=None):
+    """Run the steps of several recipes and validate the links of all of them in one stage.
+
+    Every unique external URL is checked once, however many recipes link to it, and its result is reported
+    for every occurrence that isn't ignored. Links are checked in the background while the steps run, their
+    results are reported once all steps have finished. Writers are told which recipe results belong to.
+    With jobs > 1, up to jobs recipes run at the same time; their results are still reported one recipe
+    after another, in order. Use isolate for recipes that would otherwise trample each other's files.
+    Fixtures, declared by the recipes or by the recipes in shared_fixtures, are started once and torn down
+    after the last recipe using them has finished, see FixtureRegistry. Pass a link_checker to reuse the
+    results of an earlier run. selection, a StepSelection, picks the steps to run in every recipe instead of tags,
+    a step name only has to be found in one of the recipes. deadline, a Deadline, is shared by all recipes and
+    fixtures, see Recipe.run(). Steps of recipes running in parallel, fixtures included, only start once the
+    resources they declare fit in capacity, a Capacity, which defaults to the size of the machine.
+    """
+    if selection is None:
+        selection = StepSelection(tags)
+    selection.check(recipes)
+    success = True
+    if link_checker is None:
+        link_checker = LinkChecker(link_retries)
+    if validate_links:
+        link_checker.start(link for recipe in recipes for link in recipe.external_links)
+    # Nothing is started when replaying, fixture steps are replayed like any other step
+    if capacity is None:
+        capacity = Capacity()
+    fixtures = FixtureRegistry(recipes, shared_fixtures, deadline, isolate, capacity) if replay_dir is None else None
+
+    def run_steps(recipe, recipe_writers):
+        recipe_success = recipe.run_steps(manual, recipe_writers, tags, live, record_dir, replay_dir, update_golden,
+                                          isolate, fixtures, selection, deadline, capacity)
+        if fixtures is not None and not fixtures.release(recipe, recipe_writers):
+            recipe_success = False
+        return recipe_success
+
+    if jobs > 1 and len(recipes) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='recipe') as pool:
+            buffers = [BufferingWriter() for _ in recipes]
+            futures = [pool.submit(run_steps, recipe, [buffer]) for recipe, buffer in zip(recipes, buffers)]
+            for recipe, buffer, future in zip(recipes, buffers, futures):
+                recipe_success = future.result()
+                for writer in writers:
+                    writer.file_started(recipe.filename)
+                buffer.flush(writers)
+                if not recipe_success:
+                    success = False
+    else:
+        for recipe in recipes:
+            for writer in writers:
+                writer.file_started(recipe.filename)
+            if not run_steps(recipe, writers):
+                success = False
+
+    if validate_links or validate_local_links:
+        heading_index = HeadingIndex(recipes[0].cwd if len(recipes) else None)
+        for recipe in recipes:
+            for writer in writers:
+                writer.file_started(recipe.filename)
+            if validate_links and not recipe.validate_links(writers, link_retries, link_checker):
+                success = False
+            if validate_local_links and not recipe.validate_local_links(writers, heading_index):
+                success = False
+
+    for writer in writers:
+        writer.close(success)
 
-        return False
+    return success
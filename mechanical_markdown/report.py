@@ -0,0 +1,598 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+"""
+
+import json
+import re
+
+from array import array
+from bisect import bisect_right
+from collections.abc import Sequence
+from termcolor import colored
+from xml.sax.saxutils import escape, quoteattr
+
+newline = re.compile("\n")
+
+
+class OutputLines(Sequence):
+    """The lines of the output of several commands, without a copy of each line.
+
+    The lines are those of "\n".join(texts).split("\n"), the same as splitting every text and concatenating
+    the results. Only the offset each line starts at is kept, lines are sliced out of the texts when they
+    are accessed. times, if given, holds the time.monotonic() timestamps of the lines of every text.
+    """
+
+    __slots__ = ('texts', 'times', '_bases', '_first_lines', '_starts')
+
+    def __init__(self, texts, times=None):
+        self.texts = list(texts)
+        self.times = times
+        self._starts = None
+
+    def _index(self):
+        if self._starts is None:
+            # Offsets into the joined text, which is never built
+            self._bases = []
+            self._first_lines = []
+            starts = array('q')
+            base = 0
+            for text in self.texts:
+                self._bases.append(base)
+                self._first_lines.append(len(starts))
+                starts.append(base)
+                starts.extend(base + m.end() for m in newline.finditer(text))
+                base += len(text) + 1
+            self._starts = starts
+        return self._starts
+
+    def _span(self, idx):
+        """The index of the text holding line idx, and where the line starts and ends in it."""
+        starts = self._index()
+        chunk = bisect_right(self._bases, starts[idx]) - 1
+        base = self._bases[chunk]
+        end = starts[idx + 1] - 1 if idx + 1 < len(starts) else base + len(self.texts[chunk])
+        return chunk, starts[idx] - base, end - base
+
+    def __len__(self):
+        return len(self._index())
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('line index out of range')
+        chunk, start, end = self._span(idx)
+        return self.texts[chunk][start:end]
+
+    def __iter__(self):
+        # Much faster than indexing every line, only one text is split at a time
+        for text in self.texts:
+            yield from text.split("\n")
+
+    def __eq__(self, other):
+        if not isinstance(other, Sequence):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return f"OutputLines({list(self)!r})"
+
+    def line_time(self, idx):
+        """The timestamp of line idx, or None if it isn't known."""
+        if self.times is None:
+            return None
+        chunk, _, _ = self._span(idx)
+        times = self.times[chunk]
+        line = idx - self._first_lines[chunk]
+        return times[line] if line < len(times) else None
+
+    def find(self, expected, exact=True, skip=()):
+        """Index of the first line not in skip that is (or, unless exact, contains) expected, or -1."""
+        starts = self._index()
+        for chunk, text in enumerate(self.texts):
+            base = self._bases[chunk]
+            position = 0
+            while True:
+                position = text.find(expected, position)
+                if position < 0:
+                    break
+                idx = bisect_right(starts, base + position) - 1
+                _, start, end = self._span(idx)
+                found_end = position + len(expected)
+                matched = found_end <= end if not exact else position == start and found_end == end
+                if matched and idx not in skip:
+                    return idx
+                # A line matches where expected is first found in it or not at all, go on with the next one
+                if end >= len(text):
+                    break
+                position = end + 1
+        return -1
+
+    def joined(self):
+        """The lines of "".join(texts), like its splitlines(), without building it. For whole files of output."""
+        partial = ""
+        for text in self.texts:
+            lines = text.split("\n")
+            lines[0] = partial + lines[0]
+            partial = lines.pop()
+            yield from lines
+        if partial:
+            yield partial
+
+
+class CommandResult:
+    __slots__ = ('command', 'return_code', 'expected_return_code', 'duration_seconds', 'resource_usage',
+                 'max_cpu_seconds', 'max_rss_mb', 'attempts')
+
+    def __init__(self, command, return_code, expected_return_code, duration_seconds,
+                 resource_usage=None, max_cpu_seconds=None, max_rss_mb=None, attempts=None):
+        self.command = command
+        self.return_code = return_code
+        self.expected_return_code = expected_return_code
+        self.duration_seconds = duration_seconds
+        self.resource_usage = resource_usage
+        self.max_cpu_seconds = max_cpu_seconds
+        self.max_rss_mb = max_rss_mb
+        # return_code, duration_seconds, stdout and stderr of the attempts before the last one, if it was retried
+        self.attempts = attempts or []
+
+    @property
+    def flaky(self):
+        """True if the command only succeeded after being retried."""
+        return len(self.attempts) > 0 and self.success
+
+    @property
+    def cpu_seconds(self):
+        if self.resource_usage is None:
+            return None
+        return self.resource_usage['user_cpu_seconds'] + self.resource_usage['system_cpu_seconds']
+
+    @property
+    def cpu_exceeded(self):
+        return self.max_cpu_seconds is not None and self.cpu_seconds is not None \
+            and self.cpu_seconds > self.max_cpu_seconds
+
+    @property
+    def rss_exceeded(self):
+        return self.max_rss_mb is not None and self.resource_usage is not None \
+            and self.resource_usage['max_rss_mb'] > self.max_rss_mb
+
+    @property
+    def return_code_matched(self):
+        return self.expected_return_code is None or self.return_code == self.expected_return_code
+
+    @property
+    def success(self):
+        return self.return_code_matched and not self.cpu_exceeded and not self.rss_exceeded
+
+    def to_dict(self):
+        return {
+            'command': self.command,
+            'return_code': self.return_code,
+            'expected_return_code': self.expected_return_code,
+            'duration_seconds': self.duration_seconds,
+            'resource_usage': self.resource_usage,
+            'attempts': self.attempts,
+            'flaky': self.flaky,
+            'success': self.success,
+        }
+
+
+class OutputResult:
+    """The outcome of matching the expected lines of one stream (stdout or stderr) against the actual output."""
+
+    __slots__ = ('stream', 'match_mode', 'match_order', 'expected_lines', 'actual_lines', 'matches', 'line_times',
+                 'max_latencies', 'expected_file', 'expected_file_diff')
+
+    def __init__(self, stream, match_mode, match_order, expected_lines, actual_lines, matches,
+                 line_times=None, max_latencies=None, expected_file=None, expected_file_diff=None):
+        self.stream = stream
+        self.match_mode = match_mode
+        self.match_order = match_order
+        self.expected_lines = expected_lines
+        self.actual_lines = actual_lines
+        # For every expected line, the index into actual_lines where it was found, or None
+        self.matches = matches
+        # For every actual line, or a dict with at least the matched ones, the seconds between the start of the
+        # step and the line being read, or None
+        self.line_times = line_times if line_times is not None else [None] * len(actual_lines)
+        # For every expected line, the max_latency_seconds it has to be found within, or None
+        self.max_latencies = max_latencies if max_latencies is not None else [None] * len(expected_lines)
+        # The file the whole output was compared to, and the unified diff lines if it didn't match
+        self.expected_file = expected_file
+        self.expected_file_diff = expected_file_diff
+
+    @property
+    def found_indices(self):
+        """Index into actual_lines of every expected line that was found, in the order they were expected."""
+        return [idx for idx in self.matches if idx is not None]
+
+    @property
+    def not_found(self):
+        return [expected for expected, idx in zip(self.expected_lines, self.matches) if idx is None]
+
+    @property
+    def out_of_order(self):
+        found_indices = self.found_indices
+        return self.match_order == 'sequential' and sorted(found_indices) != found_indices
+
+    @property
+    def latencies(self):
+        """(expected line, seconds until it was found, seconds since the previous match, max_latency_seconds)
+
+        for every expected line that was found and has a timestamp, in the order they were expected.
+        """
+        latencies = []
+        previous = None
+        for expected, idx, max_latency in zip(self.expected_lines, self.matches, self.max_latencies):
+            if idx is None or self.line_times[idx] is None:
+                continue
+            seconds = self.line_times[idx]
+            latencies.append((expected, seconds, None if previous is None else seconds - previous, max_latency))
+            previous = seconds
+        return latencies
+
+    @property
+    def latency_exceeded(self):
+        return [(expected, seconds, max_latency) for expected, seconds, _, max_latency in self.latencies
+                if max_latency is not None and seconds > max_latency]
+
+    @property
+    def success(self):
+        return not self.out_of_order and len(self.not_found) == 0 and len(self.latency_exceeded) == 0 \
+            and self.expected_file_diff is None
+
+    def to_dict(self):
+        return {
+            'match_mode': self.match_mode,
+            'match_order': self.match_order,
+            'expected_lines': self.expected_lines,
+            'actual_lines': list(self.actual_lines),
+            'matched_lines': sorted(self.found_indices),
+            'not_found': self.not_found,
+            'out_of_order': self.out_of_order,
+            'latencies': [{'line': expected, 'seconds': seconds, 'since_previous_match': since_previous,
+                           'max_latency_seconds': max_latency}
+                          for expected, seconds, since_previous, max_latency in self.latencies],
+            'expected_file': self.expected_file,
+            'expected_file_diff': self.expected_file_diff,
+            'success': self.success,
+        }
+
+
+class StepResult:
+    __slots__ = ('name', 'commands', 'outputs', 'skipped')
+
+    def __init__(self, name, commands, outputs, skipped=None):
+        self.name = name
+        self.commands = commands
+        self.outputs = outputs
+        # Why the step wasn't run at all, if it wasn't
+        self.skipped = skipped
+
+    @property
+    def duration_seconds(self):
+        return sum(c.duration_seconds for c in self.commands)
+
+    @property
+    def success(self):
+        return self.skipped is None and all(c.success for c in self.commands) and all(o.success for o in self.outputs)
+
+    @property
+    def flaky(self):
+        """True if the step passed, but only because some of its commands were retried."""
+        return self.success and any(c.flaky for c in self.commands)
+
+    def to_dict(self):
+        result = {
+            'type': 'step',
+            'name': self.name,
+            'success': self.success,
+            'flaky': self.flaky,
+            'skipped': self.skipped,
+            'duration_seconds': self.duration_seconds,
+            'commands': [c.to_dict() for c in self.commands],
+        }
+        for output in self.outputs:
+            result[output.stream] = output.to_dict()
+        return result
+
+
+class LinkResult:
+    __slots__ = ('url', 'status', 'ignored', 'local')
+
+    def __init__(self, url, status, ignored=False, local=False):
+        self.url = url
+        # External links: either the HTTP status code of the last attempt or a string describing why there isn't one
+        # Local links: "Found", "File not found" or "Anchor not found"
+        self.status = status
+        self.ignored = ignored
+        self.local = local
+
+    @property
+    def success(self):
+        if self.local:
+            return self.ignored or self.status == "Found"
+        return self.ignored or (isinstance(self.status, int) and self.status < 400)
+
+    def to_dict(self):
+        return {'type': 'link', 'url': self.url, 'status': self.status, 'ignored': self.ignored,
+                'local': self.local, 'success': self.success}
+
+
+class ReportWriter:
+    """Base class for report writers. Results are handed to the writer as soon as they are available."""
+
+    def file_started(self, filename):
+        """The results that follow belong to the recipe read from filename. Only called when running several."""
+        pass
+
+    def step_finished(self, result):
+        pass
+
+    def links_started(self):
+        pass
+
+    def local_links_started(self):
+        pass
+
+    def link_checked(self, result):
+        pass
+
+    def close(self, success):
+        pass
+
+
+class BufferingWriter(ReportWriter):
+    """Holds on to step results until flush() hands them to other writers, e.g. for recipes run in parallel."""
+
+    def __init__(self):
+        self.results = []
+
+    def step_finished(self, result):
+        self.results.append(result)
+
+    def flush(self, writers):
+        results, self.results = self.results, []
+        for result in results:
+            for writer in writers:
+                writer.step_finished(result)
+
+
+class TerminalWriter(ReportWriter):
+    """Writes the human readable, optionally colored, report to a text stream."""
+
+    def __init__(self, stream, color=True):
+        self.stream = stream
+        self.color = color
+
+    def colored(self, text, color):
+        if not self.color or color is None:
+            return str(text)
+        return colored(text, color)
+
+    def write(self, text):
+        self.stream.write(text)
+        self.stream.flush()
+
+    def file_started(self, filename):
+        self.write("\nFile: {}\n".format(filename))
+
+    def step_finished(self, result):
+        self.write(self.format_step(result))
+
+    def links_started(self):
+        self.write("\nExternal link validation:\n")
+
+    def local_links_started(self):
+        self.write("\nLocal link validation:\n")
+
+    def link_checked(self, result):
+        if result.ignored:
+            status = self.colored("Ignored", "yellow")
+        else:
+            status = self.colored(result.status, "green" if result.success else "red")
+        self.write(f'\t{result.url} Status: {status}\n')
+
+    def format_step(self, result):
+        lines = []
+        if result.name != "":
+            lines.append("Step: {}\n".format(result.name))
+        if result.skipped is not None:
+            lines.append(self.colored(f"\tSKIPPED: {result.skipped}", 'yellow') + "\n")
+
+        for c in result.commands:
+            color = 'green'
+            if c.expected_return_code is None:
+                color = 'yellow'
+            elif not c.return_code_matched:
+                color = 'red'
+            lines.append(f"\tcommand: `{c.command}`\n")
+            lines.append(f"\treturn_code: {self.colored(c.return_code, color)}\n")
+            lines.append(f"\tduration_seconds: {c.duration_seconds:.{3}}\n")
+            if len(c.attempts):
+                flaky = self.colored(" (flaky)", 'yellow') if c.flaky else ""
+                lines.append(f"\tattempts: {len(c.attempts) + 1}{flaky}\n")
+                for idx, attempt in enumerate(c.attempts):
+                    lines.append(f"\t\tattempt {idx + 1}: return_code: {self.colored(attempt['return_code'], 'red')}, "
+                                 f"duration_seconds: {attempt['duration_seconds']:.{3}}\n")
+            if c.resource_usage is not None:
+                lines.append(self.format_resource_usage(c))
+
+        for output in result.outputs:
+            lines.append(self.format_output(output))
+
+        return "".join(lines)
+
+    def format_resource_usage(self, c):
+        usage = c.resource_usage
+
+        def threshold_color(threshold, exceeded):
+            if threshold is None:
+                return None
+            return 'red' if exceeded else 'green'
+
+        lines = [
+            "\tcpu_seconds: {} (user: {:.3f}, system: {:.3f})\n".format(
+                self.colored(f"{c.cpu_seconds:.3f}", threshold_color(c.max_cpu_seconds, c.cpu_exceeded)),
+                usage['user_cpu_seconds'], usage['system_cpu_seconds']),
+            "\tmax_rss_mb: {}\n".format(
+                self.colored(f"{usage['max_rss_mb']:.1f}", threshold_color(c.max_rss_mb, c.rss_exceeded))),
+            "\tblock_io_ops: {} in, {} out\n".format(usage['block_input_ops'], usage['block_output_ops']),
+            "\tcontext_switches: {} voluntary, {} involuntary\n".format(
+                usage['voluntary_context_switches'], usage['involuntary_context_switches']),
+        ]
+        if c.cpu_exceeded:
+            lines.append(self.colored(f"\tERROR command exceeded max_cpu_seconds: {c.max_cpu_seconds}", 'red') + "\n")
+        if c.rss_exceeded:
+            lines.append(self.colored(f"\tERROR command exceeded max_rss_mb: {c.max_rss_mb}", 'red') + "\n")
+        return "".join(lines)
+
+    def format_output(self, output):
+        lines = ["\tExpected {} (output_match_mode: {}, match_order: {}):\n".format(
+            output.stream, output.match_mode, output.match_order)]
+        for expected in output.expected_lines:
+            lines.append('\t\t' + expected + '\n')
+        lines.append("\tActual {}:\n".format(output.stream))
+
+        found = set(output.found_indices)
+        for idx, line in enumerate(output.actual_lines):
+            if idx in found:
+                lines.append("\t\t{}\n".format(self.colored(line, 'green')))
+            else:
+                lines.append("\t\t{}\n".format(line))
+
+        latencies = output.latencies
+        if len(latencies):
+            lines.append("\tExpected {} latency:\n".format(output.stream))
+            for expected, seconds, since_previous, max_latency in latencies:
+                since_previous = "" if since_previous is None else f" (+{since_previous:.3f}s)"
+                color = None
+                if max_latency is not None:
+                    color = 'red' if seconds > max_latency else 'green'
+                lines.append("\t\t{}{} {}\n".format(self.colored(f"{seconds:.3f}s", color), since_previous, expected))
+
+        if output.out_of_order:
+            lines.append(self.colored("\tERROR expected lines were not found in the correct order", 'red') + "\n")
+
+        if len(output.not_found):
+            lines.append(self.colored("\tERROR expected lines not found:", 'red') + "\n")
+            for line in output.not_found:
+                lines.append("\t\t" + self.colored(line, 'red') + "\n")
+
+        if output.expected_file is not None:
+            stream, path = output.stream, output.expected_file
+            if output.expected_file_diff is None:
+                lines.append("\tExpected {} file: {}\n".format(stream, self.colored(path, 'green')))
+            else:
+                lines.append(self.colored(f"\tERROR {stream} differs from {path}:", 'red') + "\n")
+                for line in output.expected_file_diff:
+                    color = {'+': 'green', '-': 'red', '@': 'cyan'}.get(line[:1])
+                    lines.append("\t\t" + self.colored(line, color) + "\n")
+
+        for expected, seconds, max_latency in output.latency_exceeded:
+            lines.append(self.colored(f"\tERROR expected line exceeded max_latency_seconds ({max_latency}):", 'red') +
+                         "\n\t\t" + self.colored(expected, 'red') + "\n")
+
+        return "".join(lines)
+
+
+class JSONLinesWriter(ReportWriter):
+    """Writes one JSON document per step and link, followed by a summary line."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.filename = None
+
+    def write(self, record):
+        self.stream.write(json.dumps(record) + "\n")
+        self.stream.flush()
+
+    def write_result(self, result):
+        record = result.to_dict()
+        if self.filename is not None:
+            record['file'] = self.filename
+        self.write(record)
+
+    def file_started(self, filename):
+        self.filename = filename
+
+    def step_finished(self, result):
+        self.write_result(result)
+
+    def link_checked(self, result):
+        self.write_result(result)
+
+    def close(self, success):
+        self.write({'type': 'summary', 'success': success})
+
+
+class JUnitXMLWriter(ReportWriter):
+    """Writes a JUnit XML report with one test case per step and link.
+
+    Test cases are written as they finish, the enclosing elements are closed by close(). Every file_started()
+    begins a new test suite named after the file.
+    """
+
+    def __init__(self, stream, suite_name='mechanical-markdown'):
+        self.stream = stream
+        self.suite_name = suite_name
+        self.suite_open = False
+        self.formatter = TerminalWriter(None, color=False)
+        self.write('<?xml version="1.0" encoding="utf-8"?>\n<testsuites>\n')
+
+    def write(self, text):
+        self.stream.write(text)
+        self.stream.flush()
+
+    def open_suite(self):
+        if not self.suite_open:
+            self.write(f'<testsuite name={quoteattr(self.suite_name)}>\n')
+            self.suite_open = True
+
+    def close_suite(self):
+        if self.suite_open:
+            self.write('</testsuite>\n')
+            self.suite_open = False
+
+    def file_started(self, filename):
+        self.close_suite()
+        self.suite_name = filename
+
+    def step_finished(self, result):
+        self.open_suite()
+        body = self.formatter.format_step(result)
+        case = (f'<testcase classname={quoteattr(self.suite_name)} name={quoteattr(result.name)} '
+                f'time="{result.duration_seconds:.3f}">\n')
+        if result.skipped is not None:
+            case += f'<skipped message={quoteattr(result.skipped)}/>\n'
+        elif not result.success:
+            case += f'<failure message="Step failed">{escape(body)}</failure>\n'
+        elif result.flaky:
+            # Surefire's way of reporting tests that passed after being rerun
+            for c in result.commands:
+                for attempt in c.attempts:
+                    message = f"`{c.command}` returned {attempt['return_code']}"
+                    case += (f'<flakyFailure message={quoteattr(message)}>'
+                             f'<system-out>{escape(attempt["stdout"])}</system-out>'
+                             f'<system-err>{escape(attempt["stderr"])}</system-err></flakyFailure>\n')
+        case += f'<system-out>{escape(body)}</system-out>\n</testcase>\n'
+        self.write(case)
+
+    def link_checked(self, result):
+        self.open_suite()
+        classname = self.suite_name + (".local_links" if result.local else ".links")
+        case = f'<testcase classname={quoteattr(classname)} name={quoteattr(result.url)}>\n'
+        if result.ignored:
+            case += '<skipped message="Ignored"/>\n'
+        elif not result.success:
+            case += f'<failure message={quoteattr("Status: " + str(result.status))}/>\n'
+        self.write(case + '</testcase>\n')
+
+    def close(self, success):
+        self.open_suite()
+        self.close_suite()
+        self.write('</testsuites>\n')
@@ -0,0 +1,70 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+"""
+
+import re
+import shutil
+import socket
+import tempfile
+import uuid
+
+from threading import Lock
+
+placeholder = re.compile(r'\$\{(PORT|TMPDIR|UNIQUE):([A-Za-z_][\w.-]*)\}')
+
+# Ports handed out to any recipe of this process that hasn't released them yet
+_allocated_ports = set()
+_allocated_ports_lock = Lock()
+
+
+def free_port():
+    """A port nothing listens on right now, that hasn't been handed out to another recipe of this run."""
+    with _allocated_ports_lock:
+        while True:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                s.bind(('127.0.0.1', 0))
+                port = s.getsockname()[1]
+            if port not in _allocated_ports:
+                _allocated_ports.add(port)
+                return port
+
+
+class Resources:
+    """Resolves ${PORT:name}, ${TMPDIR:name} and ${UNIQUE:name} placeholders for a run of a recipe.
+
+    Every name is allocated once, so all steps of a run referring to ${PORT:app} get the same port, while
+    another recipe, or another run of the same recipe, gets a different one. release() removes the temporary
+    directories and hands the ports back.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.ports = []
+        self.tempdirs = []
+
+    def allocate(self, kind, name):
+        key = (kind, name)
+        if key not in self.values:
+            if kind == 'PORT':
+                value = str(free_port())
+                self.ports.append(int(value))
+            elif kind == 'TMPDIR':
+                value = tempfile.mkdtemp(prefix=f'mm-{name}-')
+                self.tempdirs.append(value)
+            else:
+                value = f'{name}-{uuid.uuid4().hex[:8]}'
+            self.values[key] = value
+        return self.values[key]
+
+    def substitute(self, text):
+        return placeholder.sub(lambda m: self.allocate(m.group(1), m.group(2)), text)
+
+    def release(self):
+        for path in self.tempdirs:
+            shutil.rmtree(path, ignore_errors=True)
+        with _allocated_ports_lock:
+            _allocated_ports.difference_update(self.ports)
+        self.values = {}
+        self.ports = []
+        self.tempdirs = []
@@ -0,0 +1,208 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+"""
+
+import re
+
+from mechanical_markdown.parsers import MarkdownAnnotationError
+
+token = re.compile(r"""\s*(?:([()])|"([^"]*)"|'([^']*)'|([^\s()"']+))""")
+
+operators = ('and', 'or', 'not')
+
+
+class SelectionError(Exception):
+    pass
+
+
+class TagExpression:
+    """A boolean expression over tags, such as `setup and not (slow or windows)`.
+
+    `not` binds tighter than `and`, which binds tighter than `or`. A single word is always a plain tag, even
+    `and` or one with parentheses, like tags were before expressions. In an expression, tags like those are
+    quoted: `"db(local)" and not 'or'`.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        # (tag or operator, True if it is a tag) for every token
+        self._tokens = []
+        self._position = 0
+        text = text.strip()
+        if len(text) == 0:
+            raise SelectionError("Empty tag expression")
+        if len(text.split()) == 1 and text[0] not in "\"'":
+            self._select = self._tag(text)
+            return
+        position = 0
+        while position < len(text):
+            match = token.match(text, position)
+            if match is None:
+                self._error("unterminated quote")
+            if match.group(1) is not None:
+                self._tokens.append((match.group(1), False))
+            elif match.group(4) is not None:
+                self._tokens.append((match.group(4), match.group(4) not in operators))
+            else:
+                self._tokens.append((match.group(2) if match.group(2) is not None else match.group(3), True))
+            position = match.end()
+        self._select = self._or()
+        if self._position < len(self._tokens):
+            self._error(f"unexpected '{self._tokens[self._position][0]}'")
+
+    def _error(self, problem):
+        raise SelectionError(f"Invalid tag expression '{self.text}': {problem}")
+
+    def _next(self):
+        if self._position >= len(self._tokens):
+            self._error("unexpected end")
+        self._position += 1
+        return self._tokens[self._position - 1]
+
+    def _peek(self):
+        return self._tokens[self._position] if self._position < len(self._tokens) else (None, False)
+
+    def _or(self):
+        operands = [self._and()]
+        while self._peek() == ('or', False):
+            self._next()
+            operands.append(self._and())
+        if len(operands) == 1:
+            return operands[0]
+        return lambda index, everything: set().union(*(operand(index, everything) for operand in operands))
+
+    def _and(self):
+        operands = [self._not()]
+        while self._peek() == ('and', False):
+            self._next()
+            operands.append(self._not())
+        if len(operands) == 1:
+            return operands[0]
+        return lambda index, everything: set(everything).intersection(
+            *(operand(index, everything) for operand in operands))
+
+    def _not(self):
+        current, is_tag = self._next()
+        if is_tag:
+            return self._tag(current)
+        if current == 'not':
+            operand = self._not()
+            return lambda index, everything: everything - operand(index, everything)
+        if current == '(':
+            expression = self._or()
+            if self._next() != (')', False):
+                self._error("missing ')'")
+            return expression
+        self._error(f"unexpected '{current}'")
+
+    @staticmethod
+    def _tag(name):
+        return lambda index, everything: index.get(name, frozenset())
+
+    def select(self, index, everything):
+        """The positions matching the expression, given index, which maps tags to the positions tagged with them."""
+        return set(self._select(index, everything))
+
+
+class StepIndex:
+    """Positions of the steps of a recipe by name and by tag, and the steps each one needs to run first.
+
+    A step depends on the steps named in its depends_on, which have to come before it, and on the steps
+    starting and tearing down the fixtures it uses.
+    """
+
+    def __init__(self, steps):
+        self.everything = frozenset(range(len(steps)))
+        self.by_name = {}
+        self.by_tag = {}
+        self.untagged = set()
+        fixture_steps = {}
+        for position, step in enumerate(steps):
+            self.by_name.setdefault(step.name, []).append(position)
+            for tag in step.tags:
+                self.by_tag.setdefault(tag, set()).add(position)
+            if len(step.tags) == 0:
+                self.untagged.add(position)
+            for name in step.fixture, step.teardown_fixture:
+                if name is not None:
+                    fixture_steps.setdefault(name, []).append(position)
+
+        self.dependencies = {}
+        for position, step in enumerate(steps):
+            dependencies = set()
+            for name in step.depends_on:
+                if name not in self.by_name:
+                    raise MarkdownAnnotationError(f"Step '{step.name}' depends on '{name}', but there is no such step",
+                                                  step.line)
+                # Steps run in document order, a step coming later would only run after the one needing it
+                earlier = [dependency for dependency in self.by_name[name] if dependency < position]
+                if len(earlier) == 0:
+                    raise MarkdownAnnotationError(f"Step '{step.name}' depends on '{name}', which only comes after it",
+                                                  step.line)
+                dependencies.update(earlier)
+            for name in step.fixtures:
+                dependencies.update(fixture_steps.get(name, ()))
+            dependencies.discard(position)
+            self.dependencies[position] = dependencies
+
+    def closure(self, positions):
+        """positions and every step they depend on, directly or not."""
+        selected = set(positions)
+        pending = list(selected)
+        while len(pending):
+            for dependency in self.dependencies[pending.pop()]:
+                if dependency not in selected:
+                    selected.add(dependency)
+                    pending.append(dependency)
+        return selected
+
+
+class StepSelection:
+    """Which steps of a recipe to run.
+
+    A step is selected if it matches any of the tag expressions in tags. Steps without tags are shared by
+    everything and are selected by any expression, unless strict_tags is set. steps limits the selection to the
+    steps with those names, from_step and until_step to the steps from the first step called from_step and up to
+    the last step called until_step. The steps the selected steps depend on are run too, and nothing else.
+    """
+
+    def __init__(self, tags=(), steps=(), from_step=None, until_step=None, strict_tags=False):
+        self.expressions = [TagExpression(tag) for tag in tags]
+        self.strict_tags = strict_tags
+        self.steps = list(steps)
+        self.from_step = from_step
+        self.until_step = until_step
+
+    def check(self, recipes):
+        """Raise a SelectionError for step names that none of recipes has."""
+        names = set(name for recipe in recipes for name in recipe.step_index.by_name)
+        options = [('--step', name) for name in self.steps] + [('--from', self.from_step), ('--until', self.until_step)]
+        for option, name in options:
+            if name is not None and name not in names:
+                raise SelectionError(f"No step called '{name}' for {option}")
+
+    def matches(self, step):
+        """True if the tags of step match the tag expressions, whether or not it is selected otherwise."""
+        if len(self.expressions) == 0 or (len(step.tags) == 0 and not self.strict_tags):
+            return True
+        index = {tag: {0} for tag in step.tags}
+        return any(len(expression.select(index, frozenset([0]))) for expression in self.expressions)
+
+    def select(self, recipe):
+        """The steps of recipe to run, in document order."""
+        index = recipe.step_index
+        selected = set(index.everything)
+        if self.from_step is not None:
+            start = index.by_name.get(self.from_step, [len(recipe.all_steps)])[0]
+            selected = {position for position in selected if position >= start}
+        if self.until_step is not None:
+            end = index.by_name.get(self.until_step, [-1])[-1]
+            selected = {position for position in selected if position <= end}
+        if len(self.steps):
+            selected &= {position for name in self.steps for position in index.by_name.get(name, ())}
+        if len(self.expressions):
+            untagged = () if self.strict_tags else index.untagged
+            selected &= set(untagged).union(*(expression.select(index.by_tag, index.everything)
+                                              for expression in self.expressions))
+        return [recipe.all_steps[position] for position in sorted(index.closure(selected))]
@@ -4,11 +4,18 @@ Copyright (c) Microsoft Corporation.
 Licensed under the MIT License.
 """
 
+import difflib
+import io
+import itertools
 import os
+import re
 import time
 
+from collections import ChainMap
 from mechanical_markdown.command import Command
-from termcolor import colored
+from mechanical_markdown.hooks import hooks
+from mechanical_markdown.report import CommandResult, OutputLines, OutputResult, StepResult, TerminalWriter
+from mechanical_markdown.trace import tracer
 
 default_timeout_seconds = 300
 
@@ -16,32 +23,92 @@ VALID_MATCH_MODES = ('exact', 'substring')
 
 VALID_MATCH_ORDERS = ('sequential', 'none')
 
+VALID_STEP_KEYS = ('background', 'sleep', 'name', 'expected_stdout_lines', 'expected_stderr_lines',
+                   'expected_return_code', 'working_dir', 'timeout_seconds', 'env', 'manual_pause_message',
+                   'output_match_mode', 'match_order', 'tags', 'max_rss_mb', 'max_cpu_seconds',
+                   'expected_stdout_file', 'expected_stderr_file', 'isolate', 'fixture', 'teardown_fixture',
+                   'fixtures', 'retries', 'retry_backoff_seconds', 'retry_on_return_codes', 'depends_on',
+                   'resources')
+
+VALID_ISOLATE_VALUES = (False, True, 'collect')
+
+# Lines of a unified diff shown in the report when output doesn't match its expected file
+max_diff_lines = 50
+# Lines of the output and of the expected file read ahead from a mismatch, to find where they are back in sync
+diff_window_lines = 500
+hunk_header = re.compile(r"^@@ -(\d+)(,\d+)? \+(\d+)(,\d+)? @@$")
+
 
 class Step:
-    def __init__(self, parameters, shell):
-        self.observed_output = {
-            "stdout": "",
-            "stderr": ""
-        }
-        self.return_values = ""
+    # Large runs hold thousands of steps
+    __slots__ = ('commands', 'background', 'sleep', 'name', 'expected_lines', 'max_latencies', 'expected_files',
+                 'expect_return_code', 'working_dir', 'timeout', 'env', 'pause_message', 'match_mode',
+                 'match_order', 'tags', 'max_rss_mb', 'max_cpu_seconds', 'isolate', 'isolated', 'fixture',
+                 'teardown_fixture', 'fixtures', 'retries', 'retry_backoff_seconds', 'retry_on_return_codes',
+                 'depends_on', 'resource_costs', 'shell', 'cwd', 'base_env', 'line', 'template', 'skipped',
+                 'unknown_keys')
+
+    def __init__(self, parameters, shell, cwd=None, env=None):
         self.commands = []
         self.background = False if "background" not in parameters else parameters["background"]
         self.sleep = 0 if "sleep" not in parameters else parameters["sleep"]
         self.name = "" if "name" not in parameters else parameters["name"]
         self.expected_lines = {"stdout": [], "stderr": []}
-        if "expected_stdout_lines" in parameters and parameters["expected_stdout_lines"] is not None:
-            self.expected_lines['stdout'] = parameters["expected_stdout_lines"]
-        if "expected_stderr_lines" in parameters and parameters["expected_stderr_lines"] is not None:
-            self.expected_lines['stderr'] = parameters["expected_stderr_lines"]
+        self.max_latencies = {"stdout": [], "stderr": []}
+        for out in 'stdout', 'stderr':
+            if f"expected_{out}_lines" in parameters and parameters[f"expected_{out}_lines"] is not None:
+                self.expected_lines[out], self.max_latencies[out] = \
+                    Step.parse_expected_lines(parameters[f"expected_{out}_lines"])
+        self.expected_files = {out: parameters.get(f"expected_{out}_file") for out in ('stdout', 'stderr')}
         self.expect_return_code = 0 if "expected_return_code" not in parameters else parameters["expected_return_code"]
-        self.working_dir = os.getcwd() if "working_dir" not in parameters else parameters["working_dir"]
+        # The working directory and environment of the recipe, which relative paths are resolved against and
+        # the env of the step overrides
+        self.cwd = os.getcwd() if cwd is None else cwd
+        self.base_env = dict(os.environ) if env is None else env
+        self.working_dir = self.cwd if "working_dir" not in parameters \
+            else os.path.join(self.cwd, parameters["working_dir"])
         self.timeout = default_timeout_seconds if "timeout_seconds" not in parameters else parameters["timeout_seconds"]
-        self.env = dict(os.environ, **parameters['env']) if "env" in parameters else os.environ
+        self.env = self.base_env
+        if "env" in parameters:
+            # Values are often numbers, such as ports, but the environment of a process only holds strings.
+            # Only the overrides are stored, over the snapshot of the environment every step of the run shares.
+            self.env = ChainMap({key: str(value) for key, value in parameters['env'].items()}, self.base_env)
         self.pause_message = None if "manual_pause_message" not in parameters else parameters["manual_pause_message"]
         self.match_mode = 'exact' if "output_match_mode" not in parameters else parameters["output_match_mode"]
         self.match_order = "sequential" if "match_order" not in parameters else parameters["match_order"]
         self.tags = [] if "tags" not in parameters else parameters["tags"]
+        self.max_rss_mb = None if "max_rss_mb" not in parameters else parameters["max_rss_mb"]
+        self.max_cpu_seconds = None if "max_cpu_seconds" not in parameters else parameters["max_cpu_seconds"]
+        self.isolate = False if "isolate" not in parameters else parameters["isolate"]
+        # The IsolatedDirectory the commands run in while the step is running with isolate
+        self.isolated = None
+        self.fixture = None if "fixture" not in parameters else parameters["fixture"]
+        self.teardown_fixture = None if "teardown_fixture" not in parameters else parameters["teardown_fixture"]
+        self.fixtures = [] if "fixtures" not in parameters else parameters["fixtures"]
+        if isinstance(self.fixtures, str):
+            self.fixtures = [self.fixtures]
+        self.retries = 0 if "retries" not in parameters else parameters["retries"]
+        self.retry_backoff_seconds = 1 if "retry_backoff_seconds" not in parameters \
+            else parameters["retry_backoff_seconds"]
+        # Retry on any unexpected return code if None
+        self.retry_on_return_codes = None if "retry_on_return_codes" not in parameters \
+            else parameters["retry_on_return_codes"]
+        if isinstance(self.retry_on_return_codes, int):
+            self.retry_on_return_codes = [self.retry_on_return_codes]
+        # Names of the steps that have to run before this one when only some steps are selected
+        self.depends_on = [] if "depends_on" not in parameters else parameters["depends_on"]
+        if isinstance(self.depends_on, str):
+            self.depends_on = [self.depends_on]
+        # How much of every resource, such as cpus, memory_mb or a custom token, the step uses while it runs
+        self.resource_costs = {} if "resources" not in parameters else parameters["resources"]
         self.shell = shell
+        # Line of the STEP annotation in the markdown source, if known
+        self.line = None
+        # The STEP annotation, if it or the code blocks of the step have placeholders to substitute, see bind()
+        self.template = None
+        # Why the step was stopped before all of its commands had started, if it was
+        self.skipped = None
+        self.unknown_keys = [key for key in parameters if key not in VALID_STEP_KEYS]
 
         if self.match_mode not in VALID_MATCH_MODES:
             from mechanical_markdown.parsers import MarkdownAnnotationError
@@ -51,11 +118,71 @@ class Step:
             from mechanical_markdown.parsers import MarkdownAnnotationError
             raise MarkdownAnnotationError(f'match_order must be one of: {VALID_MATCH_ORDERS}')
 
-    def add_command_block(self, block):
-        self.commands.append(Command(block.strip(), self.working_dir, self.env, self.shell, self.timeout + self.sleep))
+        if self.isolate not in VALID_ISOLATE_VALUES:
+            from mechanical_markdown.parsers import MarkdownAnnotationError
+            raise MarkdownAnnotationError(f'isolate must be one of: {VALID_ISOLATE_VALUES}')
+
+        if not isinstance(self.retries, int) or self.retries < 0:
+            from mechanical_markdown.parsers import MarkdownAnnotationError
+            raise MarkdownAnnotationError(f'retries must be a number of retries, not: {self.retries}')
+
+        if not isinstance(self.resource_costs, dict) or \
+                not all(isinstance(amount, (int, float)) and amount >= 0 for amount in self.resource_costs.values()):
+            from mechanical_markdown.parsers import MarkdownAnnotationError
+            raise MarkdownAnnotationError(f'resources must map resource names to amounts, not: {self.resource_costs}')
+
+    @classmethod
+    def parse_expected_lines(cls, lines):
+        """Split expected lines into the lines themselves and their max_latency_seconds, if any.
+
+        An expected line is either a plain string or a mapping with a 'line' and an optional
+        'max_latency_seconds' key.
+        """
+        expected_lines = []
+        max_latencies = []
+        for line in lines:
+            if isinstance(line, dict):
+                if "line" not in line:
+                    from mechanical_markdown.parsers import MarkdownAnnotationError
+                    raise MarkdownAnnotationError(f"Expected line {line} is missing the 'line' key")
+                expected_lines.append(str(line["line"]))
+                max_latencies.append(line.get("max_latency_seconds"))
+            else:
+                # Lines such as a port number are parsed as numbers by YAML, but are matched against text
+                expected_lines.append(str(line))
+                max_latencies.append(None)
+        return expected_lines, max_latencies
+
+    def add_command_block(self, block, template=None):
+        """Add a command to run. template is the block before placeholders were substituted, if it had any."""
+        command = Command(block.strip(), self.working_dir, self.env, self.shell, self.timeout + self.sleep)
+        command.template = command.command if template is None else template.strip()
+        self.commands.append(command)
+
+    def bind(self, resources):
+        """The step to run, with the placeholders of its annotation and commands substituted from resources.
+
+        A step without placeholders is run as it is. Others are created again for every run from their
+        templates, so each run gets the ports and temporary directories resources, a Resources, allocates.
+        """
+        if self.template is None:
+            return self
+        import yaml
+        step = Step(yaml.safe_load(resources.substitute(self.template)) or {}, self.shell, self.cwd, self.base_env)
+        step.line = self.line
+        step.template = self.template
+        for command in self.commands:
+            step.add_command_block(resources.substitute(command.template), command.template)
+        return step
 
-    def run_all_commands(self, manual):
-        if manual and self.pause_message is not None:
+    def run_all_commands(self, manual, live=None, deadline=None):
+        """Start the commands, waiting for those that don't run in the background. False if one of them failed.
+
+        With deadline, a Deadline, commands don't run past it, and are no longer started once it is reached. The
+        step is then skipped, see validate(). A manual pause can't be bounded, so it isn't made with a deadline.
+        """
+        self.skipped = None
+        if manual and self.pause_message is not None and deadline is None:
             try:
                 while True:
                     if input(self.pause_message + "\nType 'x' to exit\n") == 'x':
@@ -63,15 +190,64 @@ class Step:
             except KeyboardInterrupt:
                 pass
 
-        for command in self.commands:
+        if self.isolate:
+            from mechanical_markdown.isolate import IsolatedDirectory
+            with tracer.span(self.name, 'isolate'):
+                self.isolated = IsolatedDirectory(self.working_dir)
+
+        for idx, command in enumerate(self.commands):
+            if live is not None:
+                command.line_callback = live.listener(self)
+            if self.isolated is not None:
+                command.cwd = self.isolated.map(command.cwd)
+            if deadline is not None:
+                if deadline.reached():
+                    never_started = ", ".join(f"`{c.command}`" for c in self.commands[idx:])
+                    self.skipped = f"{deadline.reason} before {never_started} started"
+                    return False
+                command.deadline = deadline
+                command.timeout = deadline.limit(command.timeout)
             command.start()
             if not self.background:
                 command.wait()
+                while self.should_retry(command) and (deadline is None or not deadline.reached()):
+                    backoff = self.retry_backoff_seconds * 2 ** len(command.attempts)
+                    with tracer.span('retry backoff', 'sleep', attempt=len(command.attempts) + 1):
+                        time.sleep(backoff if deadline is None else deadline.limit(backoff))
+                    command = self.commands[idx] = command.retry()
+                    if deadline is not None:
+                        command.timeout = deadline.limit(command.timeout)
+                    command.start()
+                    command.wait()
                 if self.expect_return_code is not None and command.return_code != self.expect_return_code:
                     return False
             if self.sleep:
-                time.sleep(self.sleep)
+                with tracer.span('sleep', 'sleep', seconds=self.sleep):
+                    time.sleep(self.sleep if deadline is None else deadline.limit(self.sleep))
+
+        return True
+
+    def should_retry(self, command):
+        """True if a command that has finished failed in a way worth another attempt."""
+        if self.expect_return_code is None or command.return_code == self.expect_return_code:
+            return False
+        if len(command.attempts) >= self.retries:
+            return False
+        return self.retry_on_return_codes is None or command.return_code in self.retry_on_return_codes
 
+    def replay(self, recordings):
+        """Like run_all_commands, but take the results of the commands from a cassette instead of running them."""
+        recordings = list(recordings)
+        step_start = time.monotonic()
+        for command in self.commands:
+            if len(recordings) == 0:
+                from mechanical_markdown.cassette import CassetteError
+                raise CassetteError(f"Command `{command.command}` of step '{self.name}' was never recorded, "
+                                    "record it again with --record")
+            command.replay(recordings.pop(0), step_start)
+            if not self.background and self.expect_return_code is not None \
+                    and command.return_code != self.expect_return_code:
+                return False
         return True
 
     def dryrun(self):
@@ -85,11 +261,23 @@ class Step:
             retstr += "\tExpected {}:\n".format(out)
             for expected in self.expected_lines[out]:
                 retstr += "\t\t{}\n".format(expected)
+            if self.expected_files[out] is not None:
+                retstr += "\tExpected {} file: {}\n".format(out, self.expected_files[out])
 
         retstr += "\tExpected return code: {}\n".format(self.expect_return_code)
+        if self.retries:
+            retstr += "\tRetries: {}\n".format(self.retries)
+        if self.depends_on:
+            retstr += "\tDepends on: {}\n".format(", ".join(self.depends_on))
+        if self.resource_costs:
+            costs = ", ".join(f"{name}={amount}" for name, amount in self.resource_costs.items())
+            retstr += "\tResources: {}\n".format(costs)
 
         return retstr + "\n"
 
+    def is_finished(self):
+        return not any(command.is_alive() for command in self.commands)
+
     def wait_for_all_background_commands(self):
         success = True
         for command in self.commands:
@@ -99,80 +287,150 @@ class Step:
                     success = False
         return success
 
-    @classmethod
-    def find_substring_in_list(cls, expected, lines):
-        for idx, line in enumerate(lines):
-            if expected in line:
-                return idx
-        return -1
+    def finish_isolation(self):
+        """Remove the private copy of the working directory, collecting its changes back first if asked to."""
+        if self.isolated is None:
+            return
+        if self.isolate == 'collect':
+            self.isolated.collect()
+        self.isolated.cleanup()
+        self.isolated = None
 
-    def validate_and_report(self):
-        success = True
-        report = ""
-        if self.name != "":
-            report += "Step: {}\n".format(self.name)
+    def match_line(self, expected, line):
+        if self.match_mode == 'substring':
+            return expected in line
+        return expected == line
 
-        for c in self.commands:
-            if c.process is not None:
-                color = 'green'
-                if self.expect_return_code is None:
-                    color = 'yellow'
-                elif c.return_code != self.expect_return_code:
-                    color = 'red'
-                report += f"\tcommand: `{c.command}`\n"
-                report += f"\treturn_code: {colored(c.return_code, color)}\n"
-                report += f"\tduration_seconds: {c.duration_seconds:.{3}}\n"
+    def compare_expected_file(self, path, actual_lines):
+        """Return a unified diff between the expected file at path and actual_lines, or None if they match.
 
-        for out in 'stdout', 'stderr':
-            report += "\tExpected {} (output_match_mode: {}, match_order: {}):\n".format(
-                out, self.match_mode, self.match_order)
-            for expected in self.expected_lines[out]:
-                report += '\t\t' + expected + '\n'
-            report += "\tActual {}:\n".format(out)
+        Both are streamed line by line. From a mismatch on, up to diff_window_lines of each side are read ahead
+        and diffed, to find where they are back in sync; the lines after that are streamed again. Actual lines
+        that match an expected line, such as those containing it in substring mode, are shown as unchanged.
+        """
+        try:
+            f = open(os.path.join(self.cwd, path))
+        except FileNotFoundError:
+            f = io.StringIO()
+        with f:
+            expected = (line.rstrip("\n") for line in f)
+            actual = iter(actual_lines)
+            # Lines of each side compared so far, and the last one they had in common
+            expected_position = actual_position = 0
+            context = None
+            hunks = []
+            while True:
+                mismatch = None
+                for expected_line, actual_line in itertools.zip_longest(expected, actual):
+                    if expected_line is None or actual_line is None or not self.match_line(expected_line, actual_line):
+                        mismatch = expected_line, actual_line
+                        break
+                    expected_position += 1
+                    actual_position += 1
+                    context = expected_line
+                if mismatch is None:
+                    break
+                if len(hunks) >= max_diff_lines:
+                    hunks.append("... and more differences after that")
+                    break
 
-            not_found = {"stdout": [], "stderr": []}  # lines that were expected but not found
-            output_found_markers = []  # index of lines that were found in the output
+                expected_window = [line for line in mismatch[:1] if line is not None]
+                expected_window.extend(itertools.islice(expected, diff_window_lines - len(expected_window)))
+                actual_window = [line for line in mismatch[1:] if line is not None]
+                actual_window.extend(itertools.islice(actual, diff_window_lines - len(actual_window)))
+                # Actual lines matching an expected line are compared as that line
+                keys = [self.expected_key(line, idx, expected_window) for idx, line in enumerate(actual_window)]
 
-            # Gather output from all commands
-            output_lines = []
-            for c in self.commands:
-                if c.process is not None:
-                    output_lines += c.output[out].split("\n")
+                # The windows are only diffed up to the end of their last common lines, the lines after those
+                # could only differ because the windows end where they do, they are streamed again
+                expected_end, actual_end = len(expected_window), len(keys)
+                in_sync = False
+                if len(expected_window) == diff_window_lines or len(keys) == diff_window_lines:
+                    opcodes = difflib.SequenceMatcher(None, expected_window, keys, autojunk=False).get_opcodes()
+                    common = [(i2, j2) for tag, i1, i2, j1, j2 in opcodes if tag == 'equal']
+                    if len(common):
+                        (expected_end, actual_end), in_sync = common[-1], True
+                expected = itertools.chain(expected_window[expected_end:], expected)
+                actual = itertools.chain(actual_window[actual_end:], actual)
 
-            # Find expected lines in the output
-            output_lines_copy = output_lines[:]
+                leading = [] if context is None else [context]
+                diff = difflib.unified_diff(leading + expected_window[:expected_end], leading + keys[:actual_end],
+                                            n=1, lineterm="")
+                # Line numbers of the hunks count from the start of the file, not of the windows
+                expected_offset, actual_offset = expected_position - len(leading), actual_position - len(leading)
+                hunks.extend(hunk_header.sub(lambda m: "@@ -{}{} +{}{} @@".format(
+                    int(m.group(1)) + expected_offset, m.group(2) or "",
+                    int(m.group(3)) + actual_offset, m.group(4) or ""), line) for line in list(diff)[2:])
+
+                expected_position += expected_end
+                actual_position += actual_end
+                context = expected_window[expected_end - 1] if in_sync else None
+
+        if len(hunks) == 0:
+            return None
+        diff = ["--- " + path, "+++ actual"] + hunks
+        if len(diff) > max_diff_lines:
+            diff = diff[:max_diff_lines] + [f"... {len(diff) - max_diff_lines} more lines"]
+        return diff
+
+    def expected_key(self, line, idx, expected_window):
+        """line, or the expected line it matches, preferably the one at idx, to diff it against expected_window."""
+        if self.match_mode != 'substring':
+            return line
+        if idx < len(expected_window) and self.match_line(expected_window[idx], line):
+            return expected_window[idx]
+        return next((expected for expected in expected_window if self.match_line(expected, line)), line)
+
+    def update_expected_files(self):
+        """Overwrite the expected files of this step with the output of its commands."""
+        started = [c for c in self.commands if c.started]
+        for out, path in self.expected_files.items():
+            if path is not None and len(started):
+                with open(os.path.join(self.cwd, path), 'w') as f:
+                    f.write("".join(c.output[out] for c in started))
+
+    def validate(self):
+        """Match the output of the commands that ran against the expectations and return a StepResult."""
+        started = [c for c in self.commands if c.started]
+        commands = [CommandResult(c.command, c.return_code, self.expect_return_code, c.duration_seconds,
+                                  c.resource_usage, self.max_cpu_seconds, self.max_rss_mb, c.attempts)
+                    for c in started]
+        step_start = min((c.start_monotonic for c in started), default=0.0)
+
+        outputs = []
+        for out in 'stdout', 'stderr':
+            # The output of all commands, along with the time each line arrived
+            output_lines = OutputLines([c.output[out] for c in started], [c.line_times[out] for c in started])
+
+            # Find expected lines in the output, matches[i] is the index of expected line i in the output or None
+            matches = []
+            # Lines already matched can't be matched again
+            matched = set()
             for expected in self.expected_lines[out]:
-                if self.match_mode == 'exact':
-                    if expected in output_lines_copy:
-                        idx = output_lines_copy.index(expected)
-                        # remove the line so it can't be matched again, but keep the index
-                        output_lines_copy[idx] = ""
-                        output_found_markers.append(idx)
-                    else:
-                        not_found[out].append(expected)
-                elif self.match_mode == 'substring':
-                    idx = Step.find_substring_in_list(expected, output_lines_copy)
-                    if idx >= 0:
-                        # remove the line so it can't be matched again, but keep the index
-                        output_lines_copy[idx] = ""
-                        output_found_markers.append(idx)
-                    else:
-                        not_found[out].append(expected)
-
-            for idx, line in enumerate(output_lines):
-                if idx in output_found_markers:
-                    report += "\t\t{}\n".format(colored(line, 'green'))
+                idx = output_lines.find(expected, exact=self.match_mode == 'exact', skip=matched)
+                if idx >= 0:
+                    matched.add(idx)
+                    matches.append(idx)
                 else:
-                    report += "\t\t{}\n".format(line)
+                    matches.append(None)
+                hooks.emit('line_matched', self.name, out, expected, matches[-1])
+
+            # Seconds between the start of the step and each matched line being read
+            line_times = {}
+            for idx in matched:
+                line_time = output_lines.line_time(idx)
+                line_times[idx] = None if line_time is None else line_time - step_start
 
-            if self.match_order == 'sequential' and sorted(output_found_markers) != output_found_markers:
-                report += colored("\tERROR expected lines were not found in the correct order", 'red') + "\n"
-                success = False
+            expected_file_diff = None
+            if self.expected_files[out] is not None:
+                expected_file_diff = self.compare_expected_file(self.expected_files[out], output_lines.joined())
 
-            if len(not_found[out]):
-                success = False
-                report += colored("\tERROR expected lines not found:", 'red') + "\n"
-                for line in not_found[out]:
-                    report += "\t\t" + colored(line, 'red') + "\n"
+            outputs.append(OutputResult(out, self.match_mode, self.match_order, self.expected_lines[out],
+                                        output_lines, matches, line_times, self.max_latencies[out],
+                                        self.expected_files[out], expected_file_diff))
 
-        return success, report
+        return StepResult(self.name, commands, outputs, skipped=self.skipped)
+
+    def validate_and_report(self):
+        result = self.validate()
+        return result.success, TerminalWriter(None).format_step(result)
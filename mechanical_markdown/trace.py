@@ -0,0 +1,81 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+"""
+
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+class Tracer:
+    """Collects timing spans and writes them in the Chrome trace event format.
+
+    The resulting file can be loaded in chrome://tracing or https://ui.perfetto.dev.
+    Tracing is disabled by default, in which case span() costs next to nothing.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.thread_names = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def enable(self):
+        self.enabled = True
+
+    def clear(self):
+        with self._lock:
+            self.events = []
+            self.thread_names = {}
+
+    @classmethod
+    def now(cls):
+        return time.perf_counter() * 1000000
+
+    @contextmanager
+    def span(self, name, category, **args):
+        """Record a complete event around the body of the with statement.
+
+        The yielded dict can be used to attach more arguments to the event, e.g. a return code.
+        """
+        if not self.enabled:
+            yield args
+            return
+
+        start = self.now()
+        try:
+            yield args
+        finally:
+            self.add_event(name, category, start, self.now() - start, args)
+
+    def add_event(self, name, category, start, duration, args=None):
+        thread = threading.current_thread()
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': start,
+            'dur': duration,
+            'pid': self._pid,
+            'tid': thread.ident,
+            'args': args or {},
+        }
+        with self._lock:
+            self.events.append(event)
+            self.thread_names[thread.ident] = thread.name
+
+    def write(self, path):
+        with self._lock:
+            metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': self._pid, 'tid': tid, 'args': {'name': name}}
+                        for tid, name in self.thread_names.items()]
+            trace = {'traceEvents': metadata + self.events, 'displayTimeUnit': 'ms'}
+        with open(path, 'w') as f:
+            json.dump(trace, f)
+
+
+tracer = Tracer()
@@ -32,12 +32,15 @@ setup(
         "Programming Language :: Python :: 3",
         "Programming Language :: Python :: 3.7"
     ],
-    packages=find_packages(exclude='tests'),
+    packages=find_packages(exclude=('tests', 'benchmarks')),
     include_package_data=True,
     install_requires=["termcolor", "pyyaml", "mistune>=3.0.0", "requests", "colorama"],
     entry_points={
         "console_scripts": [
             "mm.py = mechanical_markdown.__main__:main"
+        ],
+        "pytest11": [
+            "mechanical_markdown = mechanical_markdown.pytest_plugin"
         ]
     },
 )
@@ -0,0 +1,296 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+"""
+
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from mechanical_markdown import MechanicalMarkdown, MarkdownAnnotationError
+from mechanical_markdown.capacity import Capacity, parse_capacity
+from mechanical_markdown.deadline import Deadline
+from mechanical_markdown.recipe import run_recipes
+from mechanical_markdown.report import JSONLinesWriter
+
+
+class CapacityTests(unittest.TestCase):
+    def test_steps_wait_for_their_resources(self):
+        capacity = Capacity({'cpus': 4})
+        first, second = object(), object()
+        self.assertTrue(capacity.acquire(first, {'cpus': 3, 'docker': 1}))
+        # The steps of one recipe don't share resources either
+        self.assertFalse(capacity.try_acquire(first, {'docker': 1}))
+        self.assertFalse(capacity.fits({'cpus': 2}))
+        self.assertTrue(capacity.try_acquire(first, {'cpus': 1}))
+        capacity.release(first, {'cpus': 1})
+
+        acquired = threading.Event()
+
+        def acquire():
+            capacity.acquire(second, {'cpus': 2})
+            acquired.set()
+
+        waiter = threading.Thread(target=acquire)
+        waiter.start()
+        self.assertFalse(acquired.wait(0.1))
+        capacity.release(first, {'cpus': 3, 'docker': 1})
+        self.assertTrue(acquired.wait(10))
+        waiter.join()
+
+        # Unknown resources are exclusive, and asking for more than there is gets everything once it's free
+        self.assertTrue(capacity.acquire(first, {'docker': 1}))
+        self.assertFalse(capacity.acquire(second, {'docker': 1}, Deadline(1.1)))
+        capacity.release_all(first)
+        capacity.release(second, {'cpus': 2})
+        self.assertTrue(capacity.acquire(second, {'docker': 1, 'cpus': 100}))
+        self.assertEqual({'cpus': 4, 'docker': 1}, capacity.held[second])
+
+    def test_parse_capacity(self):
+        self.assertEqual(('docker', 2.0), parse_capacity('docker=2'))
+        for text in ('docker', '=2', 'docker=lots', 'docker=-1'):
+            with self.assertRaises(ValueError):
+                parse_capacity(text)
+
+    def test_invalid_resources(self):
+        with self.assertRaises(MarkdownAnnotationError):
+            MechanicalMarkdown("""
+<!-- STEP
+name: bad
+resources: [docker]
+-->
+
+<!-- END_STEP -->
+""")
+
+    def test_exclusive_steps_of_parallel_recipes(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            lock = os.path.join(tmpdir, 'lock')
+            # mkdir fails if the other recipe holds the lock at the same time
+            test_data = f"""
+<!-- STEP
+name: exclusive
+resources:
+  database: 1
+-->
+
+```bash
+mkdir {lock} && sleep 0.3 && rmdir {lock}
+```
+
+<!-- END_STEP -->
+"""
+            recipes = [MechanicalMarkdown(test_data, filename=f'{name}.md') for name in ('a', 'b')]
+            start = time.monotonic()
+            self.assertTrue(run_recipes(recipes, False, [], jobs=2))
+            self.assertGreaterEqual(time.monotonic() - start, 0.6)
+
+    def test_background_steps_keep_their_resources(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            lock = os.path.join(tmpdir, 'lock')
+            test_data = f"""
+<!-- STEP
+name: server
+background: true
+resources:
+  database: 1
+-->
+
+```bash
+mkdir {lock} && sleep 0.3 && rmdir {lock}
+```
+
+<!-- END_STEP -->
+
+<!-- STEP
+name: wait
+-->
+
+```bash
+sleep 0.5
+```
+
+<!-- END_STEP -->
+
+<!-- STEP
+name: exclusive
+resources:
+  database: 1
+-->
+
+```bash
+mkdir {lock} && rmdir {lock}
+```
+
+<!-- END_STEP -->
+"""
+            # The server has finished, and released the database, by the time the last step starts
+            capacity = Capacity()
+            self.assertTrue(MechanicalMarkdown(test_data).run(False, [], capacity=capacity))
+            self.assertEqual({}, capacity.held)
+
+    def test_steps_dont_wait_for_background_steps_of_their_recipe(self):
+        test_data = """
+<!-- STEP
+name: server
+background: true
+resources:
+  cpus: 2
+-->
+
+```bash
+sleep 1
+```
+
+<!-- END_STEP -->
+
+<!-- STEP
+name: client
+resources:
+  cpus: 1
+-->
+
+```bash
+echo "client"
+```
+
+<!-- END_STEP -->
+
+<!-- STEP
+name: after
+-->
+
+```bash
+echo "after"
+```
+
+<!-- END_STEP -->
+"""
+        # The server may well be waiting for the client, so the client fails instead of waiting for it
+        report = io.StringIO()
+        capacity = Capacity({'cpus': 2})
+        start = time.monotonic()
+        self.assertFalse(MechanicalMarkdown(test_data).run(False, [JSONLinesWriter(report)], capacity=capacity))
+        self.assertLess(time.monotonic() - start, 5)
+        records = [json.loads(line) for line in report.getvalue().splitlines()]
+        reason = "Step 'client' needs resources held by background step 'server' of the same recipe"
+        self.assertEqual([('server', True, None), ('client', False, reason), ('after', False, reason)],
+                         [(r['name'], r['success'], r['skipped']) for r in records[:3]])
+        self.assertEqual({}, capacity.held)
+
+    def test_steps_dont_wait_for_their_fixtures(self):
+        test_data = """
+<!-- STEP
+name: start service
+fixture: service
+background: true
+resources:
+  cpus: 2
+-->
+
+```bash
+sleep 1
+```
+
+<!-- END_STEP -->
+
+<!-- STEP
+name: use service
+fixtures: [service]
+resources:
+  cpus: 1
+-->
+
+```bash
+echo "client"
+```
+
+<!-- END_STEP -->
+"""
+        report = io.StringIO()
+        capacity = Capacity({'cpus': 2})
+        recipes = [MechanicalMarkdown(test_data, filename='a.md')]
+        self.assertFalse(run_recipes(recipes, False, [JSONLinesWriter(report)], capacity=capacity))
+        records = [json.loads(line) for line in report.getvalue().splitlines()]
+        self.assertIn(("use service", "Step 'use service' needs resources held by fixture 'service'"),
+                      [(r.get('name'), r.get('skipped')) for r in records])
+        self.assertEqual({}, capacity.held)
+
+    def test_recipes_wait_for_each_others_background_steps(self):
+        def document(name, held, wanted):
+            return f"""
+<!-- STEP
+name: {name} holds
+background: true
+resources:
+  {held}: 1
+-->
+
+```bash
+sleep 0.3
+```
+
+<!-- END_STEP -->
+
+<!-- STEP
+name: {name} wants
+resources:
+  {wanted}: 1
+-->
+
+```bash
+echo "{name}"
+```
+
+<!-- END_STEP -->
+"""
+        # Each recipe holds what the other one wants next, until its background step has finished
+        recipes = [MechanicalMarkdown(document('a', 'x', 'y'), filename='a.md'),
+                   MechanicalMarkdown(document('b', 'y', 'x'), filename='b.md')]
+        self.assertTrue(run_recipes(recipes, False, [], jobs=2, deadline=Deadline(30)))
+
+    def test_fixtures_wait_for_their_resources(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            lock = os.path.join(tmpdir, 'lock')
+            fixture = f"""
+<!-- STEP
+name: start service
+fixture: service
+resources:
+  database: 1
+-->
+
+```bash
+mkdir {lock} && sleep 0.3 && rmdir {lock}
+```
+
+<!-- END_STEP -->
+
+<!-- STEP
+name: use service
+fixtures: [service]
+-->
+
+<!-- END_STEP -->
+"""
+            exclusive = f"""
+<!-- STEP
+name: exclusive
+resources:
+  database: 1
+-->
+
+```bash
+sleep 0.1 && mkdir {lock} && rmdir {lock}
+```
+
+<!-- END_STEP -->
+"""
+            recipes = [MechanicalMarkdown(fixture, filename='a.md'), MechanicalMarkdown(exclusive, filename='b.md')]
+            capacity = Capacity()
+            self.assertTrue(run_recipes(recipes, False, [], jobs=2, capacity=capacity))
+            self.assertEqual({}, capacity.held)
@@ -0,0 +1,167 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+"""
+
+import io
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from threading import Thread
+from unittest.mock import patch
+from mechanical_markdown.daemon import Daemon, client_request, send_request
+from mechanical_markdown.report import LinkResult
+
+test_data = """
+[Mechanical Markdown](http://example.com/mechanical-markdown)
+
+<!-- STEP
+name: echo step
+expected_stdout_lines:
+  - "hello from work"
+-->
+
+```bash
+echo "$GREETING from $(basename $PWD)"
+```
+
+<!-- END_STEP -->
+"""
+
+
+class DaemonTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.workdir = os.path.join(self.tmpdir.name, 'work')
+        os.mkdir(self.workdir)
+        with open(os.path.join(self.workdir, 'doc.md'), 'w') as f:
+            f.write(test_data)
+        self.socket_path = os.path.join(self.tmpdir.name, 'mm.sock')
+        self.daemon = Daemon(self.socket_path)
+        self.thread = Thread(target=self.daemon.serve_forever, daemon=True)
+        self.thread.start()
+        deadline = time.monotonic() + 10
+        while not os.path.exists(self.socket_path) and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def tearDown(self):
+        if self.thread.is_alive():
+            self.request('shutdown')
+            self.thread.join(10)
+        self.tmpdir.cleanup()
+
+    def request(self, command, **options):
+        streams = {name: io.StringIO() for name in ('stdout', 'stderr', 'json_report')}
+        status = send_request(self.socket_path, client_request(command, **options), streams)
+        return status, {name: stream.getvalue() for name, stream in streams.items()}
+
+    def test_socket_is_private_from_the_start(self):
+        import socketserver
+
+        modes = []
+
+        class Bound(Exception):
+            pass
+
+        class Server(socketserver.UnixStreamServer):
+            def __init__(self, path, handler):
+                super().__init__(path, handler)
+                modes.append(os.stat(path).st_mode & 0o777)
+                self.server_close()
+                raise Bound()
+
+        umask = os.umask(0o022)
+        try:
+            with patch('mechanical_markdown.daemon.socketserver.UnixStreamServer', Server):
+                with self.assertRaises(Bound):
+                    Daemon(os.path.join(self.tmpdir.name, 'other.sock')).serve_forever()
+            self.assertEqual(0o022, os.umask(0o022))
+        finally:
+            os.umask(umask)
+        self.assertEqual([0], [mode & 0o077 for mode in modes])
+
+    def test_run_in_client_context(self):
+        self.assertEqual(0o600, os.stat(self.socket_path).st_mode & 0o777)
+        cwd = os.getcwd()
+        os.chdir(self.workdir)
+        try:
+            with patch.dict(os.environ, {'GREETING': 'hello'}):
+                request = client_request('run', files=[{'name': 'doc.md', 'markdown': test_data}], json_report=True)
+        finally:
+            os.chdir(cwd)
+        # The daemon hands the client's directory and environment to the steps, without changing its own
+        with patch('mechanical_markdown.daemon.os.chdir', side_effect=AssertionError('chdir')):
+            streams = {name: io.StringIO() for name in ('stdout', 'stderr', 'json_report')}
+            status = send_request(self.socket_path, request, streams)
+        output = {name: stream.getvalue() for name, stream in streams.items()}
+        self.assertEqual(0, status, output)
+        self.assertIn("Running shell 'bash -c' with command", output['stdout'])
+        self.assertIn("hello from work", output['stdout'])
+        records = [json.loads(line) for line in output['json_report'].splitlines()]
+        self.assertEqual(['step', 'summary'], [r['type'] for r in records])
+        self.assertNotIn('GREETING', os.environ)
+        self.assertEqual(cwd, os.getcwd())
+
+    def test_link_results_are_cached(self):
+        checked = []
+
+        def fake_check_link(link, retries=3, session=None):
+            checked.append(link)
+            return LinkResult(link, 200 if len(checked) > 1 else 500)
+
+        files = [{'name': 'doc.md', 'markdown': "[Mechanical Markdown](http://example.com/mechanical-markdown)\n"}]
+        with patch('mechanical_markdown.links.check_link', side_effect=fake_check_link):
+            status, output = self.request('run', files=files, validate_links=True)
+            self.assertEqual(1, status, output)
+            # Failed links are checked again, good ones are reused
+            status, output = self.request('run', files=files, validate_links=True)
+            self.assertEqual(0, status, output)
+            status, output = self.request('run', files=files, validate_links=True)
+            self.assertEqual(0, status, output)
+        self.assertEqual(2, len(checked))
+        self.assertIn("http://example.com/mechanical-markdown Status:", output['stdout'])
+
+    def test_lint_results_are_cached(self):
+        from mechanical_markdown import lint
+
+        path = os.path.join(self.workdir, 'doc.md')
+        with patch('mechanical_markdown.lint.lint_paths', side_effect=lint.lint_paths) as lint_paths:
+            status, output = self.request('lint', paths=[self.workdir])
+            self.assertEqual(0, status, output)
+            self.assertEqual("1 files checked: 0 errors, 0 warnings\n", output['stderr'])
+            status, output = self.request('lint', paths=[self.workdir])
+            self.assertEqual(1, lint_paths.call_count)
+
+            with open(path, 'a') as f:
+                f.write("\n<!-- STEP\nname: unfinished\n-->\n")
+            status, output = self.request('lint', paths=[self.workdir])
+            self.assertEqual(1, status, output)
+            self.assertEqual(2, lint_paths.call_count)
+            self.assertIn(f"{path}:", output['stdout'])
+
+            # Relative paths are relative to the client, and reported that way
+            cwd = os.getcwd()
+            os.chdir(self.tmpdir.name)
+            try:
+                status, output = self.request('lint', paths=['work'])
+            finally:
+                os.chdir(cwd)
+            self.assertEqual(1, status, output)
+            self.assertIn(f"{os.path.join('work', 'doc.md')}:", output['stdout'])
+            self.assertEqual(2, lint_paths.call_count)
+
+    def test_errors_are_reported(self):
+        status, output = self.request('run', files=[{'name': 'bad.md', 'markdown': "<!-- STEP\nname: [\n-->\n"}])
+        self.assertEqual(1, status)
+        self.assertIn('Traceback', output['stderr'])
+        status, output = self.request('unknown')
+        self.assertEqual(1, status)
+
+    def test_shutdown(self):
+        status, _ = self.request('shutdown')
+        self.assertEqual(0, status)
+        self.thread.join(10)
+        self.assertFalse(os.path.exists(self.socket_path))
@@ -0,0 +1,144 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+"""
+
+import threading
+import unittest
+
+from mechanical_markdown import MechanicalMarkdown
+from mechanical_markdown.hooks import Hooks, Plugin, hooks, load_plugin
+
+
+class RecordingPlugin(Plugin):
+    def __init__(self):
+        self.events = []
+        self.closed = False
+
+    def recipe_started(self, filename):
+        self.events.append(('recipe_started', filename))
+
+    def recipe_finished(self, filename, success):
+        self.events.append(('recipe_finished', filename, success))
+
+    def step_started(self, name):
+        self.events.append(('step_started', name))
+
+    def step_finished(self, result):
+        self.events.append(('step_finished', result.name, result.success))
+
+    def command_started(self, command, cwd, pid):
+        self.events.append(('command_started', command))
+
+    def command_finished(self, command, return_code, duration_seconds, resource_usage, output):
+        self.events.append(('command_finished', command, return_code, output['stdout']))
+
+    def output_line(self, command, stream, line, timestamp):
+        self.events.append(('output_line', stream, line))
+
+    def line_matched(self, step_name, stream, expected_line, index):
+        self.events.append(('line_matched', stream, expected_line, index))
+
+    def link_checked(self, result):
+        self.events.append(('link_checked', result.url, result.status))
+
+    def close(self):
+        self.closed = True
+
+
+class HooksTests(unittest.TestCase):
+    def test_events_of_a_run(self):
+        test_data = """
+[Missing](missing.md)
+
+<!-- STEP
+name: echo step
+expected_stdout_lines:
+  - hello
+  - goodbye
+-->
+
+```bash
+echo hello
+```
+
+<!-- END_STEP -->
+"""
+        plugin = RecordingPlugin()
+        hooks.add(plugin)
+        try:
+            mm = MechanicalMarkdown(test_data, filename='doc.md')
+            self.assertFalse(mm.run(False, [], validate_local_links=True))
+        finally:
+            hooks.close()
+        self.assertTrue(plugin.closed)
+        self.assertFalse(hooks.enabled)
+        self.assertEqual([
+            ('recipe_started', 'doc.md'),
+            ('step_started', 'echo step'),
+            ('command_started', 'echo hello'),
+            ('output_line', 'stdout', 'hello\n'),
+            ('command_finished', 'echo hello', 0, 'hello\n'),
+            ('line_matched', 'stdout', 'hello', 0),
+            ('line_matched', 'stdout', 'goodbye', None),
+            ('step_finished', 'echo step', False),
+            ('recipe_finished', 'doc.md', False),
+            ('link_checked', 'missing.md', 'File not found'),
+        ], plugin.events)
+
+    def test_slow_plugins_drop_output_lines(self):
+        release = threading.Event()
+
+        class SlowPlugin(Plugin):
+            def __init__(self):
+                self.events = []
+
+            def step_started(self, name):
+                release.wait(10)
+                self.events.append(name)
+
+            def output_line(self, command, stream, line, timestamp):
+                self.events.append(line)
+
+        slow_hooks = Hooks(queue_size=2)
+        self.assertFalse(slow_hooks.lines_enabled)
+        slow_hooks.add(Plugin())
+        self.assertFalse(slow_hooks.lines_enabled)
+        plugin = SlowPlugin()
+        slow_hooks.add(plugin)
+        self.assertTrue(slow_hooks.lines_enabled)
+        slow_hooks.emit('step_started', 'first')
+        for idx in range(10):
+            slow_hooks.emit('output_line', 'cmd', 'stdout', str(idx), 0.0)
+        self.assertGreaterEqual(slow_hooks.dropped, 7)
+
+        # Other events wait for room in the queue instead
+        emitter = threading.Thread(target=lambda: [slow_hooks.emit('step_started', str(idx)) for idx in range(5)])
+        emitter.start()
+        emitter.join(0.1)
+        self.assertTrue(emitter.is_alive())
+        release.set()
+        emitter.join(10)
+        slow_hooks.close()
+        self.assertEqual('first', plugin.events[0])
+        self.assertEqual([str(idx) for idx in range(5)], [e for e in plugin.events if e.isdigit()][-5:])
+
+    def test_failing_plugins_dont_stop_the_others(self):
+        class FailingPlugin(Plugin):
+            def step_started(self, name):
+                raise RuntimeError('broken plugin')
+
+        failing_hooks = Hooks()
+        plugin = RecordingPlugin()
+        failing_hooks.add(FailingPlugin())
+        failing_hooks.add(plugin)
+        failing_hooks.emit('step_started', 'step')
+        failing_hooks.close()
+        self.assertEqual([('step_started', 'step')], plugin.events)
+
+    def test_load_plugin(self):
+        self.assertIsInstance(load_plugin(f'{__name__}:RecordingPlugin'), RecordingPlugin)
+        with self.assertRaises(ValueError):
+            load_plugin(__name__)
+        with self.assertRaises(AttributeError):
+            load_plugin(f'{__name__}:Missing')
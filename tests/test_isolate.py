@@ -0,0 +1,95 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+"""
+
+import io
+import os
+import tempfile
+import unittest
+
+from mechanical_markdown import MechanicalMarkdown
+from mechanical_markdown.isolate import IsolatedDirectory
+from mechanical_markdown.recipe import run_recipes
+from mechanical_markdown.report import TerminalWriter
+
+
+class IsolatedDirectoryTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tmpdir.name, 'source')
+        os.makedirs(os.path.join(self.source, 'nested'))
+        for name, content in (('keep.txt', 'keep'), ('modify.txt', 'modify'), ('nested/delete.txt', 'delete')):
+            with open(os.path.join(self.source, name), 'w') as f:
+                f.write(content)
+        os.symlink('keep.txt', os.path.join(self.source, 'link.txt'))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_copy_changes_and_collect(self):
+        isolated = IsolatedDirectory(self.source)
+        # On the same file system as the source, so files can be reflinked
+        self.assertEqual(self.tmpdir.name, os.path.dirname(isolated.path))
+        self.assertEqual(os.path.join(isolated.path, 'nested'), isolated.map(os.path.join(self.source, 'nested')))
+        self.assertEqual(self.tmpdir.name, isolated.map(self.tmpdir.name))
+        self.assertEqual('keep.txt', os.readlink(isolated.map(os.path.join(self.source, 'link.txt'))))
+
+        with open(isolated.map(os.path.join(self.source, 'modify.txt')), 'w') as f:
+            f.write('modified in the copy')
+        with open(isolated.map(os.path.join(self.source, 'nested', 'added.txt')), 'w') as f:
+            f.write('added')
+        os.remove(isolated.map(os.path.join(self.source, 'nested', 'delete.txt')))
+
+        with open(os.path.join(self.source, 'modify.txt')) as f:
+            self.assertEqual('modify', f.read())
+        added, modified, deleted = isolated.changes()
+        self.assertEqual([os.path.join('nested', 'added.txt')], added)
+        self.assertEqual(['modify.txt'], modified)
+        self.assertEqual([os.path.join('nested', 'delete.txt')], deleted)
+
+        isolated.collect()
+        isolated.cleanup()
+        self.assertFalse(os.path.exists(isolated.path))
+        with open(os.path.join(self.source, 'modify.txt')) as f:
+            self.assertEqual('modified in the copy', f.read())
+        self.assertTrue(os.path.exists(os.path.join(self.source, 'nested', 'added.txt')))
+        self.assertFalse(os.path.exists(os.path.join(self.source, 'nested', 'delete.txt')))
+
+    def test_isolated_steps_and_recipes(self):
+        test_data = """
+<!-- STEP
+name: isolated
+isolate: {}
+working_dir: {}
+expected_stdout_lines:
+  - {}
+-->
+
+```bash
+echo {} > modify.txt; cat modify.txt
+```
+
+<!-- END_STEP -->
+"""
+        mm = MechanicalMarkdown(test_data.format('true', self.source, 'first', 'first'))
+        success, report = mm.execute_steps(False)
+        self.assertTrue(success, report)
+        with open(os.path.join(self.source, 'modify.txt')) as f:
+            self.assertEqual('modify', f.read())
+
+        mm = MechanicalMarkdown(test_data.format('collect', self.source, 'second', 'second'))
+        success, report = mm.execute_steps(False)
+        self.assertTrue(success, report)
+        with open(os.path.join(self.source, 'modify.txt')) as f:
+            self.assertEqual('second\n', f.read())
+
+        recipes = [MechanicalMarkdown(test_data.format('false', self.source, name, name), filename=f'{name}.md',
+                                      cwd=self.source)
+                   for name in ('third', 'fourth')]
+        report = io.StringIO()
+        success = run_recipes(recipes, False, [TerminalWriter(report)], isolate=True, jobs=2)
+        self.assertTrue(success, report.getvalue())
+        self.assertLess(report.getvalue().index('File: third.md'), report.getvalue().index('File: fourth.md'))
+        with open(os.path.join(self.source, 'modify.txt')) as f:
+            self.assertEqual('second\n', f.read())
@@ -4,9 +4,18 @@ Copyright (c) Microsoft Corporation.
 Licensed under the MIT License.
 """
 
+import io
+import os
+import tempfile
+import time
 import unittest
 
+from unittest.mock import patch
+
 from mechanical_markdown import MechanicalMarkdown
+from mechanical_markdown.recipe import run_recipes
+from mechanical_markdown.report import LinkResult, TerminalWriter
+from mechanical_markdown.links import HeadingIndex, heading_anchor, markdown_anchors
 from fake_http_server import FakeHttpServer
 from termcolor import colored
 
@@ -92,3 +101,135 @@ External link validation:
 \thttp://{self.host_port}/dapr/mechanical-markdown Status: {colored('200', 'green')}
 """
         self.assertEqual(expected_report, report)
+
+    def test_links_are_checked_once_across_recipes(self):
+        link = f'http://{self.host_port}/dapr/mechanical-markdown'
+        first = MechanicalMarkdown(f"[Link]({link}) and again [Link]({link})", filename='first.md')
+        second = MechanicalMarkdown(f"""
+<!-- IGNORE_LINKS -->
+[Link]({link})
+<!-- END_IGNORE -->
+[Link]({link})
+""", filename='second.md')
+        # The server only answers a single request
+        self.server.set_response_codes((200, ))
+        report = io.StringIO()
+        success = run_recipes([first, second], False, [TerminalWriter(report)], validate_links=True)
+        self.assertTrue(success)
+        expected_report = f"""
+File: first.md
+
+File: second.md
+
+File: first.md
+
+External link validation:
+\t{link} Status: {colored('200', 'green')}
+\t{link} Status: {colored('200', 'green')}
+
+File: second.md
+
+External link validation:
+\t{link} Status: {colored('Ignored', 'yellow')}
+\t{link} Status: {colored('200', 'green')}
+"""
+        self.assertEqual(expected_report, report.getvalue())
+
+    def test_links_are_checked_while_steps_run(self):
+        test_data = """
+[Mechanical Markdown](http://example.com/mechanical-markdown)
+
+<!-- STEP
+name: slow step
+-->
+
+```bash
+sleep 1
+```
+
+<!-- END_STEP -->
+"""
+        checked = []
+
+        def fake_check_link(link, retries=3, session=None):
+            checked.append(time.monotonic())
+            return LinkResult(link, 200)
+
+        mm = MechanicalMarkdown(test_data)
+        start = time.monotonic()
+        with patch('mechanical_markdown.links.check_link', side_effect=fake_check_link):
+            success, report = mm.execute_steps(False, validate_links=True)
+        self.assertTrue(success)
+        self.assertEqual(1, len(checked))
+        self.assertLess(checked[0] - start, 0.5, 'the link should be checked before the step finished')
+        expected = f"\thttp://example.com/mechanical-markdown Status: {colored('200', 'green')}\n"
+        self.assertTrue(report.endswith(expected),
+                        report)
+
+
+class LocalLinkValidationTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = self.tmpdir.name
+        os.makedirs(os.path.join(self.root, 'docs', 'images'))
+        with open(os.path.join(self.root, 'setup.md'), 'w') as f:
+            f.write("# Setup\n\n## Install `mm.py`\n\n## Usage\n\n## Usage\n\n<a name=\"custom\"></a>\n")
+        with open(os.path.join(self.root, 'docs', 'images', 'a diagram.png'), 'w') as f:
+            f.write("")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_heading_anchor(self):
+        self.assertEqual('install-mmpy', heading_anchor('Install <code>mm.py</code>'))
+        self.assertEqual('q--a-stuff', heading_anchor('Q &amp; A: Stuff!'))
+
+    def test_local_link_validation(self):
+        test_data = """
+# Local links
+
+[Setup](../setup.md#install-mmpy) [Second usage](../setup.md#usage-1)
+[Missing](missing.md) [Missing anchor](../setup.md#uninstall) [Self](#local-links)
+![Diagram](images/a%20diagram.png) [External](https://example.com) [Mail](mailto:someone@example.com)
+
+<!-- IGNORE_LINKS -->
+[Ignored](missing.md#ignored)
+<!-- END_IGNORE -->
+"""
+        mm = MechanicalMarkdown(test_data, filename=os.path.join(self.root, 'docs', 'index.md'))
+        success, report = mm.execute_steps(False, validate_local_links=True)
+        self.assertFalse(success)
+        expected_report = f"""
+Local link validation:
+\t../setup.md#install-mmpy Status: {colored('Found', 'green')}
+\t../setup.md#usage-1 Status: {colored('Found', 'green')}
+\tmissing.md Status: {colored('File not found', 'red')}
+\t../setup.md#uninstall Status: {colored('Anchor not found', 'red')}
+\t#local-links Status: {colored('Found', 'green')}
+\timages/a%20diagram.png Status: {colored('Found', 'green')}
+\tmissing.md#ignored Status: {colored('Ignored', 'yellow')}
+"""
+        self.assertEqual(expected_report, report)
+
+    def test_headings_with_links_and_code(self):
+        test_data = """
+## Install [Dapr](https://dapr.io) now
+
+## Run `mm.py` here
+
+[Install](#install-dapr-now) [Run](#run-mmpy-here)
+"""
+        mm = MechanicalMarkdown(test_data, filename=os.path.join(self.root, 'docs', 'index.md'))
+        # A recipe has the same anchors as the file has when another one links to it
+        self.assertEqual({'install-dapr-now', 'run-mmpy-here'}, mm.anchors)
+        self.assertEqual(mm.anchors, markdown_anchors(test_data))
+        self.assertEqual([('https://dapr.io', False)], mm.external_links)
+        success, report = mm.execute_steps(False, validate_local_links=True)
+        self.assertTrue(success, report)
+
+    def test_heading_index_resolves_root_links(self):
+        index = HeadingIndex(self.root)
+        docs = os.path.join(self.root, 'docs', 'index.md')
+        self.assertTrue(index.check('/setup.md#custom', docs).success)
+        self.assertTrue(index.check('images/a%20diagram.png#anything', docs).success)
+        self.assertFalse(index.check('/docs/setup.md', docs).success)
@@ -0,0 +1,108 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+"""
+
+import os
+import tempfile
+import unittest
+
+from mechanical_markdown import MechanicalMarkdown, MarkdownAnnotationError
+from mechanical_markdown.lint import lint_markdown, lint_paths, ERROR, WARNING
+
+valid_document = """
+# A valid document
+
+<!-- STEP
+name: valid
+expected_stdout_lines:
+  - test
+-->
+
+```bash
+echo "test"
+```
+
+<!-- END_STEP -->
+"""
+
+broken_document = """# Broken
+
+<!-- STEP
+name: bad yaml
+expected_stdout_lines: [a
+-->
+
+<!-- END_STEP -->
+
+<!-- STEP
+name: bad keys
+tiemout_seconds: 5
+match_order: random
+-->
+
+<!-- END_STEP -->
+
+<!-- END_STEP -->
+
+<!-- IGNORE_LINKS -->
+"""
+
+
+class LintTests(unittest.TestCase):
+    def test_valid_document_has_no_diagnostics(self):
+        self.assertEqual([], lint_markdown(valid_document, 'valid.md'))
+
+    def test_all_problems_are_reported_with_lines(self):
+        diagnostics = [(d.line, d.severity, d.message) for d in lint_markdown(broken_document, 'broken.md')]
+        self.assertEqual([
+            (3, WARNING, "Step has no bash, sh, shell or shell-script code blocks"),
+            (6, ERROR, "Invalid YAML in <!-- STEP -->: expected ',' or ']', but got '<stream end>'"),
+            (10, ERROR, "match_order must be one of: ('sequential', 'none')"),
+            (10, WARNING, "Unknown step key 'tiemout_seconds'"),
+            (10, WARNING, "Step 'bad keys' has no bash, sh, shell or shell-script code blocks"),
+            (16, ERROR, "Unexpected <!-- END_STEP --> found"),
+            (20, ERROR, "Reached end of input searching for <!-- END_IGNORE -->"),
+        ], diagnostics)
+
+    def test_unterminated_step_and_manual_steps(self):
+        document = """
+<!-- STEP
+name: manual
+manual_pause_message: "Open a browser"
+-->
+
+<!-- END_STEP -->
+
+<!-- STEP
+name: never ends
+-->
+
+```bash
+echo "test"
+```
+"""
+        diagnostics = lint_markdown(document)
+        self.assertEqual([(9, ERROR)], [(d.line, d.severity) for d in diagnostics])
+
+    def test_lint_paths_in_parallel(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, 'nested'))
+            for i in range(6):
+                name = os.path.join(tmpdir, 'nested' if i % 2 else '', f'doc{i}.md')
+                with open(name, 'w') as f:
+                    f.write(broken_document if i == 3 else valid_document)
+            with open(os.path.join(tmpdir, 'notes.txt'), 'w') as f:
+                f.write(broken_document)
+
+            files, diagnostics = lint_paths([tmpdir], jobs=2)
+            self.assertEqual(6, len(files))
+            self.assertEqual({os.path.join(tmpdir, 'nested', 'doc3.md')}, {d.filename for d in diagnostics})
+            self.assertEqual(4, len([d for d in diagnostics if d.severity == ERROR]))
+
+    def test_execution_errors_carry_location(self):
+        with self.assertRaises(MarkdownAnnotationError) as context:
+            MechanicalMarkdown(broken_document, filename='broken.md')
+        self.assertEqual(6, context.exception.line)
+        self.assertEqual('broken.md', context.exception.filename)
+        self.assertTrue(str(context.exception).startswith('broken.md:6: Invalid YAML'))
@@ -0,0 +1,98 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+"""
+
+import io
+import subprocess
+import sys
+import threading
+import unittest
+
+from mechanical_markdown import MechanicalMarkdown
+from mechanical_markdown.command import Popen
+from mechanical_markdown.live import LivePrinter
+from termcolor import colored
+
+test_step = """
+<!-- STEP
+name: live step
+output_match_mode: substring
+expected_stdout_lines:
+  - two
+-->
+
+```bash
+echo one
+```
+
+<!-- END_STEP -->
+"""
+
+
+class BlockingStream(io.StringIO):
+    def __init__(self):
+        super().__init__()
+        self.unblock = threading.Event()
+
+    def write(self, text):
+        self.unblock.wait()
+        return super().write(text)
+
+
+class LiveOutputTests(unittest.TestCase):
+    def test_popen_calls_line_callback_while_reading(self):
+        lines = []
+        process = Popen([sys.executable, '-c', 'import sys; print("a"); print("b", file=sys.stderr); print("c")'],
+                        universal_newlines=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        process.line_callback = lambda stream, line: lines.append((stream, line))
+        stdout, stderr = process.communicate(timeout=30)
+        self.assertEqual("a\nc\n", stdout)
+        self.assertEqual("b\n", stderr)
+        self.assertEqual(0, process.returncode)
+        self.assertEqual([('stdout', 'a\n'), ('stdout', 'c\n')], [line for line in lines if line[0] == 'stdout'])
+        self.assertIn(('stderr', 'b\n'), lines)
+
+    def test_popen_communicate_timeout(self):
+        process = Popen([sys.executable, '-c', 'import time; time.sleep(30)'],
+                        universal_newlines=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        with self.assertRaises(subprocess.TimeoutExpired):
+            process.communicate(timeout=0.1)
+        process.kill()
+        process.communicate(timeout=30)
+        self.assertNotEqual(0, process.returncode)
+
+    def test_live_printer_prefixes_and_highlights(self):
+        step = MechanicalMarkdown(test_step).all_steps[0]
+        stream = io.StringIO()
+        printer = LivePrinter(stream)
+        listener = printer.listener(step)
+        listener('stdout', 'one\n')
+        listener('stdout', 'one two three\n')
+        printer.close()
+
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(2, len(lines))
+        self.assertTrue(lines[0].endswith(" [live step] stdout: one"), lines[0])
+        self.assertTrue(lines[1].endswith(" [live step] stdout: " + colored('one two three', 'green')), lines[1])
+
+    def test_live_printer_applies_backpressure(self):
+        step = MechanicalMarkdown(test_step).all_steps[0]
+        stream = BlockingStream()
+        printer = LivePrinter(stream, max_queued_lines=2)
+        listener = printer.listener(step)
+
+        def produce():
+            for i in range(10):
+                listener('stdout', f'line {i}\n')
+        producer = threading.Thread(target=produce)
+        producer.start()
+        producer.join(0.5)
+        # One line is held by the printer and two more are queued, the producer is blocked on the rest
+        self.assertTrue(producer.is_alive())
+        self.assertLessEqual(printer.queue.qsize(), 2)
+
+        stream.unblock.set()
+        producer.join()
+        printer.close()
+        self.assertEqual(10, len(stream.getvalue().splitlines()))
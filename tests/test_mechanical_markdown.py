@@ -4,15 +4,27 @@ Copyright (c) Microsoft Corporation.
 Licensed under the MIT License.
 """
 
+import io
+import json
 import os
 import subprocess
+import sys
+import tempfile
+import time
 import unittest
 
+from collections import namedtuple
 from mechanical_markdown import MechanicalMarkdown, MarkdownAnnotationError
+# The tests mock mechanical_markdown.command.Popen, keep the real one for those that run processes
+from mechanical_markdown.command import Popen as RealPopen
+from mechanical_markdown.resources import Resources
 from unittest.mock import patch, MagicMock, call
 
 DEFAULT_TIMEOUT = 300
 
+FakeRusage = namedtuple('FakeRusage', ('ru_utime', 'ru_stime', 'ru_maxrss', 'ru_inblock', 'ru_oublock',
+                                       'ru_nvcsw', 'ru_nivcsw'))
+
 
 class MechanicalMarkdownTests(unittest.TestCase):
     def setUp(self):
@@ -59,10 +71,9 @@ echo "test"
                                            stdout=subprocess.PIPE,
                                            stderr=subprocess.PIPE,
                                            universal_newlines=True,
-                                           env=os.environ)
+                                           env=os.environ, cwd=os.getcwd())
 
-    @patch("mechanical_markdown.command.os.chdir")
-    def test_working_dir_success(self, chdir_mock):
+    def test_working_dir_success(self):
         test_data = """
 <!-- STEP
 name: basic test
@@ -83,8 +94,7 @@ echo "test"
                                            stdout=subprocess.PIPE,
                                            stderr=subprocess.PIPE,
                                            universal_newlines=True,
-                                           env=os.environ)
-        chdir_mock.assert_has_calls([call("./foo"), call(os.getcwd())])
+                                           env=os.environ, cwd=os.path.join(os.getcwd(), "./foo"))
 
     @patch("mechanical_markdown.step.time.sleep")
     def test_sleep_is_honored(self, sleep_mock):
@@ -108,7 +118,7 @@ echo "test"
                                            stdout=subprocess.PIPE,
                                            stderr=subprocess.PIPE,
                                            universal_newlines=True,
-                                           env=os.environ)
+                                           env=os.environ, cwd=os.getcwd())
         sleep_mock.assert_called_with(10)
 
     def test_env(self):
@@ -136,7 +146,7 @@ echo "test"
                                            stdout=subprocess.PIPE,
                                            stderr=subprocess.PIPE,
                                            universal_newlines=True,
-                                           env=dict(os.environ, **expected_env))
+                                           env=dict(os.environ, **expected_env), cwd=os.getcwd())
 
     def test_background_success(self):
         test_data = """
@@ -161,7 +171,7 @@ echo "test"
                                            stdout=subprocess.PIPE,
                                            stderr=subprocess.PIPE,
                                            universal_newlines=True,
-                                           env=os.environ)
+                                           env=os.environ, cwd=os.getcwd())
 
         self.process_mock.communicate.assert_called_with(timeout=DEFAULT_TIMEOUT)
 
@@ -188,7 +198,7 @@ echo "test"
                                            stdout=subprocess.PIPE,
                                            stderr=subprocess.PIPE,
                                            universal_newlines=True,
-                                           env=os.environ)
+                                           env=os.environ, cwd=os.getcwd())
 
         self.process_mock.communicate.assert_called_with(timeout=DEFAULT_TIMEOUT)
 
@@ -231,7 +241,7 @@ echo "This should not be executed"
                                                 stdout=subprocess.PIPE,
                                                 stderr=subprocess.PIPE,
                                                 universal_newlines=True,
-                                                env=os.environ)
+                                                env=os.environ, cwd=os.getcwd())
 
     def test_missing_expected_line_causes_failure(self):
         test_data = """
@@ -255,7 +265,7 @@ echo "test"
                                                 stdout=subprocess.PIPE,
                                                 stderr=subprocess.PIPE,
                                                 universal_newlines=True,
-                                                env=os.environ)
+                                                env=os.environ, cwd=os.getcwd())
 
     def test_expected_lines_succeed_when_matched(self):
         test_data = """
@@ -284,7 +294,7 @@ echo "error" 1>&2
                       stdout=subprocess.PIPE,
                       stderr=subprocess.PIPE,
                       universal_newlines=True,
-                      env=os.environ),
+                      env=os.environ, cwd=os.getcwd()),
                  call().communicate(timeout=DEFAULT_TIMEOUT)]
         self.popen_mock.assert_has_calls(calls)
 
@@ -312,7 +322,7 @@ echo "Match a substring"
                       stdout=subprocess.PIPE,
                       stderr=subprocess.PIPE,
                       universal_newlines=True,
-                      env=os.environ),
+                      env=os.environ, cwd=os.getcwd()),
                  call().communicate(timeout=DEFAULT_TIMEOUT)]
         self.popen_mock.assert_has_calls(calls)
 
@@ -345,7 +355,7 @@ echo "line 1"
                           stdout=subprocess.PIPE,
                           stderr=subprocess.PIPE,
                           universal_newlines=True,
-                          env=os.environ),
+                          env=os.environ, cwd=os.getcwd()),
                      call().communicate(timeout=DEFAULT_TIMEOUT)]
             self.popen_mock.assert_has_calls(calls)
 
@@ -398,7 +408,7 @@ echo "test"
                       stdout=subprocess.PIPE,
                       stderr=subprocess.PIPE,
                       universal_newlines=True,
-                      env=os.environ),
+                      env=os.environ, cwd=os.getcwd()),
                  call().communicate(timeout=5)]
         self.popen_mock.assert_has_calls(calls)
 
@@ -487,7 +497,7 @@ echo "test"
                                            stdout=subprocess.PIPE,
                                            stderr=subprocess.PIPE,
                                            universal_newlines=True,
-                                           env=os.environ)
+                                           env=os.environ, cwd=os.getcwd())
         self.process_mock.terminate.assert_called()
         self.process_mock.kill.assert_called()
         self.process_mock.communicate.assert_has_calls([call(timeout=DEFAULT_TIMEOUT), call(timeout=DEFAULT_TIMEOUT)])
@@ -517,7 +527,7 @@ echo "test"
                                            stdout=subprocess.PIPE,
                                            stderr=subprocess.PIPE,
                                            universal_newlines=True,
-                                           env=os.environ)
+                                           env=os.environ, cwd=os.getcwd())
 
     def test_different_shell(self):
         test_data = """
@@ -539,7 +549,7 @@ echo "test"
                                            stdout=subprocess.PIPE,
                                            stderr=subprocess.PIPE,
                                            universal_newlines=True,
-                                           env=os.environ)
+                                           env=os.environ, cwd=os.getcwd())
 
     def test_missing_end_tag_throws_exception(self):
         test_data = """
@@ -658,13 +668,13 @@ exit 15
                       stdout=subprocess.PIPE,
                       stderr=subprocess.PIPE,
                       universal_newlines=True,
-                      env=os.environ),
+                      env=os.environ, cwd=os.getcwd()),
                  call().communicate(timeout=DEFAULT_TIMEOUT),
                  call(['bash', '-c', 'exit 15'],
                       stdout=subprocess.PIPE,
                       stderr=subprocess.PIPE,
                       universal_newlines=True,
-                      env=os.environ)]
+                      env=os.environ, cwd=os.getcwd())]
         self.popen_mock.assert_has_calls(calls)
 
     def test_steps_with_no_matching_tags_are_skipped(self):
@@ -703,7 +713,7 @@ echo blag
                       stdout=subprocess.PIPE,
                       stderr=subprocess.PIPE,
                       universal_newlines=True,
-                      env=os.environ),
+                      env=os.environ, cwd=os.getcwd()),
                  call().communicate(timeout=DEFAULT_TIMEOUT)]
         self.popen_mock.assert_has_calls(calls)
 
@@ -744,11 +754,657 @@ echo foo2
                       stdout=subprocess.PIPE,
                       stderr=subprocess.PIPE,
                       universal_newlines=True,
-                      env=os.environ),
+                      env=os.environ, cwd=os.getcwd()),
                  call().communicate(timeout=DEFAULT_TIMEOUT),
                  call(['bash', '-c', 'echo foo2'],
                       stdout=subprocess.PIPE,
                       stderr=subprocess.PIPE,
                       universal_newlines=True,
-                      env=os.environ)]
+                      env=os.environ, cwd=os.getcwd())]
         self.popen_mock.assert_has_calls(calls)
+
+    def test_trace_records_spans(self):
+        test_data = """
+<!-- STEP
+name: traced step
+-->
+
+```bash
+echo "test"
+```
+
+<!-- END_STEP -->
+"""
+        from mechanical_markdown.trace import tracer
+
+        self.prep_command_output("test", "", 0)
+        tracer.enable()
+        try:
+            mm = MechanicalMarkdown(test_data)
+            success, report = mm.execute_steps(False)
+            events = {(e['cat'], e['name']): e for e in tracer.events}
+        finally:
+            tracer.enabled = False
+            tracer.clear()
+        self.assertTrue(success)
+        for key in (('recipe', 'parse'), ('recipe', 'execute_steps'), ('step', 'traced step'),
+                    ('validate', 'traced step'), ('command', 'spawn'), ('command', 'echo "test"')):
+            self.assertIn(key, events)
+        command = events[('command', 'echo "test"')]
+        self.assertEqual(0, command['args']['return_code'])
+        self.assertNotEqual(command['tid'], events[('step', 'traced step')]['tid'])
+        self.assertLessEqual(events[('step', 'traced step')]['ts'], command['ts'])
+
+    def test_resource_usage_is_reported(self):
+        test_data = """
+<!-- STEP
+name: resource usage
+-->
+
+```bash
+echo "test"
+```
+
+<!-- END_STEP -->
+"""
+        self.prep_command_output("test", "", 0)
+        self.process_mock.rusage = FakeRusage(1.5, 0.25, 2048, 3, 4, 5, 6)
+        mm = MechanicalMarkdown(test_data)
+        success, report = mm.execute_steps(False)
+        self.assertTrue(success, report)
+        usage = mm.all_steps[0].commands[0].resource_usage
+        self.assertEqual(1.5, usage['user_cpu_seconds'])
+        self.assertEqual(0.25, usage['system_cpu_seconds'])
+        self.assertEqual(3, usage['block_input_ops'])
+        self.assertIn("\tcpu_seconds: 1.750 (user: 1.500, system: 0.250)\n", report)
+        self.assertIn("\tblock_io_ops: 3 in, 4 out\n", report)
+        self.assertIn("\tcontext_switches: 5 voluntary, 6 involuntary\n", report)
+
+    def test_resource_thresholds_fail_step(self):
+        test_data = """
+<!-- STEP
+name: resource thresholds
+max_cpu_seconds: {}
+max_rss_mb: {}
+-->
+
+```bash
+echo "test"
+```
+
+<!-- END_STEP -->
+"""
+        # ru_maxrss of 2097152 is 2048 MB on Linux and 2 MB on macOS, both above the 1 MB limit
+        for max_cpu, max_rss, expect_success in ((10, 4096, True), (1, 4096, False), (10, 1, False)):
+            self.prep_command_output("test", "", 0)
+            self.process_mock.rusage = FakeRusage(1.5, 0.25, 2097152, 0, 0, 0, 0)
+            mm = MechanicalMarkdown(test_data.format(max_cpu, max_rss))
+            success, report = mm.execute_steps(False)
+            self.assertEqual(expect_success, success, report)
+
+    @unittest.skipIf(not hasattr(os, 'wait4'), 'os.wait4 is not available')
+    def test_popen_keeps_resource_usage(self):
+        process = RealPopen([sys.executable, '-c', 'import os, time; time.sleep(0.2); os._exit(3)'],
+                            universal_newlines=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        process.communicate(timeout=30)
+        self.assertEqual(3, process.returncode)
+        self.assertGreater(process.rusage.ru_maxrss, 0)
+
+        process = RealPopen([sys.executable, '-c', 'import os, signal; os.kill(os.getpid(), signal.SIGKILL)'],
+                            universal_newlines=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        process.communicate()
+        self.assertEqual(-9, process.returncode)
+
+    def test_results_are_written_as_steps_finish(self):
+        test_data = """
+<!-- STEP
+name: first
+-->
+
+```bash
+echo "first"
+```
+
+<!-- END_STEP -->
+
+<!-- STEP
+name: second
+-->
+
+```bash
+echo "second"
+```
+
+<!-- END_STEP -->
+"""
+        from mechanical_markdown.report import ReportWriter
+
+        events = []
+
+        class RecordingWriter(ReportWriter):
+            def step_finished(self, result):
+                events.append(('finished', result.name, result.success))
+
+            def close(self, success):
+                events.append(('close', success))
+
+        def pop_command(timeout=None):
+            events.append(('ran', len(self.command_outputs)))
+            stdout, stderr, return_code = self.command_outputs.pop(0)
+            self.process_mock.returncode = return_code
+            return (stdout, stderr)
+        self.process_mock.communicate.side_effect = pop_command
+
+        self.prep_command_output("first", "", 0)
+        self.prep_command_output("second", "", 0)
+        mm = MechanicalMarkdown(test_data)
+        success = mm.run(False, [RecordingWriter()])
+        self.assertTrue(success)
+        self.assertEqual([('ran', 2), ('finished', 'first', True), ('ran', 1), ('finished', 'second', True),
+                          ('close', True)], events)
+
+    def test_expected_line_latency(self):
+        test_data = """
+<!-- STEP
+name: latency test
+expected_stdout_lines:
+  - starting
+  - line: up and running
+    max_latency_seconds: {}
+-->
+
+```bash
+echo "starting"
+echo "up and running"
+```
+
+<!-- END_STEP -->
+"""
+        for max_latency, expect_success in ((10, True), (2, False)):
+            self.prep_command_output("starting\nup and running\n", "", 0)
+            now = time.monotonic()
+            self.process_mock.line_times = {'stdout': [now + 1.0, now + 3.0], 'stderr': []}
+            mm = MechanicalMarkdown(test_data.format(max_latency))
+            self.assertEqual(["starting", "up and running"], mm.all_steps[0].expected_lines['stdout'])
+            success, report = mm.execute_steps(False)
+            self.assertEqual(expect_success, success, report)
+
+            result = mm.all_steps[0].validate()
+            latencies = result.outputs[0].latencies
+            self.assertEqual(["starting", "up and running"], [latency[0] for latency in latencies])
+            self.assertAlmostEqual(1.0, latencies[0][1], delta=0.5)
+            self.assertIsNone(latencies[0][2])
+            self.assertAlmostEqual(2.0, latencies[1][2], delta=0.01)
+            self.assertEqual(max_latency, latencies[1][3])
+            self.assertIn("\tExpected stdout latency:\n", report)
+
+    def test_exception_raised_for_expected_line_without_line(self):
+        test_data = """
+<!-- STEP
+name: basic test
+expected_stdout_lines:
+  - max_latency_seconds: 10
+-->
+
+<!-- END_STEP -->
+"""
+
+        with self.assertRaises(MarkdownAnnotationError):
+            MechanicalMarkdown(test_data)
+
+    def test_record_and_replay(self):
+        test_data = """
+<!-- STEP
+name: record test
+expected_stdout_lines:
+  - {}
+expected_return_code: {}
+-->
+
+```bash
+echo "test"
+```
+
+```bash
+echo "second"
+```
+
+<!-- END_STEP -->
+"""
+        from mechanical_markdown.cassette import CassetteError
+
+        with tempfile.TemporaryDirectory() as cassettes:
+            self.prep_command_output("test\n", "", 0)
+            self.prep_command_output("second\n", "warning\n", 0)
+            mm = MechanicalMarkdown(test_data.format("test", 0), filename='doc.md')
+            self.assertTrue(mm.run(False, [], record_dir=cassettes))
+            self.assertEqual(2, self.popen_mock.call_count)
+
+            # Changed expectations are validated against the recording without running anything
+            mm = MechanicalMarkdown(test_data.format("second", 0), filename='doc.md')
+            self.assertTrue(mm.run(False, [], replay_dir=cassettes))
+            self.assertEqual("warning\n", mm.all_steps[0].commands[1].output['stderr'])
+            mm = MechanicalMarkdown(test_data.format("other", 0), filename='doc.md')
+            self.assertFalse(mm.run(False, [], replay_dir=cassettes))
+            mm = MechanicalMarkdown(test_data.format("test", 1), filename='doc.md')
+            self.assertFalse(mm.run(False, [], replay_dir=cassettes))
+            self.assertEqual(2, self.popen_mock.call_count)
+
+            # Changed commands need to be recorded again
+            mm = MechanicalMarkdown(test_data.format("test", 0).replace('second', 'changed'), filename='doc.md')
+            with self.assertRaises(CassetteError):
+                mm.run(False, [], replay_dir=cassettes)
+            mm = MechanicalMarkdown(test_data.format("test", 0), filename='other.md')
+            with self.assertRaises(CassetteError):
+                mm.run(False, [], replay_dir=cassettes)
+
+    def test_retries(self):
+        test_data = """
+<!-- STEP
+name: flaky step
+retries: 2
+retry_backoff_seconds: 0
+retry_on_return_codes: {}
+expected_stdout_lines:
+  - pulled
+-->
+
+```bash
+docker pull image
+```
+
+```bash
+echo done
+```
+
+<!-- END_STEP -->
+"""
+        from mechanical_markdown.report import JSONLinesWriter, JUnitXMLWriter
+
+        self.prep_command_output("", "pull failed", 1)
+        self.prep_command_output("", "pull failed", 1)
+        self.prep_command_output("pulled", "", 0)
+        self.prep_command_output("done", "", 0)
+        report = io.StringIO()
+        junit = io.StringIO()
+        mm = MechanicalMarkdown(test_data.format("[1]"))
+        self.assertTrue(mm.run(False, [JSONLinesWriter(report), JUnitXMLWriter(junit)]))
+        self.assertEqual(4, self.popen_mock.call_count)
+        step = json.loads(report.getvalue().splitlines()[0])
+        self.assertTrue(step['flaky'])
+        self.assertEqual([1, 1], [a['return_code'] for a in step['commands'][0]['attempts']])
+        self.assertEqual("pull failed", step['commands'][0]['attempts'][0]['stderr'])
+        self.assertEqual([], step['commands'][1]['attempts'])
+        self.assertIn('<flakyFailure message="`docker pull image` returned 1">', junit.getvalue())
+
+        # Only the given return codes are retried, and only as often as asked to
+        self.prep_command_output("", "pull failed", 1)
+        mm = MechanicalMarkdown(test_data.format("[2]"))
+        success, report = mm.execute_steps(False)
+        self.assertFalse(success)
+        self.assertEqual(5, self.popen_mock.call_count)
+        for _ in range(3):
+            self.prep_command_output("", "denied", 2)
+        mm = MechanicalMarkdown(test_data.format("2"))
+        success, report = mm.execute_steps(False)
+        self.assertFalse(success)
+        self.assertEqual(8, self.popen_mock.call_count)
+        self.assertIn("attempts: 3", report)
+
+        with self.assertRaises(MarkdownAnnotationError):
+            MechanicalMarkdown(test_data.format("[1]").replace("retries: 2", "retries: many"))
+
+    def test_expected_output_file(self):
+        test_data = """
+<!-- STEP
+name: golden test
+output_match_mode: {}
+expected_stdout_file: {}
+-->
+
+```bash
+echo "test"
+```
+
+<!-- END_STEP -->
+"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            golden = os.path.join(tmpdir, 'golden.txt')
+            with open(golden, 'w') as f:
+                f.write("first\nsecond\nthird\n")
+
+            for mode, output, expect_success in (('exact', "first\nsecond\nthird\n", True),
+                                                 ('exact', "first\nsecond\n", False),
+                                                 ('exact', "first\nsecond\nthird\nfourth\n", False),
+                                                 ('substring', "a first\nthe second\nthird one\n", True),
+                                                 ('substring', "first\nthird\nsecond\n", False)):
+                self.prep_command_output(output, "", 0)
+                mm = MechanicalMarkdown(test_data.format(mode, golden))
+                success, report = mm.execute_steps(False)
+                self.assertEqual(expect_success, success, report)
+
+            self.prep_command_output("first\nchanged\nthird\n", "", 0)
+            mm = MechanicalMarkdown(test_data.format('exact', golden))
+            success, report = mm.execute_steps(False)
+            self.assertFalse(success)
+            self.assertEqual(["--- " + golden, "+++ actual", "@@ -1,3 +1,3 @@", " first", "-second", "+changed",
+                              " third"], mm.all_steps[0].validate().outputs[0].expected_file_diff)
+
+            # Only the lines from the first mismatch on are compared, matching lines show as unchanged
+            self.prep_command_output("a first\nthe second\n3rd\n", "", 0)
+            mm = MechanicalMarkdown(test_data.format('substring', golden))
+            success, report = mm.execute_steps(False)
+            self.assertFalse(success)
+            self.assertEqual(["--- " + golden, "+++ actual", "@@ -2,2 +2,2 @@", " second", "-third", "+3rd"],
+                             mm.all_steps[0].validate().outputs[0].expected_file_diff)
+
+            self.prep_command_output("first\nchanged\nthird\n", "", 0)
+            mm = MechanicalMarkdown(test_data.format('exact', golden))
+            self.assertTrue(mm.run(False, [], update_golden=True))
+            with open(golden) as f:
+                self.assertEqual("first\nchanged\nthird\n", f.read())
+
+    def test_expected_output_file_diff(self):
+        from mechanical_markdown.step import diff_window_lines, max_diff_lines
+
+        step = MechanicalMarkdown("""
+<!-- STEP
+name: golden test
+expected_stdout_file: golden.txt
+-->
+
+<!-- END_STEP -->
+""").all_steps[0]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            step.cwd = tmpdir
+            golden = os.path.join(tmpdir, 'golden.txt')
+
+            def diff(expected, actual):
+                with open(golden, 'w') as f:
+                    f.write("".join(line + "\n" for line in expected))
+                return step.compare_expected_file('golden.txt', iter(actual))[2:]
+
+            for length in (60, 2 * diff_window_lines + 100):
+                lines = [f"line {n}" for n in range(1, length + 1)]
+                # A deleted or inserted line doesn't shift the lines after it
+                self.assertEqual(["@@ -10,3 +10,2 @@", " line 10", "-line 11", " line 12"],
+                                 diff(lines, lines[:10] + lines[11:]), length)
+                self.assertEqual(["@@ -30,2 +30,3 @@", " line 30", "+inserted", " line 31"],
+                                 diff(lines, lines[:30] + ["inserted"] + lines[30:]), length)
+                # Nor does a change at the end of the window of lines read ahead
+                changed = list(lines)
+                expected = []
+                for n in (50, 50 + diff_window_lines):
+                    if n < length:
+                        changed[n - 1] = "changed"
+                        expected += [f"@@ -{n - 1},3 +{n - 1},3 @@", f" line {n - 1}", f"-line {n}", "+changed",
+                                     f" line {n + 1}"]
+                self.assertEqual(expected, diff(lines, changed), length)
+
+            # Only differences that are really there are reported as more of them
+            lines = [f"line {n}" for n in range(1, 2 * diff_window_lines)]
+            result = diff(lines, [line + "!" for line in lines])
+            self.assertEqual(max_diff_lines + 1 - 2, len(result))
+            self.assertRegex(result[-1], r"^\.\.\. \d+ more lines$")
+
+    def test_shared_fixtures(self):
+        from mechanical_markdown.recipe import run_recipes
+
+        fixture_data = """
+<!-- STEP
+name: start service
+fixture: svc
+-->
+
+```bash
+echo "start"
+```
+
+<!-- END_STEP -->
+
+<!-- STEP
+name: stop service
+teardown_fixture: svc
+-->
+
+```bash
+echo "stop"
+```
+
+<!-- END_STEP -->
+"""
+        test_data = """
+<!-- STEP
+name: use service
+fixtures: svc
+-->
+
+```bash
+echo "{}"
+```
+
+<!-- END_STEP -->
+"""
+        for output in "start", "a", "b", "stop":
+            self.prep_command_output(output, "", 0)
+        shared = MechanicalMarkdown(fixture_data, filename='fixtures.md')
+        recipes = [MechanicalMarkdown(test_data.format(name), filename=f'{name}.md') for name in ("a", "b")]
+        self.assertEqual(['svc'], recipes[0].all_steps[0].fixtures)
+        self.assertTrue(run_recipes(recipes, False, [], shared_fixtures=[shared]))
+        commands = [c[0][0][2] for c in self.popen_mock.call_args_list]
+        self.assertEqual(['echo "start"', 'echo "a"', 'echo "b"', 'echo "stop"'], commands)
+
+        # The recipe declaring the fixture owns it, other recipes share it
+        for output in "start", "a", "stop":
+            self.prep_command_output(output, "", 0)
+        recipes = [MechanicalMarkdown(fixture_data, filename='fixtures.md'),
+                   MechanicalMarkdown(test_data.format("a"), filename='a.md')]
+        self.assertTrue(run_recipes(recipes, False, []))
+        commands = [c[0][0][2] for c in self.popen_mock.call_args_list[4:]]
+        self.assertEqual(['echo "start"', 'echo "a"', 'echo "stop"'], commands)
+
+        with self.assertRaises(MarkdownAnnotationError):
+            run_recipes([MechanicalMarkdown(test_data.format("a"), filename='a.md')], False, [])
+
+        # The fixture keeps its placeholders and working directory copy until it is torn down, even though the
+        # recipe declaring it has finished long before
+        spawned = []
+
+        def popen(args, **kwargs):
+            path = args[2].split()[-1].strip('"')
+            spawned.append((args[2], kwargs['cwd'], os.path.isdir(kwargs['cwd']) and os.path.isdir(path)))
+            return self.process_mock
+
+        self.popen_mock.side_effect = popen
+        for output in "start", "a", "stop":
+            self.prep_command_output(output, "", 0)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            pwd = os.getcwd()
+            os.chdir(tmpdir)
+            try:
+                recipes = [MechanicalMarkdown(fixture_data.replace('"start"', '${TMPDIR:svc}')
+                                              .replace('"stop"', '${TMPDIR:svc}'), filename='fixtures.md'),
+                           MechanicalMarkdown(test_data.format(tmpdir), filename='a.md')]
+                self.assertTrue(run_recipes(recipes, False, [], isolate=True))
+            finally:
+                os.chdir(pwd)
+        self.assertEqual(3, len(spawned))
+        self.assertEqual(spawned[0], spawned[2])
+        self.assertNotIn(spawned[0][1], (tmpdir, spawned[1][1]))
+        self.assertTrue(all(exists for _, _, exists in spawned))
+        self.assertFalse(os.path.exists(spawned[0][0].split()[-1]))
+        self.assertFalse(os.path.exists(spawned[0][1]))
+
+    def test_env_is_a_snapshot(self):
+        test_data = """
+<!-- STEP
+name: first
+env:
+  FIRST: 1
+-->
+
+<!-- END_STEP -->
+
+<!-- STEP
+name: second
+-->
+
+<!-- END_STEP -->
+"""
+        with patch.dict(os.environ, {'MM_SNAPSHOT': 'parsed'}):
+            mm = MechanicalMarkdown(test_data)
+            os.environ['MM_SNAPSHOT'] = 'changed later'
+        first, second = mm.all_steps
+        self.assertIs(first.base_env, second.env)
+        self.assertEqual('1', first.env['FIRST'])
+        self.assertEqual('parsed', first.env['MM_SNAPSHOT'])
+        self.assertNotIn('FIRST', second.env)
+
+    def test_placeholders_are_allocated_per_recipe(self):
+        test_data = """
+<!-- STEP
+name: placeholders
+env:
+  APP_PORT: ${PORT:app}
+  DATA_DIR: ${TMPDIR:data}
+expected_stdout_lines:
+  - ${PORT:app}
+-->
+
+```bash
+echo ${PORT:app} ${PORT:other} ${TMPDIR:data} ${UNIQUE:cluster} ${HOME:0:3}
+```
+
+<!-- END_STEP -->
+"""
+        recipe = MechanicalMarkdown(test_data)
+        template = 'echo ${PORT:app} ${PORT:other} ${TMPDIR:data} ${UNIQUE:cluster} ${HOME:0:3}'
+        # Nothing is allocated until the recipe runs
+        self.assertEqual(template, recipe.all_steps[0].commands[0].command)
+        self.assertEqual('${PORT:app}', recipe.all_steps[0].env['APP_PORT'])
+
+        resources = Resources()
+        step = recipe.all_steps[0].bind(resources)
+        port, other_port, data_dir, cluster, home = step.commands[0].command.split()[1:]
+        self.assertEqual(template, step.commands[0].template)
+        self.assertEqual(port, step.env['APP_PORT'])
+        self.assertEqual(data_dir, step.env['DATA_DIR'])
+        self.assertNotEqual(port, other_port)
+        self.assertTrue(os.path.isdir(data_dir))
+        self.assertTrue(cluster.startswith('cluster-'))
+        self.assertEqual('${HOME:0:3}', home)
+        self.assertEqual([port], step.expected_lines['stdout'])
+
+        other_step = recipe.all_steps[0].bind(Resources())
+        self.assertNotIn(other_step.commands[0].command.split()[1], (port, other_port))
+        resources.release()
+        self.assertFalse(os.path.exists(data_dir))
+
+        def echo_port(timeout=None):
+            self.process_mock.returncode = 0
+            return self.popen_mock.call_args[0][0][2].split()[1] + "\n", ""
+
+        self.process_mock.communicate.side_effect = echo_port
+        # Every run allocates its own placeholders, and releases them afterwards
+        runs = []
+        for _ in range(2):
+            success, report = recipe.execute_steps(False)
+            self.assertTrue(success, report)
+            runs.append(self.popen_mock.call_args[0][0][2].split()[1:4])
+            self.assertFalse(os.path.exists(runs[-1][2]))
+        self.assertNotEqual(runs[0], runs[1])
+
+    def test_deadline(self):
+        from mechanical_markdown.deadline import Deadline
+        from mechanical_markdown.report import JSONLinesWriter, TerminalWriter
+
+        test_data = """
+<!-- STEP
+name: slow step
+expected_stdout_lines:
+  - first
+-->
+
+```bash
+echo "first"
+```
+
+<!-- END_STEP -->
+
+<!-- STEP
+name: never started
+-->
+
+```bash
+echo "second"
+```
+
+<!-- END_STEP -->
+"""
+        deadline = Deadline(60)
+
+        def run_out_of_time(timeout=None):
+            deadline.expires = time.monotonic()
+            self.process_mock.returncode = 0
+            return ("first", "")
+
+        self.process_mock.communicate.side_effect = run_out_of_time
+        report = io.StringIO()
+        terminal = io.StringIO()
+        mm = MechanicalMarkdown(test_data)
+        self.assertFalse(mm.run(False, [JSONLinesWriter(report), TerminalWriter(terminal, color=False)],
+                                deadline=deadline))
+        self.assertEqual(1, self.popen_mock.call_count)
+        self.assertLessEqual(self.process_mock.communicate.call_args[1]['timeout'], 60)
+
+        records = [json.loads(line) for line in report.getvalue().splitlines()]
+        self.assertEqual([('slow step', True, None), ('never started', False, deadline.reason)],
+                         [(r['name'], r['success'], r['skipped']) for r in records[:2]])
+        self.assertIn("Step: never started\n\tSKIPPED: the run deadline of 60s was reached\n", terminal.getvalue())
+
+    @patch("mechanical_markdown.step.time.sleep")
+    @patch("builtins.input")
+    def test_deadline_stops_steps_half_way(self, input_mock, sleep_mock):
+        from mechanical_markdown.deadline import Deadline
+        from mechanical_markdown.report import JSONLinesWriter
+
+        test_data = """
+<!-- STEP
+name: half way
+sleep: 600
+manual_pause_message: "Nobody is there"
+-->
+
+```bash
+echo "first"
+```
+
+```bash
+echo "second"
+```
+
+<!-- END_STEP -->
+"""
+        deadline = Deadline(60)
+
+        def run_out_of_time(timeout=None):
+            if self.process_mock.communicate.call_count == 1:
+                deadline.expires = time.monotonic() + 0.5
+                raise subprocess.TimeoutExpired("foo", timeout)
+            return ("", "")
+
+        self.process_mock.communicate.side_effect = run_out_of_time
+        self.process_mock.returncode = 0
+        report = io.StringIO()
+        mm = MechanicalMarkdown(test_data)
+        self.assertFalse(mm.run(True, [JSONLinesWriter(report)], deadline=deadline))
+        input_mock.assert_not_called()
+        self.assertEqual(1, self.popen_mock.call_count)
+        # Neither the grace period after SIGTERM nor the sleep run past the deadline
+        self.assertLessEqual(self.process_mock.wait.call_args[0][0], 0.5)
+        self.assertLessEqual(sleep_mock.call_args[0][0], 0.5)
+
+        record = json.loads(report.getvalue().splitlines()[0])
+        self.assertEqual(('half way', False), (record['name'], record['success']))
+        self.assertEqual(f'{deadline.reason} before `echo "second"` started', record['skipped'])
+        self.assertEqual(1, len(record['commands']))
@@ -0,0 +1,109 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+"""
+
+import os
+import tempfile
+import time
+import unittest
+
+from mechanical_markdown import MechanicalMarkdown
+from mechanical_markdown.hooks import hooks
+from mechanical_markdown.metrics import PrometheusExporter
+from mechanical_markdown.report import LinkResult
+
+try:
+    from prometheus_client.parser import text_string_to_metric_families
+except ImportError:
+    text_string_to_metric_families = None
+
+
+class PrometheusExporterTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'mm.prom')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def read(self):
+        with open(self.path) as f:
+            return f.read().splitlines()
+
+    def test_metrics_of_a_run(self):
+        test_data = """
+<!-- STEP
+name: echo step
+-->
+
+```bash
+echo "hello \\"world\\""
+```
+
+```bash
+exit 3
+```
+
+<!-- END_STEP -->
+"""
+        exporter = PrometheusExporter(self.path)
+        hooks.add(exporter)
+        try:
+            MechanicalMarkdown(test_data).run(False, [])
+            hooks.emit('link_checked', LinkResult('http://example.com', 404))
+            hooks.emit('link_requested', 'http://example.com', 404, 0.2)
+            hooks.emit('cache_lookup', 'links', True)
+        finally:
+            hooks.close()
+
+        lines = self.read()
+        self.assertNotIn('# EOF', lines)
+        for expected in ('mm_recipes_total{result="failure"} 1',
+                         'mm_steps_total{result="failure"} 1',
+                         'mm_step_duration_seconds_count 1',
+                         'mm_command_duration_seconds_count 2',
+                         'mm_command_duration_seconds_bucket{le="+Inf"} 2',
+                         'mm_command_return_codes_total{code="0"} 1',
+                         'mm_command_return_codes_total{code="3"} 1',
+                         'mm_command_output_bytes_total{stream="stdout"} 14',
+                         'mm_links_checked_total{kind="external",status="404"} 1',
+                         'mm_link_check_duration_seconds_bucket{le="0.1"} 0',
+                         'mm_link_check_duration_seconds_bucket{le="0.25"} 1',
+                         'mm_cache_lookups_total{cache="links",result="hit"} 1'):
+            self.assertIn(expected, lines)
+        self.assertIn('# TYPE mm_steps_total counter', lines)
+        self.assertEqual([], [name for name in os.listdir(self.tmpdir.name) if name != 'mm.prom'])
+
+    def test_periodic_updates(self):
+        exporter = PrometheusExporter(self.path, interval=0.05)
+        exporter.count('mm_steps', result='success')
+        deadline = time.monotonic() + 10
+        while not os.path.exists(self.path) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertIn('mm_steps_total{result="success"} 1', self.read())
+        exporter.count('mm_steps', result='success')
+        exporter.close()
+        self.assertIn('mm_steps_total{result="success"} 2', self.read())
+
+    def test_label_values_are_escaped(self):
+        exporter = PrometheusExporter(self.path)
+        exporter.link_checked(LinkResult('http://example.com', 'Connection "Failed"\\\n'))
+        self.assertIn('mm_links_checked_total{kind="external",status="Connection \\"Failed\\"\\\\\\n"} 1',
+                      exporter.render().splitlines())
+
+    @unittest.skipIf(text_string_to_metric_families is None, 'prometheus_client is not installed')
+    def test_prometheus_text_format(self):
+        exporter = PrometheusExporter(self.path)
+        exporter.count('mm_steps', result='success')
+        exporter.link_checked(LinkResult('http://example.com', 'Connection "Failed"\\\n'))
+        exporter.observe('mm_step_duration_seconds', 0.2)
+        families = {family.name: family for family in text_string_to_metric_families(exporter.render())}
+        self.assertEqual('counter', families['mm_steps'].type)
+        self.assertEqual([('mm_steps_total', {'result': 'success'}, 1.0)],
+                         [(s.name, s.labels, s.value) for s in families['mm_steps'].samples])
+        self.assertEqual({'kind': 'external', 'status': 'Connection "Failed"\\\n'},
+                         families['mm_links_checked'].samples[0].labels)
+        self.assertEqual('histogram', families['mm_step_duration_seconds'].type)
+        self.assertIn(('mm_step_duration_seconds_count', 1.0),
+                      [(s.name, s.value) for s in families['mm_step_duration_seconds'].samples])
@@ -0,0 +1,160 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+try:
+    import pytest  # noqa: F401
+except ImportError:
+    pytest = None
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+passing_recipe = """
+# A passing recipe
+
+<!-- STEP
+name: setup
+-->
+
+```bash
+echo "setting up"
+```
+
+<!-- END_STEP -->
+
+<!-- STEP
+name: tagged
+tags:
+  - slow
+expected_stdout_lines:
+  - tagged
+-->
+
+```bash
+echo "tagged"
+```
+
+<!-- END_STEP -->
+"""
+
+failing_recipe = """
+<!-- STEP
+name: wrong output
+expected_stdout_lines:
+  - expected
+-->
+
+```bash
+echo "actual"
+```
+
+<!-- END_STEP -->
+
+<!-- STEP
+name: after failure
+-->
+
+```bash
+echo "never runs"
+```
+
+<!-- END_STEP -->
+"""
+
+python_tests = """
+import pytest
+
+
+@pytest.mark.device(serial="1")
+def test_device():
+    pass
+
+
+def test_other():
+    pass
+"""
+
+
+@unittest.skipIf(pytest is None, 'pytest is not installed')
+class PytestPluginTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        for name, body in (('passing.md', passing_recipe), ('failing.md', failing_recipe),
+                           ('plain.md', '# No annotations here\n')):
+            with open(os.path.join(self.tmpdir.name, name), 'w') as f:
+                f.write(body)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def run_pytest(self, *args):
+        env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+        completed = subprocess.run([sys.executable, '-m', 'pytest', '-p', 'mechanical_markdown.pytest_plugin',
+                                    '-p', 'no:cacheprovider', '-rA', '--rootdir', self.tmpdir.name] + list(args),
+                                   cwd=self.tmpdir.name, env=env, universal_newlines=True,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        return completed.returncode, completed.stdout
+
+    def test_files_are_not_collected_without_mm(self):
+        return_code, output = self.run_pytest()
+        self.assertEqual(5, return_code, output)  # no tests collected
+
+    def test_one_item_per_file(self):
+        return_code, output = self.run_pytest('--mm')
+        self.assertEqual(1, return_code, output)
+        self.assertIn('PASSED passing.md::recipe', output)
+        self.assertIn('FAILED failing.md::recipe', output)
+        self.assertIn('ERROR expected lines not found', output)
+        self.assertNotIn('plain.md', output)
+
+    def test_one_item_per_step(self):
+        return_code, output = self.run_pytest('--mm', '--mm-per-step')
+        self.assertEqual(1, return_code, output)
+        self.assertIn('PASSED passing.md::setup', output)
+        self.assertIn('PASSED passing.md::tagged', output)
+        self.assertIn('FAILED failing.md::wrong output', output)
+        self.assertIn('a previous step of this file failed', output)
+
+    def test_tags_map_to_markers(self):
+        # Steps without tags run whatever the expression
+        return_code, output = self.run_pytest('--mm', '--mm-per-step', '-m', 'slow', 'passing.md')
+        self.assertEqual(0, return_code, output)
+        self.assertIn('PASSED passing.md::setup', output)
+        self.assertIn('PASSED passing.md::tagged', output)
+        self.assertIn('2 passed', output)
+
+        return_code, output = self.run_pytest('--mm', '--mm-per-step', '-m', 'not slow', 'passing.md')
+        self.assertEqual(0, return_code, output)
+        self.assertIn('PASSED passing.md::setup', output)
+        self.assertIn('1 passed, 1 deselected', output)
+
+    def test_tags_select_the_steps_of_files(self):
+        return_code, output = self.run_pytest('--mm', '-m', 'not slow', 'passing.md')
+        self.assertEqual(0, return_code, output)
+        self.assertIn('PASSED passing.md::recipe', output)
+        self.assertIn('echo "setting up"', output)
+        self.assertNotIn('echo "tagged"', output)
+
+    def test_tags_and_keywords(self):
+        return_code, output = self.run_pytest('--mm', '--mm-per-step', '-m', 'slow', '-k', 'setup', 'passing.md')
+        self.assertEqual(0, return_code, output)
+        self.assertIn('PASSED passing.md::setup', output)
+        self.assertIn('1 passed, 1 deselected', output)
+
+    def test_marker_expressions_of_other_tests(self):
+        with open(os.path.join(self.tmpdir.name, 'test_devices.py'), 'w') as f:
+            f.write(python_tests)
+        for args in (('test_devices.py',), ('--mm', '--mm-per-step', 'test_devices.py', 'passing.md')):
+            return_code, output = self.run_pytest('-m', 'device(serial="1")', *args)
+            self.assertEqual(0, return_code, output)
+            self.assertIn('1 passed, ', output)
+        # Markdown steps are selected by their markers then, which none of them has
+        self.assertIn('1 passed, 3 deselected', output)
+        self.assertIn('Markdown steps are only selected by their markers', output)
@@ -0,0 +1,126 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+"""
+
+import io
+import json
+import unittest
+
+from xml.dom import minidom
+
+from mechanical_markdown.report import (CommandResult, OutputLines, OutputResult, StepResult, LinkResult,
+                                        TerminalWriter, JSONLinesWriter, JUnitXMLWriter)
+
+
+def make_step_result(name, stdout_lines, expected_lines, return_code=0):
+    matches = [stdout_lines.index(line) if line in stdout_lines else None for line in expected_lines]
+    return StepResult(name,
+                      [CommandResult('echo test', return_code, 0, 0.5)],
+                      [OutputResult('stdout', 'exact', 'sequential', expected_lines, stdout_lines, matches),
+                       OutputResult('stderr', 'exact', 'sequential', [], [''], [])])
+
+
+class ReportWriterTests(unittest.TestCase):
+    def test_step_result_success(self):
+        self.assertTrue(make_step_result('ok', ['a', 'b'], ['a', 'b']).success)
+        self.assertFalse(make_step_result('missing', ['a'], ['a', 'b']).success)
+        self.assertFalse(make_step_result('out of order', ['b', 'a'], ['a', 'b']).success)
+        self.assertFalse(make_step_result('return code', ['a'], ['a'], return_code=1).success)
+
+    def test_terminal_writer_without_color(self):
+        stream = io.StringIO()
+        writer = TerminalWriter(stream, color=False)
+        writer.step_finished(make_step_result('plain', ['a', 'c'], ['a', 'b']))
+        writer.links_started()
+        writer.link_checked(LinkResult('http://example.com', 404))
+        expected = """Step: plain
+\tcommand: `echo test`
+\treturn_code: 0
+\tduration_seconds: 0.5
+\tExpected stdout (output_match_mode: exact, match_order: sequential):
+\t\ta
+\t\tb
+\tActual stdout:
+\t\ta
+\t\tc
+\tERROR expected lines not found:
+\t\tb
+\tExpected stderr (output_match_mode: exact, match_order: sequential):
+\tActual stderr:
+\t\t
+
+External link validation:
+\thttp://example.com Status: 404
+"""
+        self.assertEqual(expected, stream.getvalue())
+
+    def test_json_lines_writer(self):
+        stream = io.StringIO()
+        writer = JSONLinesWriter(stream)
+        writer.step_finished(make_step_result('first', ['a'], ['a']))
+        self.assertEqual(1, len(stream.getvalue().splitlines()), 'steps should be written as they finish')
+        writer.link_checked(LinkResult('http://example.com', 'Ignored', ignored=True))
+        writer.close(True)
+
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(['step', 'link', 'summary'], [r['type'] for r in records])
+        self.assertEqual('first', records[0]['name'])
+        self.assertEqual([0], records[0]['stdout']['matched_lines'])
+        self.assertEqual(0, records[0]['commands'][0]['return_code'])
+        self.assertTrue(records[1]['ignored'])
+        self.assertTrue(records[2]['success'])
+
+    def test_junit_xml_writer(self):
+        stream = io.StringIO()
+        writer = JUnitXMLWriter(stream, suite_name='doc.md')
+        writer.step_finished(make_step_result('passes', ['a'], ['a']))
+        writer.step_finished(make_step_result('fails <badly>', ['a'], ['b']))
+        writer.link_checked(LinkResult('http://example.com/?a=1&b=2', 500))
+        writer.link_checked(LinkResult('http://example.com/ignored', 'Ignored', ignored=True))
+        writer.close(False)
+
+        document = minidom.parseString(stream.getvalue())
+        cases = document.getElementsByTagName('testcase')
+        self.assertEqual(['passes', 'fails <badly>', 'http://example.com/?a=1&b=2', 'http://example.com/ignored'],
+                         [c.getAttribute('name') for c in cases])
+        self.assertEqual([0, 1, 1, 0], [len(c.getElementsByTagName('failure')) for c in cases])
+        self.assertEqual(1, len(cases[3].getElementsByTagName('skipped')))
+        self.assertEqual('doc.md.links', cases[2].getAttribute('classname'))
+
+    def test_writers_with_several_files(self):
+        json_stream = io.StringIO()
+        junit_stream = io.StringIO()
+        writers = [JSONLinesWriter(json_stream), JUnitXMLWriter(junit_stream)]
+        for filename in 'a.md', 'b.md':
+            for writer in writers:
+                writer.file_started(filename)
+                writer.step_finished(make_step_result('step', ['a'], ['a']))
+        for writer in writers:
+            writer.close(True)
+
+        records = [json.loads(line) for line in json_stream.getvalue().splitlines()]
+        self.assertEqual(['a.md', 'b.md'], [r['file'] for r in records[:2]])
+        suites = minidom.parseString(junit_stream.getvalue()).getElementsByTagName('testsuite')
+        self.assertEqual(['a.md', 'b.md'], [s.getAttribute('name') for s in suites])
+        self.assertEqual([1, 1], [len(s.getElementsByTagName('testcase')) for s in suites])
+
+    def test_output_lines(self):
+        texts = ["a\nb\n", "", "c\nb c"]
+        lines = OutputLines(texts, [[1.0, 2.0], [], [3.0]])
+        self.assertEqual("\n".join(texts).split("\n"), list(lines))
+        self.assertEqual(['a', 'b', '', '', 'c', 'b c'], lines)
+        self.assertEqual(6, len(lines))
+        self.assertEqual('b c', lines[-1])
+        self.assertEqual(['b', ''], lines[1:3])
+        self.assertEqual([1.0, 2.0, None, None, 3.0, None], [lines.line_time(idx) for idx in range(len(lines))])
+
+        self.assertEqual(1, lines.find('b'))
+        self.assertEqual(-1, lines.find('b', skip={1}))
+        self.assertEqual(5, lines.find('b', exact=False, skip={1}))
+        self.assertEqual(2, lines.find(''))
+        self.assertEqual(-1, lines.find('b\n'))
+        self.assertEqual(-1, OutputLines([]).find('a'))
+
+        for texts in (texts, ["a", "b\n", "\n"], []):
+            self.assertEqual("".join(texts).splitlines(), list(OutputLines(texts).joined()))
@@ -0,0 +1,130 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+"""
+
+import unittest
+
+from mechanical_markdown import MechanicalMarkdown, MarkdownAnnotationError
+from mechanical_markdown.lint import lint_markdown, ERROR
+from mechanical_markdown.selection import SelectionError, StepSelection, TagExpression
+
+
+def step(name, tags=None, extra=""):
+    tag_lines = "tags:\n" + "".join(f"  - {tag}\n" for tag in tags) if tags else ""
+    return f"""
+<!-- STEP
+name: {name}
+{tag_lines}{extra}-->
+
+```bash
+echo "{name}"
+```
+
+<!-- END_STEP -->
+"""
+
+
+tutorial = "".join([
+    step('install'),
+    step('start database', ['setup'], "fixture: db\n"),
+    step('create schema', ['setup', 'slow'], "depends_on: start database\n"),
+    step('linux only', ['linux']),
+    step('windows only', ['windows', 'slow']),
+    step('query', ['query'], "depends_on:\n  - create schema\nfixtures: [db]\n"),
+    step('stop database', ['setup'], "teardown_fixture: db\n"),
+    step('cleanup'),
+])
+
+
+class SelectionTests(unittest.TestCase):
+    def setUp(self):
+        self.recipe = MechanicalMarkdown(tutorial)
+
+    def selected(self, *args, **kwargs):
+        return [s.name for s in StepSelection(*args, **kwargs).select(self.recipe)]
+
+    def test_tag_expressions(self):
+        index = {'a': {0, 1}, 'b': {1, 2}, 'c': {3}}
+        everything = frozenset(range(5))
+        for text, expected in (('a', {0, 1}),
+                               ('missing', set()),
+                               ('a and b', {1}),
+                               ('a or c', {0, 1, 3}),
+                               ('not a', {2, 3, 4}),
+                               ('a and not b or c', {0, 3}),
+                               ('a and not (b or c)', {0}),
+                               ('not not  c', {3})):
+            self.assertEqual(expected, TagExpression(text).select(index, everything), text)
+
+        for text in ('', 'a and', 'a b', '(a or b', 'a) or b', 'not a or', 'and a', '"a or b', 'db(local) or a'):
+            with self.assertRaises(SelectionError, msg=text):
+                TagExpression(text)
+
+    def test_plain_tags(self):
+        # A single word is matched as it is, like tags were before expressions
+        index = {'and': {0}, 'db(local)': {1}, 'a b': {2}, 'not': {3}}
+        everything = frozenset(range(5))
+        for text, expected in (('and', {0}),
+                               (' db(local) ', {1}),
+                               ('"db(local)" or "a b"', {1, 2}),
+                               ("'and' or not 'not'", {0, 1, 2, 4}),
+                               ('not', {3})):
+            self.assertEqual(expected, TagExpression(text).select(index, everything), text)
+
+    def test_everything_is_selected_by_default(self):
+        self.assertEqual([s.name for s in self.recipe.all_steps], self.selected())
+
+    def test_tags_select_untagged_steps_too(self):
+        self.assertEqual(['install', 'linux only', 'cleanup'], self.selected(['linux']))
+        self.assertEqual(['install', 'start database', 'linux only', 'stop database', 'cleanup'],
+                         self.selected(['not slow and not query']))
+        # Steps that are excluded by the expression still run when a selected step depends on them
+        self.assertEqual(['install', 'start database', 'create schema', 'query', 'stop database', 'cleanup'],
+                         self.selected(['query']))
+
+    def test_strict_tags(self):
+        self.assertEqual(['linux only'], self.selected(['linux'], strict_tags=True))
+        # Dependencies still run, tagged or not
+        self.assertEqual(['start database', 'create schema', 'query', 'stop database'],
+                         self.selected(['query'], strict_tags=True))
+
+    def test_filter_steps(self):
+        install, start_database = self.recipe.all_steps[:2]
+        self.assertTrue(self.recipe.filter_steps([], start_database))
+        self.assertTrue(self.recipe.filter_steps(['setup'], start_database))
+        self.assertFalse(self.recipe.filter_steps(['query'], start_database))
+        self.assertTrue(self.recipe.filter_steps(['not slow and setup'], start_database))
+        self.assertTrue(self.recipe.filter_steps(['query'], install))
+
+    def test_steps_bring_their_dependencies(self):
+        self.assertEqual(['start database', 'create schema', 'query', 'stop database'], self.selected(steps=['query']))
+        self.assertEqual(['linux only'], self.selected(steps=['linux only']))
+        self.assertEqual(['start database', 'create schema', 'query', 'stop database', 'cleanup'],
+                         self.selected(from_step='query'))
+        self.assertEqual(['install', 'start database', 'create schema'], self.selected(until_step='create schema'))
+        self.assertEqual(['start database', 'create schema', 'linux only'],
+                         self.selected(['not windows'], from_step='create schema', until_step='windows only'))
+
+    def test_unknown_steps(self):
+        self.assertEqual([], self.selected(steps=['missing']))
+        StepSelection(steps=['query']).check([self.recipe])
+        with self.assertRaises(SelectionError):
+            StepSelection(from_step='missing').check([self.recipe])
+        with self.assertRaises(SelectionError):
+            self.recipe.run(False, [], selection=StepSelection(steps=['missing']))
+
+        document = step('needy', extra="depends_on: missing\n")
+        with self.assertRaises(MarkdownAnnotationError) as context:
+            MechanicalMarkdown(document)
+        self.assertEqual(2, context.exception.line)
+        self.assertEqual([(2, ERROR, "Step 'needy' depends on 'missing', but there is no such step")],
+                         [(d.line, d.severity, d.message) for d in lint_markdown(document)])
+
+    def test_dependencies_have_to_come_first(self):
+        document = step('needy', extra="depends_on: later\n") + step('later')
+        with self.assertRaises(MarkdownAnnotationError) as context:
+            MechanicalMarkdown(document)
+        self.assertEqual(2, context.exception.line)
+        self.assertEqual([(2, ERROR, "Step 'needy' depends on 'later', which only comes after it")],
+                         [(d.line, d.severity, d.message) for d in lint_markdown(document)])
@@ -0,0 +1,60 @@
+"""
+Copyright (c) Microsoft Corporation.
+Licensed under the MIT License.
+"""
+
+import os
+import subprocess
+import sys
+import unittest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLE = os.path.join(REPO_ROOT, 'examples', 'env.md')
+
+# Generous budgets (in microseconds) for the imports done by our own entry points, not counting
+# interpreter startup. They are meant to catch somebody pulling a heavy dependency back onto
+# a light path, not to benchmark the machine running the tests.
+VERSION_BUDGET_US = 250000
+DRY_RUN_BUDGET_US = 1000000
+
+
+def import_profile(*args):
+    """Run mm.py with -X importtime and return {module: self time in us} for modules imported after site."""
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'mechanical_markdown'] + list(args),
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               universal_newlines=True, env=env, cwd=REPO_ROOT)
+    modules = {}
+    after_site = False
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        if not self_us.strip().isdigit():
+            continue
+        if name.strip() == 'site' and not name.startswith('  '):
+            after_site = True
+            continue
+        if after_site:
+            modules[name.strip()] = int(self_us)
+    return completed.returncode, modules
+
+
+class StartupTimeTests(unittest.TestCase):
+    def assertNotImported(self, modules, *names):
+        for name in names:
+            self.assertNotIn(name, modules, f'{name} should not be imported on this path')
+
+    def test_version_is_cheap(self):
+        return_code, modules = import_profile('--version')
+        self.assertEqual(0, return_code)
+        self.assertIn('mechanical_markdown', modules)
+        self.assertNotImported(modules, 'requests', 'mistune', 'yaml', 'termcolor', 'colorama')
+        self.assertLess(sum(modules.values()), VERSION_BUDGET_US)
+
+    def test_dry_run_does_not_import_requests(self):
+        return_code, modules = import_profile('--dry-run', EXAMPLE)
+        self.assertEqual(0, return_code)
+        self.assertIn('mechanical_markdown.recipe', modules)
+        self.assertNotImported(modules, 'requests', 'urllib3', 'charset_normalizer', 'colorama')
+        self.assertLess(sum(modules.values()), DRY_RUN_BUDGET_US)